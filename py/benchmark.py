@@ -0,0 +1,371 @@
+# Copyright 2022 Lorna Authors. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Inference latency of the eager Darknet against the compiled DarknetInference wrapper, training step time, NMS and AP.
+
+Usage:
+    python benchmark.py --cfg ../cfg/roidepth_0_0_2.cfg --img-size 128 --batch-size 1 --compile
+    python benchmark.py --cfg ../cfg/roidepth_0_0_2.cfg --img-size 128 --batch-size 64 --train-step
+    python benchmark.py --cfg ../cfg/yolov3-tiny.cfg --img-size 416 --nms 16 64
+    python benchmark.py --ap 3 80 --ap-detections 2000 20000
+
+"""
+import argparse
+import time
+from typing import Callable, Tuple
+
+import numpy as np
+import torch
+import torchvision
+import yaml
+from torch import Tensor
+
+from dataset import num_label_columns
+from model import Darknet, DarknetInference, ROIDepthLoss, _build_targets
+from utils import ap_per_class, compute_ap, load_pretrained_torch_state_dict, load_pretrained_darknet_state_dict, \
+    non_max_suppression, xywh2xyxy
+
+
+def measure_latency(function: Callable, images: Tensor, roi: Tensor, iters: int = 100, warmup: int = 10) -> float:
+    """Returns the mean latency of function(images, roi) in milliseconds.
+
+    Args:
+        function (Callable): The model to measure.
+        images (Tensor): The input images.
+        roi (Tensor): The input ROI info.
+        iters (int, optional): Number of measured calls. Defaults: 100.
+        warmup (int, optional): Number of calls before measuring. Defaults: 10.
+
+    Returns:
+        latency (float): Mean latency in milliseconds.
+
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            function(images, roi)
+        start = time.perf_counter()
+        for _ in range(iters):
+            function(images, roi)
+
+    return (time.perf_counter() - start) / iters * 1000
+
+
+def synthetic_targets(batch_size: int, targets_per_image: int, num_classes: int) -> Tensor:
+    """Returns random targets in the `LoadImagesAndLabels.collate_fn` layout, (image, class, xywh, depth, ...).
+
+    Args:
+        batch_size (int): Number of images.
+        targets_per_image (int): Number of targets of every image.
+        num_classes (int): Number of classes.
+
+    Returns:
+        targets (Tensor): Normalized targets with shape (batch_size * targets_per_image, 12).
+
+    """
+    n = batch_size * targets_per_image
+    targets = torch.rand(n, num_label_columns + 1)
+    targets[:, 0] = torch.arange(batch_size).repeat_interleave(targets_per_image)
+    targets[:, 1] = torch.randint(0, num_classes, (n,))
+    targets[:, 4:6] = targets[:, 4:6] * 0.3 + 0.01  # small boxes, like distant cars
+
+    return targets
+
+
+def measure_train_step(
+        model: Darknet,
+        images: Tensor,
+        roi: Tensor,
+        targets: Tensor,
+        iters: int = 20,
+        warmup: int = 3,
+) -> Tuple[float, float]:
+    """Returns the mean latency of target assignment and of a full training step in milliseconds.
+
+    Args:
+        model (Darknet): The model, with hyper_parameters_dict, gr and num_classes set.
+        images (Tensor): The input images.
+        roi (Tensor): The input ROI info.
+        targets (Tensor): The targets, the same number for every image as from `synthetic_targets`.
+        iters (int, optional): Number of measured steps. Defaults: 20.
+        warmup (int, optional): Number of steps before measuring. Defaults: 3.
+
+    Returns:
+        build_targets_latency (float): Mean `_build_targets` latency in milliseconds.
+        step_latency (float): Mean forward, loss and backward latency in milliseconds.
+
+    """
+    model.train()
+    criterion = ROIDepthLoss(model.hyper_parameters_dict).to(images.device)
+    build_targets_time = step_time = 0.0
+    for i in range(warmup + iters):
+        start = time.perf_counter()
+        p, p_roidepth = model(images, roi)
+        middle = time.perf_counter()
+        _build_targets(p, targets, model)
+        end = time.perf_counter()
+        # The depth loss pairs every target with one depth prediction, repeat them per target of the image
+        p_roidepth = p_roidepth.repeat_interleave(targets.shape[0] // images.shape[0], 0)
+        loss, _ = criterion(p, p_roidepth, targets, model)
+        loss.backward()
+        model.zero_grad(set_to_none=True)
+        if i >= warmup:
+            build_targets_time += end - middle
+            # The step runs _build_targets once, inside the criterion
+            step_time += time.perf_counter() - start - (end - middle)
+
+    return build_targets_time / iters * 1000, step_time / iters * 1000
+
+
+def _per_image_nms(prediction: Tensor, conf_threshold: float, iou_threshold: float) -> list:
+    """The former `non_max_suppression`, one filter and one nms call per image, without its time limit."""
+    min_wh, max_wh = 2, 4096
+    multi_label = prediction.shape[2] > 6
+    output = [None] * prediction.shape[0]
+    for xi, x in enumerate(prediction):
+        x = x[x[:, 4] > conf_threshold]
+        x = x[((x[:, 2:4] > min_wh) & (x[:, 2:4] < max_wh)).all(1)]
+        if not x.shape[0]:
+            continue
+        x[..., 5:] *= x[..., 4:5]
+        box = xywh2xyxy(x[:, :4])
+        if multi_label:
+            i, j = (x[:, 5:] > conf_threshold).nonzero().t()
+            x = torch.cat((box[i], x[i, j + 5].unsqueeze(1), j.float().unsqueeze(1)), 1)
+        else:
+            conf, j = x[:, 5:].max(1)
+            x = torch.cat((box, conf.unsqueeze(1), j.float().unsqueeze(1)), 1)[conf > conf_threshold]
+        if not x.shape[0]:
+            continue
+        i = torchvision.ops.nms(x[:, :4] + x[:, 5:6] * max_wh, x[:, 4], iou_threshold)
+        output[xi] = x[i]
+
+    return output
+
+
+def measure_nms(
+        prediction: Tensor,
+        conf_threshold: float = 0.001,
+        iou_threshold: float = 0.6,
+        iters: int = 20,
+        warmup: int = 3,
+) -> Tuple[float, float, float]:
+    """Returns the mean latency of the per-image NMS loop and of the batched `non_max_suppression` in milliseconds.
+
+    The batched NMS runs with its defaults, as called by `Tester`, `Detector` and quantize, and with merged boxes.
+
+    Args:
+        prediction (Tensor): Decoded predictions with shape (B, N, 5 + classes).
+        conf_threshold (float, optional): Confidence threshold. Defaults: 0.001.
+        iou_threshold (float, optional): NMS IoU threshold. Defaults: 0.6.
+        iters (int, optional): Number of measured calls. Defaults: 20.
+        warmup (int, optional): Number of calls before measuring. Defaults: 3.
+
+    Returns:
+        loop_latency (float): Mean latency of the per-image loop in milliseconds.
+        batched_latency (float): Mean latency of the batched NMS with its defaults in milliseconds.
+        merge_latency (float): Mean latency of the batched NMS with merged boxes in milliseconds.
+
+    """
+    functions = (
+        lambda: _per_image_nms(prediction.clone(), conf_threshold, iou_threshold),
+        lambda: non_max_suppression(prediction.clone(), conf_threshold, iou_threshold),
+        lambda: non_max_suppression(prediction.clone(), conf_threshold, iou_threshold, merge=True),
+    )
+    latencies = []
+    for function in functions:
+        for _ in range(warmup):
+            function()
+        start = time.perf_counter()
+        for _ in range(iters):
+            function()
+        latencies.append((time.perf_counter() - start) / iters * 1000)
+
+    return tuple(latencies)
+
+
+def _per_class_ap(tp, conf, pred_cls, target_cls) -> tuple:
+    """The former `ap_per_class`, one `compute_ap` call per class and IoU threshold."""
+    i = np.argsort(-conf)
+    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    unique_classes = np.unique(target_cls)
+    pr_score = 0.1
+    s = [unique_classes.shape[0], tp.shape[1]]
+    ap, p, r = np.zeros(s), np.zeros(s), np.zeros(s)
+    for ci, c in enumerate(unique_classes):
+        i = pred_cls == c
+        n_gt = (target_cls == c).sum()
+        if i.sum() == 0 or n_gt == 0:
+            continue
+        fpc = (1 - tp[i]).cumsum(0)
+        tpc = tp[i].cumsum(0)
+        recall = tpc / (n_gt + 1e-16)
+        r[ci] = np.interp(-pr_score, -conf[i], recall[:, 0])
+        precision = tpc / (tpc + fpc)
+        p[ci] = np.interp(-pr_score, -conf[i], precision[:, 0])
+        for j in range(tp.shape[1]):
+            ap[ci, j] = compute_ap(recall[:, j], precision[:, j])
+    f1 = 2 * p * r / (p + r + 1e-16)
+
+    return p, r, ap, f1, unique_classes.astype('int32')
+
+
+def synthetic_stats(num_detections: int, num_classes: int, num_thresholds: int) -> tuple:
+    """Returns random `ap_per_class` inputs, each target matched at most once per IoU threshold.
+
+    Args:
+        num_detections (int): Number of detections.
+        num_classes (int): Number of classes.
+        num_thresholds (int): Number of IoU thresholds.
+
+    Returns:
+        stats (tuple): tp (num_detections, num_thresholds), conf, pred_cls and target_cls.
+
+    """
+    rng = np.random.default_rng(0)
+    tp = rng.random((num_detections, num_thresholds)) < np.linspace(0.6, 0.1, num_thresholds)
+    conf = rng.random(num_detections).astype(np.float32)
+    pred_cls = rng.integers(0, num_classes, num_detections).astype(np.float32)
+    target_cls = rng.integers(0, num_classes, num_detections // 5).astype(np.float32)
+    for c in range(num_classes):
+        i = pred_cls == c
+        tp[i] &= tp[i].cumsum(0) <= (target_cls == c).sum()
+
+    return tp, conf, pred_cls, target_cls
+
+
+def measure_ap(stats: tuple, iters: int = 20, warmup: int = 3) -> Tuple[float, float]:
+    """Returns the best latency of the per-class `compute_ap` loop and of `ap_per_class` in milliseconds.
+
+    Both results are checked to be identical first.
+
+    Args:
+        stats (tuple): tp, conf, pred_cls and target_cls as from `synthetic_stats`.
+        iters (int, optional): Number of measured calls. Defaults: 20.
+        warmup (int, optional): Number of calls before measuring. Defaults: 3.
+
+    Returns:
+        loop_latency (float): Best latency of the per-class loop in milliseconds.
+        vectorized_latency (float): Best latency of `ap_per_class` in milliseconds.
+
+    """
+    for x, y in zip(_per_class_ap(*stats), ap_per_class(*stats)):
+        assert np.array_equal(x, y), "ap_per_class does not match the compute_ap loop"
+
+    latencies = []
+    for function in (_per_class_ap, ap_per_class):
+        for _ in range(warmup):
+            function(*stats)
+        best = float("inf")
+        for _ in range(iters):
+            start = time.perf_counter()
+            function(*stats)
+            best = min(best, time.perf_counter() - start)
+        latencies.append(best * 1000)
+
+    return tuple(latencies)
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    if args.ap:
+        print(("%8s" * 3 + "%12s" * 3) % ("classes", "ious", "dets", "loop ms", "vector ms", "speedup"))
+        for num_classes in args.ap:
+            for num_thresholds in (1, 10):
+                for num_detections in args.ap_detections:
+                    loop, vectorized = measure_ap(synthetic_stats(num_detections, num_classes, num_thresholds),
+                                                  args.iters, args.warmup)
+                    print(("%8d" * 3 + "%12.3f" * 2 + "%11.2fx") % (
+                        num_classes, num_thresholds, num_detections, loop, vectorized, loop / vectorized))
+        return
+
+    image_size = (args.img_size, args.img_size)
+    model = Darknet(args.cfg, image_size=image_size, gray=args.gray)
+    if args.weights.endswith(".weights"):
+        load_pretrained_darknet_state_dict(model, args.weights)
+    elif args.weights:
+        model = load_pretrained_torch_state_dict(model, args.weights)
+    model.eval()
+    if args.fuse:
+        model.fuse()
+
+    images = torch.rand(args.batch_size, 1 if args.gray else 3, *image_size)
+    roi = torch.rand(args.batch_size, 4)
+    if args.train_step:
+        with open(args.config, "r") as f:
+            model.hyper_parameters_dict = yaml.safe_load(f)["hyper"]
+        model.gr = 1.0
+        model.num_classes = model.module_list[model.yolo_layers[0]].num_classes
+        targets = synthetic_targets(args.batch_size, args.targets_per_image, model.num_classes)
+        build_targets_latency, step_latency = measure_train_step(model, images, roi, targets, args.iters, args.warmup)
+        print(f"{args.cfg} batch {args.batch_size} {args.img_size}x{args.img_size}, {targets.shape[0]} targets, "
+              f"{torch.get_num_threads()} threads")
+        print(f"{'_build_targets':>24s}: {build_targets_latency:8.3f} ms")
+        print(f"{'training step':>24s}: {step_latency:8.3f} ms")
+        return
+
+    wrapper = DarknetInference(model, image_size).eval()
+
+    if args.nms:
+        print(f"{args.cfg} {args.img_size}x{args.img_size}, conf {args.conf_threshold} iou {args.iou_threshold}, "
+              f"{torch.get_num_threads()} threads")
+        print(("%8s" * 3 + "%12s" * 5) % ("batch", "boxes", "dets", "loop ms", "default ms", "speedup", "merge ms",
+                                          "speedup"))
+        for batch_size in args.nms:
+            with torch.no_grad():
+                prediction, _ = wrapper(torch.rand(batch_size, images.shape[1], *image_size), torch.rand(batch_size, 4))
+            detections = non_max_suppression(prediction.clone(), args.conf_threshold, args.iou_threshold)
+            loop, batched, merge = measure_nms(prediction, args.conf_threshold, args.iou_threshold, args.iters,
+                                               args.warmup)
+            print(("%8d" * 3 + "%12.3f" * 2 + "%11.2fx" + "%12.3f" + "%11.2fx") % (
+                batch_size, prediction.shape[1], sum(x.shape[0] for x in detections if x is not None), loop, batched,
+                loop / batched, merge, loop / merge))
+        return
+
+    candidates = {
+        "eager Darknet": model,
+        "eager DarknetInference": wrapper,
+        "torch.jit.script": torch.jit.freeze(torch.jit.script(wrapper)),
+    }
+    if args.compile:
+        candidates["torch.compile"] = torch.compile(wrapper)
+
+    print(f"{args.cfg} batch {args.batch_size} {args.img_size}x{args.img_size}, {torch.get_num_threads()} threads")
+    baseline = None
+    for name, function in candidates.items():
+        latency = measure_latency(function, images, roi, args.iters, args.warmup)
+        baseline = baseline or latency
+        print(f"{name:>24s}: {latency:8.3f} ms  ({baseline / latency:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="CPU inference latency of Darknet variants.")
+    parser.add_argument("--cfg", type=str, default="../cfg/roidepth_0_0_2.cfg", help="model config")
+    parser.add_argument("--weights", type=str, default="", help="weights, random initialization if empty")
+    parser.add_argument("--img-size", type=int, default=128, help="input size")
+    parser.add_argument("--batch-size", type=int, default=1, help="batch size")
+    parser.add_argument("--gray", action="store_true", help="grayscale input")
+    parser.add_argument("--fuse", action="store_true", help="fuse Conv2d + BatchNorm2d first")
+    parser.add_argument("--compile", action="store_true", help="also measure torch.compile (slow first call)")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, torch default if 0")
+    parser.add_argument("--iters", type=int, default=100, help="measured iterations")
+    parser.add_argument("--warmup", type=int, default=10, help="warmup iterations")
+    parser.add_argument("--train-step", action="store_true", help="measure target assignment and a training step")
+    parser.add_argument("--targets-per-image", type=int, default=16, help="synthetic targets per image")
+    parser.add_argument("--config", type=str, default="../config.yaml", help="config with the hyper section")
+    parser.add_argument("--nms", type=int, nargs="*", default=[], help="measure NMS at these batch sizes, e.g. 16 64")
+    parser.add_argument("--conf-threshold", type=float, default=0.001, help="NMS confidence threshold")
+    parser.add_argument("--iou-threshold", type=float, default=0.6, help="NMS IoU threshold")
+    parser.add_argument("--ap", type=int, nargs="*", default=[], help="measure ap_per_class at these class counts")
+    parser.add_argument("--ap-detections", type=int, nargs="+", default=[2000, 20000], help="detections for --ap")
+    main(parser.parse_args())
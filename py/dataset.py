@@ -12,13 +12,18 @@
 # limitations under the License.
 # ==============================================================================
 import glob
+import hashlib
 import math
 import os
 import random
 import time
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
 from pathlib import Path
 from threading import Thread
-from typing import Any, Tuple, List
+from typing import Any, Callable, Iterable, Iterator, Tuple, List
 
 import cv2
 import numpy as np
@@ -35,14 +40,20 @@ from utils import make_directory
 
 __all__ = [
     "parse_dataset_config", "load_image", "augment_hsv", "load_mosaic", "letterbox", "random_affine", "cutout",
-    "xywh2xyxy", "xyxy2xywh", "labels_to_class_weights",
+    "xywh2xyxy", "xyxy2xywh", "labels_to_class_weights", "resize_image", "parse_labels", "letterbox_sample",
+    "finish_sample", "label_roi",
     "LoadImages", "LoadStreams", "LoadWebcam",
-    "LoadImagesAndLabels"
+    "ImageArena", "LoadImagesAndLabels"
 ]
 
 support_image_formats = [".bmp", ".jpg", ".jpeg", ".png", ".tif", ".tiff", ".dng"]
 support_video_formats = [".mov", ".avi", ".mp4", ".mpg", ".mpeg", ".m4v", ".wmv", ".mkv"]
 
+# Bump whenever the layout of the *.cache label files changes
+labels_cache_version = 1
+image_arena_version = 1
+num_label_columns = 11  # class, xywh, depth, x-location, roi xywh
+
 # Get orientation exif tag
 for orientation in ExifTags.TAGS.keys():
     if ExifTags.TAGS[orientation] == "Orientation":
@@ -73,6 +84,263 @@ def _exif_size(image: Image.Image) -> tuple:
     return image_size
 
 
+def _read_image_shape(path: str) -> tuple:
+    """Get the exif-corrected size (width, height) of an image file without decoding it."""
+    with Image.open(path) as image:
+        return _exif_size(image)
+
+
+def _imap(
+        function: Callable,
+        items: Iterable,
+        num_workers: int = 8,
+        processes: bool = False,
+) -> Iterator:
+    """Map a function over items on a thread or process pool, yielding the results in order.
+
+    Threads suit work that releases the GIL (OpenCV decoding and resizing), processes suit pure Python parsing.
+    The function must be picklable (module level) if processes are used.
+
+    Args:
+        function (Callable): The function to apply.
+        items (Iterable): The items.
+        num_workers (int, optional): Number of workers, items are mapped serially if it is 1 or less. Defaults: 8.
+        processes (bool, optional): Whether to use a process pool instead of a thread pool. Defaults: ``False``.
+
+    Returns:
+        results (Iterator): The results in the order of items.
+
+    """
+    if num_workers <= 1:
+        yield from map(function, items)
+        return
+
+    items = list(items)
+    if processes:
+        executor = ProcessPoolExecutor(num_workers)
+        chunk_size = max(1, min(64, len(items) // (num_workers * 4)))
+    else:
+        executor = ThreadPoolExecutor(num_workers)
+        chunk_size = 1
+    with executor:
+        yield from executor.map(function, items, chunksize=chunk_size)
+
+
+def _file_signature(path: str) -> Tuple[int, int]:
+    """Get the modification time and size of a file.
+
+    Args:
+        path (str): The path of the file.
+
+    Returns:
+        signature (tuple): (mtime_ns, size), or (-1, -1) if the file does not exist.
+
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return -1, -1
+
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _read_label_file(path: str) -> ndarray or None:
+    """Read and check one label file.
+
+    Args:
+        path (str): The path of the label file.
+
+    Returns:
+        labels (ndarray): Labels with shape (n, 11), or None if the file is missing.
+
+    """
+    try:
+        with open(path, "r") as f:
+            text = f.read()
+    except:
+        return None
+
+    return parse_labels(text, path)
+
+
+def parse_labels(text: str, path: str = "") -> ndarray:
+    """Parse and check the content of one label file.
+
+    Args:
+        text (str): The content of the label file.
+        path (str, optional): The path of the label file, used in error messages. Defaults: "".
+
+    Returns:
+        labels (ndarray): Labels with shape (n, 11).
+
+    """
+    labels = np.asarray([x.split() for x in text.splitlines()], dtype=np.float32)
+    if labels.shape[0]:
+        assert labels.shape[1] == num_label_columns, f"> {num_label_columns} label columns: {path}"
+        assert (labels >= 0).all(), f"negative labels: {path}"
+        assert (labels[:, 1:] <= 1).all(), f"non-normalized or out of bounds coordinate labels: {path}"
+    else:
+        labels = np.zeros((0, num_label_columns), dtype=np.float32)
+
+    return labels
+
+
+def _gather_labels(labels: ndarray, offsets: ndarray, index: ndarray) -> Tuple[ndarray, ndarray]:
+    """Reorder packed labels by image.
+
+    Args:
+        labels (ndarray): Packed labels, shape (m, 11).
+        offsets (ndarray): Per-image offsets into `labels`, shape (n + 1,).
+        index (ndarray): The new image order, shape (n,).
+
+    Returns:
+        labels (ndarray): Packed labels in the new image order.
+        offsets (ndarray): Per-image offsets into the new labels.
+
+    """
+    counts = np.diff(offsets)[index]
+    new_offsets = np.zeros(len(index) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum(counts)
+    rows = np.repeat(offsets[:-1][index] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+
+    return labels[rows], new_offsets
+
+
+def _load_labels_cache(cache_path: str) -> dict or None:
+    """Load a label cache written by `_cache_labels`.
+
+    Args:
+        cache_path (str): The path of the cache file.
+
+    Returns:
+        cache (dict): The cache content, or None if it is missing, unreadable or of another version.
+
+    """
+    try:
+        with np.load(cache_path, allow_pickle=False) as f:
+            cache = {k: f[k] for k in f.files}
+    except:
+        return None
+
+    if int(cache.get("version", -1)) != labels_cache_version:
+        return None
+
+    return cache
+
+
+def _cache_labels(
+        image_files: List[str],
+        label_files: List[str],
+        cache_path: str,
+        shapes_path: str = None,
+        num_workers: int = 8,
+        processes: bool = False,
+) -> dict:
+    """Read image shapes and labels through a versioned binary cache.
+
+    The cache holds one packed float32 label array, per-image offsets into it, image shapes, the label status of every
+    image and a hash of the file list and file signatures. If the hash matches the whole cache is used as is, otherwise
+    only images or label files whose (mtime, size) changed are read again and the cache is rewritten.
+
+    Args:
+        image_files (List[str]): The image paths.
+        label_files (List[str]): The label paths, one per image.
+        cache_path (str): The path of the cache file.
+        shapes_path (str, optional): The path of a legacy *.shapes file, used for images not found in the cache.
+        num_workers (int, optional): Number of workers reading shapes and labels. Defaults: 8.
+        processes (bool, optional): Whether to read with processes instead of threads. Defaults: ``False``.
+
+    Returns:
+        cache (dict): shapes (n, 2) wh, labels (m, 11), offsets (n + 1,), status (n,) 0: found, 1: missing, 2: empty,
+            duplicate (n,).
+
+    """
+    num_images = len(image_files)
+    signatures = np.asarray([_file_signature(x) + _file_signature(y) for x, y in zip(image_files, label_files)],
+                            dtype=np.int64).reshape(num_images, 4)
+    files_hash = hashlib.md5("\n".join(image_files).encode("utf-8"))
+    files_hash.update(signatures.tobytes())
+    files_hash = files_hash.hexdigest()
+
+    cache = _load_labels_cache(cache_path)
+    if cache is not None and str(cache["hash"]) == files_hash:
+        return cache
+
+    # Reuse the entries of files that did not change
+    cached_index = {}
+    if cache is not None:
+        cached_index = {x: i for i, x in enumerate(cache["image_files"].tolist())}
+
+    shapes = np.zeros((num_images, 2), dtype=np.float64)
+    status = np.zeros(num_images, dtype=np.int8)
+    duplicate = np.zeros(num_images, dtype=bool)
+    labels = [None] * num_images
+    todo_shapes, todo_labels = [], []
+    for i, file in enumerate(image_files):
+        j = cached_index.get(file, -1)
+        if j >= 0 and (cache["signatures"][j, :2] == signatures[i, :2]).all():
+            shapes[i] = cache["shapes"][j]
+        else:
+            todo_shapes.append(i)
+
+        if j >= 0 and (cache["signatures"][j, 2:] == signatures[i, 2:]).all():
+            labels[i] = cache["labels"][cache["offsets"][j]:cache["offsets"][j + 1]]
+            status[i], duplicate[i] = cache["status"][j], cache["duplicate"][j]
+        else:
+            todo_labels.append(i)
+
+    # Read image shapes (wh)
+    if todo_shapes:
+        legacy_shapes = None
+        if shapes_path is not None:
+            try:
+                with open(shapes_path, "r") as f:  # read existing shapefile
+                    legacy_shapes = [x.split() for x in f.read().splitlines()]
+                    assert len(legacy_shapes) == num_images, "Shapefile out of sync"
+            except:
+                legacy_shapes = None
+
+        if legacy_shapes is not None:
+            results = (legacy_shapes[i] for i in todo_shapes)
+        else:
+            results = _imap(_read_image_shape, [image_files[i] for i in todo_shapes], num_workers, processes)
+        for i, shape in zip(todo_shapes, tqdm(results, total=len(todo_shapes), desc="Reading image shapes")):
+            shapes[i] = shape
+
+    # Read labels
+    results = _imap(_read_label_file, [label_files[i] for i in todo_labels], num_workers, processes)
+    for i, x in zip(todo_labels, tqdm(results, total=len(todo_labels), desc="Reading labels")):
+        if x is None:
+            labels[i], status[i] = np.zeros((0, num_label_columns), dtype=np.float32), 1
+        else:
+            labels[i], status[i] = x, 0 if x.shape[0] else 2
+            duplicate[i] = x.shape[0] > 0 and np.unique(x, axis=0).shape[0] < x.shape[0]
+
+    offsets = np.zeros(num_images + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([x.shape[0] for x in labels])
+    cache = {
+        "version": np.array(labels_cache_version),
+        "hash": np.array(files_hash),
+        "image_files": np.array(image_files),
+        "signatures": signatures,
+        "shapes": shapes,
+        "labels": np.concatenate(labels, 0) if num_images else np.zeros((0, num_label_columns), dtype=np.float32),
+        "offsets": offsets,
+        "status": status,
+        "duplicate": duplicate,
+    }
+
+    # Write to a temporary file first so that an interrupted run never leaves a truncated cache behind
+    try:
+        with open(cache_path + ".tmp", "wb") as f:
+            np.savez(f, **cache)
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError as e:
+        print(f"WARNING: Cache directory is not writeable, labels are not cached ({e})")
+
+    return cache
+
+
 def parse_dataset_config(path: str) -> dict:
     """Parses the data configuration file
 
@@ -112,19 +380,60 @@ def load_image(self, index: int) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int
 
     """
     # loads 1 image from dataset, returns image, original hw, resized hw
-    image = self.images[index]
-    if image is None:  # not cached
-        path = self.image_files[index]
-        image = cv2.imread(path)  # BGR
-        assert image is not None, "Image Not Found " + path
-        h0, w0 = image.shape[:2]  # orig hw
-        r = self.image_size / max(h0, w0)  # resize image to image_size
-        if r != 1:  # always resize down, only resize up if training with augmentation
-            interp = cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR
-            image = cv2.resize(image, (int(w0 * r), int(h0 * r)), interpolation=interp)
-        return image, (h0, w0), image.shape[:2]  # image, hw_original, hw_resized
-    else:
-        return self.images[index], self.image_hw0[index], self.image_hw[index]  # image, hw_original, hw_resized
+    if self.image_cache is not None:
+        return self.image_cache[index]  # image, hw_original, hw_resized
+
+    return _read_resized_image(self.image_files[index], self.image_size, self.augment)
+
+
+def _read_resized_image(
+        path: str,
+        image_size: int,
+        augment: bool = False,
+) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int]]:
+    """Reads an image and resizes its longest side to image_size.
+
+    Args:
+        path (str): The path of the image
+        image_size (int): The size of the longest side after resizing
+        augment (bool, optional): Whether the dataset augments images, selects the interpolation. Defaults: ``False``.
+
+    Returns:
+        image (np.ndarray): BGR image
+        hw_original (tuple): Height and width before resizing
+        hw_resized (tuple): Height and width after resizing
+
+    """
+    image = cv2.imread(path)  # BGR
+    assert image is not None, "Image Not Found " + path
+
+    return resize_image(image, image_size, augment)
+
+
+def resize_image(
+        image: np.ndarray,
+        image_size: int,
+        augment: bool = False,
+) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int]]:
+    """Resizes the longest side of a decoded image to image_size.
+
+    Args:
+        image (np.ndarray): BGR image
+        image_size (int): The size of the longest side after resizing
+        augment (bool, optional): Whether the dataset augments images, selects the interpolation. Defaults: ``False``.
+
+    Returns:
+        image (np.ndarray): BGR image
+        hw_original (tuple): Height and width before resizing
+        hw_resized (tuple): Height and width after resizing
+
+    """
+    h0, w0 = image.shape[:2]  # orig hw
+    r = image_size / max(h0, w0)  # resize image to image_size
+    if r != 1:  # always resize down, only resize up if training with augmentation
+        interp = cv2.INTER_AREA if r < 1 and not augment else cv2.INTER_LINEAR
+        image = cv2.resize(image, (int(w0 * r), int(h0 * r)), interpolation=interp)
+    return image, (h0, w0), image.shape[:2]  # image, hw_original, hw_resized
 
 
 def augment_hsv(image: ndarray, hgain: float = 0.5, sgain: float = 0.5, vgain: float = 0.5) -> None:
@@ -165,7 +474,7 @@ def load_mosaic(self, index: int) -> Tuple[np.ndarray, List]:
     labels4 = []
     s = self.image_size
     xc, yc = [int(random.uniform(s * 0.5, s * 1.5)) for _ in range(2)]  # mosaic center x, y
-    indices = [index] + [random.randint(0, len(self.labels) - 1) for _ in range(3)]  # 3 additional image indices
+    indices = [index] + [random.randint(0, self.num_images - 1) for _ in range(3)]  # 3 additional image indices
     for i, index in enumerate(indices):
         # Load image
         image, _, (h, w) = load_image(self, index)
@@ -190,7 +499,7 @@ def load_mosaic(self, index: int) -> Tuple[np.ndarray, List]:
         padh = y1a - y1b
 
         # Labels
-        x = self.labels[index]
+        x = self.image_labels(index)
         labels = x.copy()
         if x.size > 0:  # Normalized xywh to pixel xyxy format
             labels[:, 1] = w * (x[:, 1] - x[:, 3] / 2) + padw
@@ -198,7 +507,7 @@ def load_mosaic(self, index: int) -> Tuple[np.ndarray, List]:
             labels[:, 3] = w * (x[:, 1] + x[:, 3] / 2) + padw
             labels[:, 4] = h * (x[:, 2] + x[:, 4] / 2) + padh
         labels4.append(labels)
-        roi_labels =  [x[:, -4], x[:, -3], x[:, -2], x[:, -1]]
+        roi_labels = label_roi(x)
 
     # Concat/clip labels
     if len(labels4):
@@ -372,6 +681,145 @@ def cutout(image, labels):
     return labels
 
 
+def label_roi(x: ndarray) -> Tensor:
+    """Returns the ROI (x, y, w, h normalized to the original frame) of an image from its labels.
+
+    Args:
+        x (ndarray): Labels of the image, shape (n, 11), all labels of a ROI image share the last 4 columns.
+
+    Returns:
+        roi (Tensor): float32 tensor with shape (4,), zeros if the image has no labels.
+
+    """
+    if x.shape[0] == 0:
+        return torch.zeros(4, dtype=torch.float32)
+
+    return torch.from_numpy(np.ascontiguousarray(x[0, -4:], dtype=np.float32))
+
+
+def letterbox_sample(
+        image: ndarray,
+        x: ndarray,
+        hw_original: Tuple[int, int],
+        shape: int or Tuple[int, int],
+        scaleup: bool = False,
+) -> Tuple[ndarray, ndarray or list, tuple, list]:
+    """Letterboxes a resized image and converts its labels to pixel xyxy coordinates of the letterboxed image.
+
+    Args:
+        image (ndarray): BGR image resized by `resize_image`.
+        x (ndarray): Normalized labels of the image, shape (n, 11).
+        hw_original (Tuple[int, int]): Height and width before resizing.
+        shape (int or Tuple[int, int]): The letterboxed shape.
+        scaleup (bool, optional): Whether to allow scaling up. Defaults: ``False``.
+
+    Returns:
+        image (ndarray): Letterboxed BGR image.
+        labels (ndarray or list): Labels in pixel xyxy format, an empty list if the image has no labels.
+        shapes (tuple): Original hw, resize ratios and padding, for COCO mAP rescaling.
+        roi (Tensor): The ROI of the image, shape (4,).
+
+    """
+    (h0, w0), (h, w) = hw_original, image.shape[:2]
+    image, ratio, pad = letterbox(image, shape, auto=False, scaleup=scaleup)
+    shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
+
+    # Load labels
+    labels = []
+    if x.size > 0:
+        # Normalized xywh to pixel xyxy format
+        labels = x.copy()
+        labels[:, 1] = ratio[0] * w * (x[:, 1] - x[:, 3] / 2) + pad[0]  # pad width
+        labels[:, 2] = ratio[1] * h * (x[:, 2] - x[:, 4] / 2) + pad[1]  # pad height
+        labels[:, 3] = ratio[0] * w * (x[:, 1] + x[:, 3] / 2) + pad[0]
+        labels[:, 4] = ratio[1] * h * (x[:, 2] + x[:, 4] / 2) + pad[1]
+    roi = label_roi(x)  # ADAPTATION
+
+    return image, labels, shapes, roi
+
+
+def finish_sample(
+        image: ndarray,
+        labels: ndarray or list,
+        augment: bool = False,
+        affine: bool = True,
+        hyper_parameters_dict: Any = None,
+        gray: bool = False,
+) -> Tuple[Tensor, Tensor]:
+    """Augments a letterboxed (or mosaic) sample and converts it to tensors.
+
+    Args:
+        image (ndarray): BGR image.
+        labels (ndarray or list): Labels in pixel xyxy format.
+        augment (bool, optional): Whether to augment the sample. Defaults: ``False``.
+        affine (bool, optional): Whether to apply a random affine transform, mosaics are already transformed.
+            Defaults: ``True``.
+        hyper_parameters_dict (Any, optional): The augmentation hyper-parameters. Defaults: None.
+        gray (bool, optional): Whether to use grayscale. Defaults: ``False``.
+
+    Returns:
+        image (Tensor): RGB (or gray) CHW uint8 image.
+        labels_out (Tensor): Labels with shape (n, 12), column 0 is filled with the batch index by the collate_fn.
+
+    """
+    if augment:
+        # Augment imagespace
+        if affine:
+            image, labels = random_affine(image, labels,
+                                          degrees=hyper_parameters_dict["degrees"],
+                                          translate=hyper_parameters_dict["translate"],
+                                          scale=hyper_parameters_dict["scale"],
+                                          shear=hyper_parameters_dict["shear"])
+
+        # Augment colorspace
+        augment_hsv(image,
+                    hgain=hyper_parameters_dict["hsv_h"],
+                    sgain=hyper_parameters_dict["hsv_s"],
+                    vgain=hyper_parameters_dict["hsv_v"])
+
+    nL = len(labels)  # number of labels
+    if nL:
+        # convert xyxy to xywh
+        labels[:, 1:5] = xyxy2xywh(labels[:, 1:5])
+
+        # Normalize coordinates 0 - 1
+        labels[:, [2, 4]] /= image.shape[0]  # height
+        labels[:, [1, 3]] /= image.shape[1]  # width
+
+    if augment:
+        # random left-right flip
+        lr_flip = True
+        if lr_flip and random.random() < 0.5:
+            image = np.fliplr(image)
+            if nL:
+                labels[:, 1] = 1 - labels[:, 1]
+
+        # random up-down flip
+        ud_flip = False
+        if ud_flip and random.random() < 0.5:
+            image = np.flipud(image)
+            if nL:
+                labels[:, 2] = 1 - labels[:, 2]
+
+    # labels_out = torch.zeros((nL, 6))
+    labels_out = torch.zeros((nL, 12)) # ADAPTATION
+    if nL:
+        labels_out[:, 1:] = torch.from_numpy(labels)
+
+    # Convert
+    image = image[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
+    image = np.ascontiguousarray(image)
+
+    # RGB numpy convert RGB tensor
+    image = torch.from_numpy(image)
+
+    if gray:
+        # RGB tensor convert GRAY tensor
+        image = F_vision.rgb_to_grayscale(image)
+
+    return image, labels_out
+
+
 def kmean_anchors(
         path: str = "./data/VOC0712/train.txt",
         num_anchor: int = 9,
@@ -403,12 +851,12 @@ def kmean_anchors(
         return (max_iou * (max_iou > iou_threshold).float()).mean()  # product
 
     # Get label wh
-    wh = []
     dataset = LoadImagesAndLabels(path, augment=True, rect_label=True)
     nr = 1 if image_size[0] == image_size[1] else 10  # number augmentation repetitions
-    for s, l in zip(dataset.shapes, dataset.labels):
-        wh.append(l[:, 3:5] * (s / s.max()))  # image normalized to letterbox normalized wh
-    wh = np.concatenate(wh, 0).repeat(nr, axis=0)  # augment 10x
+    s = dataset.shapes / dataset.shapes.max(1, keepdims=True)
+    s = s.repeat(np.diff(dataset.label_offsets), axis=0)  # shape of the image of every label
+    wh = dataset.labels[:, 3:5] * s  # image normalized to letterbox normalized wh
+    wh = wh.repeat(nr, axis=0)  # augment 10x
     wh *= np.random.uniform(image_size[0], image_size[1], size=(wh.shape[0], 1))  # normalized to pixels (multi-scale)
     wh = wh[(wh > 2.0).all(1)]  # remove below threshold boxes (< 2 pixels wh)
 
@@ -473,11 +921,11 @@ def xywh2xyxy(x):
     return y
 
 
-def labels_to_class_weights(labels: Tensor, num_classes: int = 80) -> Tensor:
+def labels_to_class_weights(labels: ndarray or list, num_classes: int = 80) -> Tensor:
     """Compute the class weights for the dataset.
 
     Args:
-        labels (Tensor): A tensor of shape (N, ) where N is the number of labels.
+        labels (ndarray or list): Packed labels of shape (N, 11), or a list of per-image label arrays.
         num_classes (int, optional): The number of classes. Defaults to 80.
 
     Returns:
@@ -485,10 +933,11 @@ def labels_to_class_weights(labels: Tensor, num_classes: int = 80) -> Tensor:
 
     """
     # Get class weights (inverse frequency) from training labels
-    if labels[0] is None:  # no labels loaded
+    if labels is None or (isinstance(labels, list) and (not labels or labels[0] is None)):  # no labels loaded
         return torch.Tensor()
 
-    labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
+    if isinstance(labels, list):
+        labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
     classes = labels[:, 0].astype(np.int_)  # labels = [class xywh]
     weights = np.bincount(classes, minlength=num_classes)  # occurences per class
     weights[weights == 0] = 1  # replace empty bins with 1
@@ -765,6 +1214,186 @@ class LoadStreams:  # multiple IP or RTSP cameras
         return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
 
+class ImageArena(object):
+    def __init__(
+            self,
+            buffer: ndarray,
+            offsets: ndarray,
+            hw: ndarray,
+            hw0: ndarray,
+            path: str = None,
+            memory: shared_memory.SharedMemory = None,
+    ) -> None:
+        """Decoded and resized uint8 images packed into one flat buffer.
+
+        The buffer is either a named shared memory segment ("ram") or a memory-mapped file ("disk"). DataLoader
+        workers see the same physical pages: forked workers inherit the mapping, pickled arenas reattach to the
+        segment by name or to the file by path. A "disk" arena can be reopened by later runs.
+
+        Args:
+            buffer (ndarray): Flat uint8 buffer holding all images.
+            offsets (ndarray): Byte offset of every image in the buffer, shape (n + 1,).
+            hw (ndarray): Height and width of every cached (resized) image, shape (n, 2).
+            hw0 (ndarray): Original height and width of every image, shape (n, 2).
+            path (str, optional): The arena file for a "disk" arena, ``None`` for a "ram" arena. Defaults: ``None``.
+            memory (shared_memory.SharedMemory, optional): The segment of a "ram" arena. Defaults: ``None``.
+
+        """
+        self.buffer = buffer
+        self.offsets = offsets
+        self.hw = hw
+        self.hw0 = hw0
+        self.path = path
+        self.memory = memory
+
+    @classmethod
+    def build(
+            cls,
+            image_files: List[str],
+            shapes: ndarray,
+            image_size: int,
+            augment: bool = False,
+            path: str = None,
+            num_workers: int = 8,
+            processes: bool = False,
+    ) -> "ImageArena":
+        """Decodes and resizes all images in parallel into a new arena.
+
+        Args:
+            image_files (List[str]): The image paths.
+            shapes (ndarray): Width and height of every image, shape (n, 2).
+            image_size (int): The size of the longest image side after resizing.
+            augment (bool, optional): Whether the dataset augments images, selects the interpolation. Defaults: ``False``.
+            path (str, optional): Arena file to create, ``None`` keeps the arena in shared memory. Defaults: ``None``.
+            num_workers (int, optional): Number of decoding workers. Defaults: 8.
+            processes (bool, optional): Whether to decode with processes instead of threads. Defaults: ``False``.
+
+        Returns:
+            ImageArena: The filled arena.
+
+        """
+        # The resized size of every image is known from the shapes, so every image gets its final slot up front
+        hw0 = np.ascontiguousarray(shapes[:, ::-1]).astype(np.int64)
+        r = image_size / hw0.max(1)
+        hw = np.where((r != 1)[:, None], (hw0 * r[:, None]).astype(np.int64), hw0)
+        offsets = np.zeros(len(image_files) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(hw.prod(1) * 3)
+
+        if path is None:
+            memory = shared_memory.SharedMemory(create=True, size=max(int(offsets[-1]), 1))
+            buffer = np.frombuffer(memory.buf, dtype=np.uint8, count=max(int(offsets[-1]), 1))
+        else:
+            memory = None
+            buffer = np.memmap(path, dtype=np.uint8, mode="w+", shape=(max(int(offsets[-1]), 1),))
+
+        def _fill(index: int, image: np.ndarray) -> int:
+            assert image.shape[:2] == tuple(hw[index]), f"Image shape does not match its cached shape: {image_files[index]}"
+            buffer[offsets[index]:offsets[index + 1]] = image.reshape(-1)
+            return image.nbytes
+
+        if processes:
+            # Worker processes decode, the images are copied into the arena here
+            results = _imap(partial(_read_resized_image, image_size=image_size, augment=augment), image_files,
+                            num_workers, processes)
+            results = (_fill(i, x[0]) for i, x in enumerate(results))
+        else:
+            # Decoding threads release the GIL and write into the arena directly
+            results = _imap(lambda i: _fill(i, _read_resized_image(image_files[i], image_size, augment)[0]),
+                            range(len(image_files)), num_workers)
+
+        gb = 0  # Gigabytes of cached images
+        pbar = tqdm(results, total=len(image_files), desc="Caching images")
+        for nbytes in pbar:
+            gb += nbytes
+            pbar.desc = f"Caching images ({gb / 1e9:.1f}GB)"
+
+        arena = cls(buffer, offsets, hw, hw0, path, memory)
+        if memory is not None:
+            # The building process owns the segment, it is removed with its arena or at exit
+            weakref.finalize(arena, _release_shared_memory, memory, os.getpid())
+        if path is not None:
+            buffer.flush()
+            # The index is written last, an arena file without index is an interrupted build and is never opened
+            with open(path + ".npz.tmp", "wb") as f:
+                np.savez(f, version=np.array(image_arena_version), offsets=offsets, hw=hw, hw0=hw0)
+            os.replace(path + ".npz.tmp", path + ".npz")
+
+        return arena
+
+    @classmethod
+    def open(cls, path: str, num_images: int) -> "ImageArena" or None:
+        """Opens an arena file written by `build`.
+
+        Args:
+            path (str): The arena file.
+            num_images (int): The expected number of images.
+
+        Returns:
+            ImageArena: The arena, or ``None`` if the file is missing, incomplete or of another version.
+
+        """
+        try:
+            with np.load(path + ".npz", allow_pickle=False) as f:
+                version, offsets, hw, hw0 = int(f["version"]), f["offsets"], f["hw"], f["hw0"]
+            if version != image_arena_version or len(hw) != num_images or \
+                    os.path.getsize(path) != max(int(offsets[-1]), 1):
+                return None
+            buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        except:
+            return None
+
+        return cls(buffer, offsets, hw, hw0, path)
+
+    def __len__(self) -> int:
+        return len(self.hw)
+
+    def __getitem__(self, index: int) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int]]:
+        """Returns a read-only view of a cached image, the original hw and the resized hw."""
+        h, w = self.hw[index]
+        image = self.buffer[self.offsets[index]:self.offsets[index + 1]].reshape(h, w, 3)
+        image.flags.writeable = False  # shared by all workers
+
+        return image, tuple(self.hw0[index]), (h, w)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getstate__(self) -> dict:
+        # Reattach to the file or the shared memory segment instead of pickling their content
+        state = self.__dict__.copy()
+        state["buffer"] = None
+        state["memory"] = None if self.memory is None else self.memory.name
+
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if self.path is not None:
+            self.buffer = np.memmap(self.path, dtype=np.uint8, mode="r")
+        else:
+            # Workers share the resource tracker of the building process, which keeps the segment registered
+            self.memory = shared_memory.SharedMemory(self.memory)
+            self.buffer = np.frombuffer(self.memory.buf, dtype=np.uint8, count=max(int(self.offsets[-1]), 1))
+
+
+def _release_shared_memory(memory: shared_memory.SharedMemory, owner: int) -> None:
+    """Removes the shared memory segment of a "ram" arena, in the process that built it only.
+
+    Args:
+        memory (shared_memory.SharedMemory): The segment.
+        owner (int): The process id of the building process, forked workers inherit the finalizer.
+
+    """
+    if os.getpid() != owner:
+        return
+    memory.unlink()
+    try:
+        memory.close()
+    except BufferError:  # images of the arena are still referenced, the mapping goes with them
+        pass
+
+
 class LoadImagesAndLabels(Dataset):
     def __init__(
             self,
@@ -775,10 +1404,13 @@ class LoadImagesAndLabels(Dataset):
             hyper_parameters_dict: Any = None,
             rect_label: bool = False,
             image_weights: bool = False,
-            cache_images: bool = False,
+            cache_images: bool or str = False,
             single_classes: bool = False,
             pad: float = 0.0,
             gray: bool = False,
+            cache_dir: str = None,
+            num_io_workers: int = 8,
+            io_processes: bool = False,
     ) -> None:
         """Load images and labels.
 
@@ -790,10 +1422,16 @@ class LoadImagesAndLabels(Dataset):
             hyper_parameters_dict (Any, optional): The hyper-parameters. Defaults: None.
             rect_label (bool, optional): Whether to use rectangular trainning. Defaults: ``False``.
             image_weights (bool, optional): Whether to use image weights. Defaults: ``False``.
-            cache_images (bool, optional): Whether to cache the images. Defaults: ``False``.
+            cache_images (bool or str, optional): Whether to cache the decoded images, "ram" (or ``True``) keeps them in
+                shared memory, "disk" in a memory-mapped file that later runs reuse. Defaults: ``False``.
             single_classes (bool, optional): Whether to use single class. Defaults: ``False``.
             pad (float, optional): The padding. Defaults: 0.0.
             gray (bool, optional): Whether to use grayscale. Defaults: ``False``.
+            cache_dir (str, optional): Directory of "disk" image caches, next to the data list if ``None``.
+                Defaults: ``None``.
+            num_io_workers (int, optional): Number of workers reading shapes, labels and cached images, 1 reads
+                serially. Defaults: 8.
+            io_processes (bool, optional): Whether the workers are processes instead of threads. Defaults: ``False``.
 
         """
         try:
@@ -831,16 +1469,22 @@ class LoadImagesAndLabels(Dataset):
         self.label_files = [x.replace("images", "labels").replace(os.path.splitext(x)[-1], ".txt")
                             for x in self.image_files]
 
-        # Read image shapes (wh)
+        # Read image shapes (wh) and labels, only files changed since the last run are read again
         sp = path.replace(".txt", "") + ".shapes"  # shapefile path
-        try:
-            with open(sp, "r") as f:  # read existing shapefile
-                s = [x.split() for x in f.read().splitlines()]
-                assert len(s) == num_images, "Shapefile out of sync"
-        except:
-            s = [_exif_size(Image.open(f)) for f in tqdm(self.image_files, desc="Reading image shapes")]
-
-        self.shapes = np.asarray(s, dtype=np.float64)
+        cache = _cache_labels(self.image_files,
+                              self.label_files,
+                              path.replace(".txt", "") + ".cache",
+                              sp,
+                              num_io_workers,
+                              io_processes)
+        self.shapes = cache["shapes"]
+        label_status, label_duplicate = cache["status"], cache["duplicate"]
+
+        # All labels live in one contiguous (n, 11) array, the labels of image i are
+        # labels[label_offsets[i]:label_offsets[i + 1]]. Unlike a list of small arrays this is not copied page by page
+        # into every forked DataLoader worker by reference counting.
+        self.labels = cache["labels"]
+        self.label_offsets = cache["offsets"]
 
         # Rectangular Training  https://github.com/ultralytics/yolov3/issues/232
         if self.rect_label:
@@ -850,7 +1494,9 @@ class LoadImagesAndLabels(Dataset):
             index_rect = aspect_ratio.argsort()
             self.image_files = [self.image_files[i] for i in index_rect]
             self.label_files = [self.label_files[i] for i in index_rect]
+            self.labels, self.label_offsets = _gather_labels(self.labels, self.label_offsets, index_rect)
             self.shapes = s[index_rect]  # wh
+            label_status, label_duplicate = label_status[index_rect], label_duplicate[index_rect]
             aspect_ratio = aspect_ratio[index_rect]
 
             # Set training image shapes
@@ -866,36 +1512,21 @@ class LoadImagesAndLabels(Dataset):
             self.batch_shapes = np.ceil(np.array(shapes) * image_size / 32. + pad).astype(np.int_) * 32
 
         # Cache labels
-        self.images = [None] * num_images
-        self.labels = [np.zeros((0, 5), dtype=np.float32)] * num_images
-        create_data_subset, extract_bounding_boxes, labels_loaded = False, False, False
-        nm, nf, ne, ns, nd = 0, 0, 0, 0, 0  # number missing, found, empty, datasubset, duplicate
+        create_data_subset, extract_bounding_boxes = False, False
+        nm = int((label_status == 1).sum())  # number missing
+        nf = int((label_status == 0).sum())  # number found
+        ne = int((label_status == 2).sum())  # number empty
+        nd = int(label_duplicate.sum())  # number duplicate
+        ns = 0  # number datasubset
         s = path.replace("images", "labels")
+        print(f"Caching labels {s} ({nf} found, {nm} missing, {ne} empty, {nd} duplicate, for {num_images} images)")
+        if single_classes:
+            self.labels = self.labels.copy()
+            self.labels[:, 0] = 0  # force dataset into single-class mode
 
-        pbar = tqdm(self.label_files)
-        for i, file in enumerate(pbar):
-            if labels_loaded:
-                labels = self.labels[i]
-            else:
-                try:
-                    with open(file, "r") as f:
-                        labels = np.asarray([x.split() for x in f.read().splitlines()], dtype=np.float32)
-                except:
-                    nm += 1
-                    continue
-
+        for i in range(num_images if create_data_subset or extract_bounding_boxes else 0):
+            labels = self.image_labels(i)
             if labels.shape[0]:
-                # assert labels.shape[1] == 11, f"> 11 label columns: {file}"
-                assert labels.shape[1] == 11, f"> 11 label columns: {file}" # ADAPTATION
-                assert (labels >= 0).all(), f"negative labels: {file}"
-                assert (labels[:, 1:] <= 1).all(), f"non-normalized or out of bounds coordinate labels: {file}"
-                if np.unique(labels, axis=0).shape[0] < labels.shape[0]:  # duplicate rows
-                    nd += 1
-                if single_classes:
-                    labels[:, 0] = 0  # force dataset into single-class mode
-                self.labels[i] = labels
-                nf += 1  # file found
-
                 # Create sub dataset (a smaller dataset)
                 if create_data_subset and ns < 1E4:
                     if ns == 0:
@@ -924,21 +1555,32 @@ class LoadImagesAndLabels(Dataset):
                         b[[0, 2]] = np.clip(b[[0, 2]], 0, w)  # clip boxes outside of image
                         b[[1, 3]] = np.clip(b[[1, 3]], 0, h)
                         assert cv2.imwrite(f, image[b[1]:b[3], b[0]:b[2]]), "Failure extracting classifier boxes"
-            else:
-                ne += 1  # file empty
+        assert nf > 0 or num_images == 20288, f"No labels found in {os.path.dirname(self.label_files[-1]) + os.sep}."
 
-            pbar.desc = f"Caching labels {s} ({nf} found, {nm} missing, {ne} empty, {nd} duplicate, for {num_images} images)"
-        assert nf > 0 or num_images == 20288, f"No labels found in {os.path.dirname(file) + os.sep}."
-
-        # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
+        # Cache images for faster training, shared by all DataLoader workers
+        # (WARNING: "ram" caches of large datasets may exceed system RAM)
+        self.image_cache = None
         if cache_images:  # if training
-            gb = 0  # Gigabytes of cached images
-            pbar = tqdm(range(len(self.image_files)), desc="Caching images")
-            self.image_hw0, self.image_hw = [None] * num_images, [None] * num_images
-            for i in pbar:  # max 10k images
-                self.images[i], self.image_hw0[i], self.image_hw[i] = load_image(self, i)
-                gb += self.images[i].nbytes
-                pbar.desc = f"Caching images ({gb / 1e9:.1f}GB)"
+            cache_images = "ram" if cache_images is True else cache_images
+            assert cache_images in ("ram", "disk"), f"Unknown image cache mode {cache_images}"
+            arena_path = None
+            if cache_images == "disk":
+                arena_key = hashlib.md5(str(cache["hash"]).encode("utf-8"))
+                arena_key.update(f"{image_size} {self.augment} {self.rect_label}".encode("utf-8"))
+                arena_path = os.path.join(cache_dir, Path(path).stem) if cache_dir else path.replace(".txt", "")
+                arena_path = f"{arena_path}_{arena_key.hexdigest()[:12]}.arena"
+                if cache_dir:
+                    make_directory(cache_dir)
+                self.image_cache = ImageArena.open(arena_path, num_images)
+            if self.image_cache is None:
+                self.image_cache = ImageArena.build(self.image_files,
+                                                   self.shapes,
+                                                   image_size,
+                                                   self.augment,
+                                                   arena_path,
+                                                   num_io_workers,
+                                                   io_processes)
+            print(f"Cached images ({self.image_cache.nbytes / 1e9:.1f}GB, {cache_images})")
 
         detect_corrupted_images = False
         if detect_corrupted_images:
@@ -953,12 +1595,15 @@ class LoadImagesAndLabels(Dataset):
         """Number of images."""
         return len(self.image_files)
 
+    def image_labels(self, index: int) -> ndarray:
+        """Returns a view on the labels of the image at the specified index, shape (n, 11)."""
+        return self.labels[self.label_offsets[index]:self.label_offsets[index + 1]]
+
     def __getitem__(self, index: int):
         """Returns the image and label at the specified index."""
         if self.image_weights:
             index = self.indices[index]
 
-        hyper_parameters_dict = self.hyper_parameters_dict
         if self.mosaic:
             # Load mosaic
             # image, labels = load_mosaic(self, index)
@@ -967,80 +1612,19 @@ class LoadImagesAndLabels(Dataset):
 
         else:
             # Load image
-            image, (h0, w0), (h, w) = load_image(self, index)
+            image, hw0, _ = load_image(self, index)
 
             # Letterbox
             shape = self.batch_shapes[
                 self.batch_index[index]] if self.rect_label else self.image_size  # final letterboxed shape
-            image, ratio, pad = letterbox(image, shape, auto=False, scaleup=self.augment)
-            shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
-
-            # Load labels
-            labels = []
-            x = self.labels[index]
-            if x.size > 0:
-                # Normalized xywh to pixel xyxy format
-                labels = x.copy()
-                labels[:, 1] = ratio[0] * w * (x[:, 1] - x[:, 3] / 2) + pad[0]  # pad width
-                labels[:, 2] = ratio[1] * h * (x[:, 2] - x[:, 4] / 2) + pad[1]  # pad height
-                labels[:, 3] = ratio[0] * w * (x[:, 1] + x[:, 3] / 2) + pad[0]
-                labels[:, 4] = ratio[1] * h * (x[:, 2] + x[:, 4] / 2) + pad[1]
-            roi =  [x[:, -4], x[:, -3], x[:, -2], x[:, -1]] # ADAPTATION
-
-        if self.augment:
-            # Augment imagespace
-            if not self.mosaic:
-                image, labels = random_affine(image, labels,
-                                              degrees=hyper_parameters_dict["degrees"],
-                                              translate=hyper_parameters_dict["translate"],
-                                              scale=hyper_parameters_dict["scale"],
-                                              shear=hyper_parameters_dict["shear"])
-
-            # Augment colorspace
-            augment_hsv(image,
-                        hgain=hyper_parameters_dict["hsv_h"],
-                        sgain=hyper_parameters_dict["hsv_s"],
-                        vgain=hyper_parameters_dict["hsv_v"])
-
-        nL = len(labels)  # number of labels
-        if nL:
-            # convert xyxy to xywh
-            labels[:, 1:5] = xyxy2xywh(labels[:, 1:5])
-
-            # Normalize coordinates 0 - 1
-            labels[:, [2, 4]] /= image.shape[0]  # height
-            labels[:, [1, 3]] /= image.shape[1]  # width
-
-        if self.augment:
-            # random left-right flip
-            lr_flip = True
-            if lr_flip and random.random() < 0.5:
-                image = np.fliplr(image)
-                if nL:
-                    labels[:, 1] = 1 - labels[:, 1]
-
-            # random up-down flip
-            ud_flip = False
-            if ud_flip and random.random() < 0.5:
-                image = np.flipud(image)
-                if nL:
-                    labels[:, 2] = 1 - labels[:, 2]
-
-        # labels_out = torch.zeros((nL, 6))
-        labels_out = torch.zeros((nL, 12)) # ADAPTATION
-        if nL:
-            labels_out[:, 1:] = torch.from_numpy(labels)
-
-        # Convert
-        image = image[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-        image = np.ascontiguousarray(image)
+            image, labels, shapes, roi = letterbox_sample(image, self.image_labels(index), hw0, shape, self.augment)
 
-        # RGB numpy convert RGB tensor
-        image = torch.from_numpy(image)
-
-        if self.gray:
-            # RGB tensor convert GRAY tensor
-            image = F_vision.rgb_to_grayscale(image)
+        image, labels_out = finish_sample(image,
+                                          labels,
+                                          self.augment,
+                                          not self.mosaic,
+                                          self.hyper_parameters_dict,
+                                          self.gray)
 
         # return image, labels_out, self.image_files[index], shapes
         return image, labels_out, self.image_files[index], shapes, roi # ADAPTATION
@@ -1052,4 +1636,5 @@ class LoadImagesAndLabels(Dataset):
         for i, l in enumerate(label):
             l[:, 0] = i  # add target image index for build_targets()
         # return torch.stack(image, 0), torch.cat(label, 0), path, shapes
-        return torch.stack(image, 0), torch.cat(label, 0), path, shapes, roi # ADAPTATION
\ No newline at end of file
+        # roi (B, 4), pinned together with the images by DataLoader(pin_memory=True)
+        return torch.stack(image, 0), torch.cat(label, 0), path, shapes, torch.stack(roi, 0) # ADAPTATION
\ No newline at end of file
@@ -0,0 +1,196 @@
+# Copyright 2022 Lorna Authors. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""ONNX export of the ROI depth network.
+
+The exported graph has the inputs ``images`` (B, C, H, W) and ``roi`` (B, 4) and the outputs ``boxes`` (B, N, 4, xywh in
+pixels), ``scores`` (B, N, classes, objectness times class probability) and ``depth`` (B, 1), with a dynamic batch axis.
+It is traced from `DarknetInference`, so the ROI planes and the depth head are part of the graph.
+
+Usage:
+    python export.py --cfg ../cfg/roidepth_0_0_2.cfg --weights ../weights/best.pt --img-size 128 --fuse
+
+"""
+import argparse
+import inspect
+import os
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor, nn
+
+from model import Darknet, DarknetInference
+from utils import load_pretrained_torch_state_dict, load_pretrained_darknet_state_dict
+
+__all__ = [
+    "ExportHead", "export_onnx", "check_onnx"
+]
+
+
+class ExportHead(nn.Module):
+    def __init__(self, model: Darknet, image_size: tuple = (416, 416)) -> None:
+        """Splits the `DarknetInference` outputs into the boxes, scores and depth of the ONNX graph.
+
+        Args:
+            model (Darknet): The model, fuse it before wrapping it.
+            image_size (tuple, optional): Input height and width. Default: (416, 416).
+
+        """
+        super(ExportHead, self).__init__()
+        self.inference = DarknetInference(model, image_size)
+        self.single_classes = all(m.num_classes == 1 for m in model.module_list if m.__class__.__name__ == "_YOLOLayer")
+
+    def forward(self, images: Tensor, roi: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        Args:
+            images (Tensor): Normalized images with shape (B, C, H, W).
+            roi (Tensor): ROI info with shape (B, 4).
+
+        Returns:
+            boxes (Tensor): Boxes with shape (B, N, 4), xywh in pixels.
+            scores (Tensor): Scores with shape (B, N, classes).
+            depth (Tensor): Depth predictions with shape (B, 1).
+
+        """
+        detections, depth = self.inference(images, roi)
+        if self.single_classes:  # the objectness is the score
+            scores = detections[..., 4:5]
+        else:
+            scores = detections[..., 5:] * detections[..., 4:5]
+
+        return detections[..., :4], scores, depth
+
+
+def export_onnx(
+        model: Darknet,
+        path: str,
+        image_size: tuple = (416, 416),
+        opset: int = 13,
+) -> str:
+    """Exports the model to a single ONNX graph with a dynamic batch axis.
+
+    Args:
+        model (Darknet): The model, fuse it before exporting.
+        path (str): The ONNX file to write.
+        image_size (tuple, optional): Input height and width. Default: (416, 416).
+        opset (int, optional): The ONNX opset version. Default: 13.
+
+    Returns:
+        path (str): The ONNX file.
+
+    """
+    head = ExportHead(model.cpu(), image_size).eval()
+    channels = model.module_list[0][0].in_channels
+    images = torch.zeros(1, channels, *image_size)
+    roi = torch.zeros(1, 4)
+
+    # The graph is traced, the TorchScript exporter keeps the dynamic_axes contract on every torch version
+    kwargs = {"dynamo": False} if "dynamo" in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(head, (images, roi), path,
+                          input_names=["images", "roi"],
+                          output_names=["boxes", "scores", "depth"],
+                          dynamic_axes={name: {0: "batch"} for name in ("images", "roi", "boxes", "scores", "depth")},
+                          opset_version=opset,
+                          do_constant_folding=True,
+                          **kwargs)
+    print(f"Exported {os.path.getsize(path) / 1e6:.1f} MB ONNX graph to {path}")
+
+    return path
+
+
+def check_onnx(
+        model: Darknet,
+        path: str,
+        image_size: tuple = (416, 416),
+        batch_size: int = 4,
+        rtol: float = 1e-3,
+        atol: float = 1e-4,
+) -> Optional[bool]:
+    """Compares the ONNX graph run by onnxruntime with the PyTorch model on random inputs.
+
+    Args:
+        model (Darknet): The exported model.
+        path (str): The ONNX file.
+        image_size (tuple, optional): Input height and width. Default: (416, 416).
+        batch_size (int, optional): The batch size, differ from the export batch size to check the dynamic axis.
+            Default: 4.
+        rtol (float, optional): Relative tolerance. Default: 1e-3.
+        atol (float, optional): Absolute tolerance. Default: 1e-4.
+
+    Returns:
+        passed (bool, optional): Whether all outputs match, ``None`` if onnx or onnxruntime is not installed.
+
+    """
+    try:
+        import onnx
+        import onnxruntime
+    except ImportError as e:
+        print(f"{e.name} is not installed, parity check skipped")
+        return None
+
+    onnx.checker.check_model(onnx.load(path))
+
+    head = ExportHead(model.cpu(), image_size).eval()
+    channels = model.module_list[0][0].in_channels
+    images = torch.rand(batch_size, channels, *image_size)
+    roi = torch.rand(batch_size, 4)
+    with torch.no_grad():
+        expected = head(images, roi)
+
+    session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+    # Models without a filterappend layer do not use the roi, the exporter drops unused inputs
+    feed = {"images": images.numpy(), "roi": roi.numpy()}
+    outputs = session.run(None, {x.name: feed[x.name] for x in session.get_inputs()})
+
+    passed = True
+    for name, x, y in zip(("boxes", "scores", "depth"), expected, outputs):
+        x = x.numpy()
+        match = x.shape == y.shape and np.allclose(x, y, rtol=rtol, atol=atol)
+        error = np.abs(x - y).max() if x.shape == y.shape else float("inf")
+        print(f"{name:>8s}: {str(tuple(y.shape)):>16s} max abs error {error:.3g} {'ok' if match else 'MISMATCH'}")
+        passed &= match
+
+    return passed
+
+
+def main(args: argparse.Namespace) -> None:
+    image_size = (args.img_size, args.img_size)
+    model = Darknet(args.cfg, image_size=image_size, gray=args.gray)
+    if args.weights.endswith(".weights"):
+        load_pretrained_darknet_state_dict(model, args.weights)
+    elif args.weights:
+        model = load_pretrained_torch_state_dict(model, args.weights)
+    model.eval()
+    if args.fuse:
+        model.fuse()
+
+    output = args.output or f"{os.path.splitext(args.weights or args.cfg)[0]}.onnx"
+    export_onnx(model, output, image_size, args.opset)
+    if args.check_batch_size > 0:
+        passed = check_onnx(model, output, image_size, args.check_batch_size)
+        assert passed is not False, f"{output} does not match the model"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="export.py", description="Export the ROI depth network to ONNX.")
+    parser.add_argument("--cfg", type=str, default="../cfg/roidepth_0_0_2.cfg", help="model config")
+    parser.add_argument("--weights", type=str, default="", help="weights, random initialization if empty")
+    parser.add_argument("--img-size", type=int, default=128, help="input size")
+    parser.add_argument("--gray", action="store_true", help="grayscale input")
+    parser.add_argument("--fuse", action="store_true", help="fuse Conv2d + BatchNorm2d first")
+    parser.add_argument("--output", type=str, default="", help="ONNX file, <weights or cfg>.onnx if empty")
+    parser.add_argument("--opset", type=int, default=13, help="ONNX opset version")
+    parser.add_argument("--check-batch-size", type=int, default=4, help="parity check batch size, skipped if 0")
+    main(parser.parse_args())
@@ -3,25 +3,68 @@ import numpy as np
 import matplotlib.pyplot as plt
 from math import ceil
 
-def collect_depth(d_error, d_acc, tdepth, pdepth):
-    """TODO
+DEPTH_RANGE_BINS = tuple(range(0, 160, 10))  # meters, 10m ranges from 0 to 150m
 
-    Args:
-        TODO
 
-    Raises:
-        TODO
+def depth_range_metrics(tdepth, pdepth, bins=DEPTH_RANGE_BINS) -> dict:
+    """Depth error statistics per target depth range, (bins[i], bins[i+1]], depths outside all ranges are left out.
+
+    Args:
+        tdepth (ndarray): target depths
+        pdepth (ndarray): predicted depths, broadcast with tdepth
+        bins (sequence, optional): increasing range edges in the unit of the depths. Default: ``DEPTH_RANGE_BINS``
 
     Returns:
-        TODO
+        dict: ``bins`` and, one value per range, ``count``, mean absolute error ``mae``, relative accuracy
+            ``accuracy`` (mean of 1 - |error| / depth) and the fractions ``one_sigma`` and ``two_sigma`` of errors
+            within one and two standard deviations of the errors of the range, NaN for empty ranges
+
     """
-    de = tdepth-pdepth
-    for i in list(range(0, 15, 1)):
-        if i*10<tdepth<=(i+1)*10: # 0~10m
-            d_error.append(de)
-            d_acc[i].append(1-abs(de)/tdepth)
-            break
-    return 
+    tdepth, pdepth = np.broadcast_arrays(np.asarray(tdepth, dtype=np.float64), np.asarray(pdepth, dtype=np.float64))
+    tdepth, errors = tdepth.ravel(), (tdepth - pdepth).ravel()
+    bins = np.asarray(bins, dtype=np.float64)
+    n = bins.shape[0] - 1
+
+    index = np.digitize(tdepth, bins, right=True) - 1
+    inside = (index >= 0) & (index < n)
+    index, tdepth, errors = index[inside], tdepth[inside], errors[inside]
+    abs_errors = np.abs(errors)
+
+    count = np.bincount(index, minlength=n)
+    with np.errstate(divide="ignore", invalid="ignore"):  # empty ranges
+        mean = np.bincount(index, errors, n) / count
+        std = np.sqrt(np.bincount(index, (errors - mean[index]) ** 2, n) / count)
+        return {
+            "bins": bins,
+            "count": count,
+            "mae": np.bincount(index, abs_errors, n) / count,
+            "accuracy": np.bincount(index, 1 - abs_errors / tdepth, n) / count,
+            "one_sigma": np.bincount(index, abs_errors <= std[index], n) / count,
+            "two_sigma": np.bincount(index, abs_errors <= 2 * std[index], n) / count,
+        }
+
+
+def collect_depth(d_error, d_acc, tdepth, pdepth, bins=DEPTH_RANGE_BINS):
+    """Appends the depth errors and relative accuracies of the targets to the lists of their depth range.
+
+    Args:
+        d_error (list): depth errors of all ranges
+        d_acc (list): one list of relative accuracies per range
+        tdepth (ndarray): target depths
+        pdepth (ndarray): predicted depths, broadcast with tdepth
+        bins (sequence, optional): increasing range edges, (bins[i], bins[i+1]]. Default: ``DEPTH_RANGE_BINS``
+
+    """
+    tdepth, pdepth = np.broadcast_arrays(np.asarray(tdepth, dtype=np.float64), np.asarray(pdepth, dtype=np.float64))
+    tdepth, de = tdepth.ravel(), (tdepth - pdepth).ravel()
+    index = np.digitize(tdepth, bins, right=True) - 1
+    inside = (index >= 0) & (index < len(bins) - 1)
+    index, tdepth, de = index[inside], tdepth[inside], de[inside]
+    d_error.extend(de.tolist())
+    acc = 1 - np.abs(de) / tdepth
+    for i in np.unique(index):
+        d_acc[i].extend(acc[index == i].tolist())
+    return
 
 def norm_func(x, mu, sigma):
     """TODO
@@ -66,13 +109,9 @@ def plot_distribution(data:list, savePath:str):
     x = np.arange(-eage, eage, 0.1)
     y = norm_func(x, mean, std)
     plt.plot(x, y, '--', color='black')
-    one_sigma, two_sigma = 0, 0
-    for e in data:
-        if -std*2 <= e <= std*2:
-            two_sigma += 1
-            if -std <= e <= std:
-                one_sigma += 1
-    one_sigma, two_sigma = 100*one_sigma/len(data), 100*two_sigma/len(data)
+    abs_data = np.abs(np.asarray(data, dtype=np.float64))
+    one_sigma = 100*np.count_nonzero(abs_data <= std)/len(data)
+    two_sigma = 100*np.count_nonzero(abs_data <= std*2)/len(data)
     plt.text(
         -eage+1, 
         max(numb), 
@@ -0,0 +1,296 @@
+# Copyright 2022 Lorna Authors. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""ROI samples cropped on the fly from original KITTI frames.
+
+This replaces the offline ``crop`` subcommand of the Go tool (internal/cmd/main.go: runCrop), which writes one image and
+label per object plus 4 shifted copies. Frames are decoded once and kept in a small per-worker LRU cache, the ROI
+cropping and labels reproduce ``KITTI.MakeROI`` and ``normLabel`` (internal/src/tps/kitti.go).
+
+    root/
+        ├──images
+        |   └──*.png/jpg
+        └──labels
+            └──*.txt
+
+"""
+import glob
+import os
+import random
+from collections import OrderedDict
+from typing import Any, Iterator, List, Tuple
+
+import cv2
+import numpy as np
+from numpy import ndarray
+from torch import distributed
+from torch.utils.data import Dataset, Sampler
+
+from dataset import LoadImagesAndLabels, support_image_formats, resize_image, letterbox_sample, finish_sample
+from utils import load_classes
+
+__all__ = [
+    "make_roi", "roi_label", "KittiROIDataset", "FrameGroupedSampler"
+]
+
+# Location ranges of the depth and x-location labels, same as the Go tool
+XRANGE = 8.0
+YRANGE = 80.0
+
+# Shifts of the ROI copies: up, down, left, right
+roi_shift_steps = np.array([[0, 1, 0, 1], [0, -1, 0, -1], [-1, 0, -1, 0], [1, 0, 1, 0]], dtype=np.float64)
+
+
+def _trim_scale(rect: List[int], image_wh: Tuple[int, int]) -> Tuple[List[int], List[float]]:
+    """Clips a rectangle to an image and computes its normalized xywh, same as ``Box.Trim().Scale()``."""
+    w, h = image_wh
+    xtl, ytl, xbr, ybr = max(rect[0], 0), max(rect[1], 0), min(rect[2], w - 1), min(rect[3], h - 1)
+    xywh = [(xtl + xbr) / 2 / w, (ytl + ybr) / 2 / h, (xbr - xtl + 1) / w, (ybr - ytl + 1) / h]
+
+    return [xtl, ytl, xbr, ybr], xywh
+
+
+def make_roi(
+        image_wh: Tuple[int, int],
+        rect: List[int],
+        translation: ndarray = (0, 0, 0, 0),
+        scale: float = 0.25,
+) -> Tuple[List[int], List[float], List[float], Tuple[int, int]]:
+    """Makes the ROI of an object, same as ``KITTI.MakeROI`` of the Go tool.
+
+    Args:
+        image_wh (Tuple[int, int]): Width and height of the frame.
+        rect (List[int]): The object rectangle xtl, ytl, xbr, ybr (inclusive) in the frame.
+        translation (ndarray, optional): Translation of the ROI center box xtl, ytl, xbr, ybr. Defaults: no translation.
+        scale (float, optional): The margin around the translated box, relative to its size. Defaults: 0.25.
+
+    Returns:
+        roi_rect (List[int]): The ROI rectangle in the frame.
+        roi_xywh (List[float]): The ROI box normalized to the frame.
+        box_xywh (List[float]): The object box normalized to the ROI.
+        offset (Tuple[int, int]): The ROI margin in x and y.
+
+    """
+    t_rect = [int(rect[i] + translation[i]) for i in range(4)]
+    offset = int((t_rect[2] - t_rect[0] + 1) * scale), int((t_rect[3] - t_rect[1] + 1) * scale)
+    roi_rect, roi_xywh = _trim_scale([t_rect[0] - offset[0], t_rect[1] - offset[1],
+                                      t_rect[2] + offset[0], t_rect[3] + offset[1]], image_wh)
+    roi_wh = roi_rect[2] - roi_rect[0] + 1, roi_rect[3] - roi_rect[1] + 1
+    _, box_xywh = _trim_scale([rect[0] - roi_rect[0], rect[1] - roi_rect[1],
+                               rect[2] - roi_rect[0], rect[3] - roi_rect[1]], roi_wh)
+
+    return roi_rect, roi_xywh, box_xywh, offset
+
+
+def roi_label(class_id: int, box_xywh: List[float], location: Tuple[float, float], roi_xywh: List[float]) -> ndarray:
+    """Makes the 11 column label of a ROI sample, same as ``normLabel`` of the Go tool.
+
+    Args:
+        class_id (int): The class index.
+        box_xywh (List[float]): The object box normalized to the ROI.
+        location (Tuple[float, float]): The x and y (depth) location of the object in meters.
+        roi_xywh (List[float]): The ROI box normalized to the frame.
+
+    Returns:
+        label (ndarray): The label, shape (1, 11).
+
+    """
+    x, y = location
+    label = [class_id] + box_xywh + [y / YRANGE, (x + XRANGE) / (2 * XRANGE)] + roi_xywh
+
+    return np.asarray([label], dtype=np.float32)
+
+
+class KittiROIDataset(Dataset):
+    def __init__(
+            self,
+            path: str,
+            classes: str or List[str],
+            image_size: int = 128,
+            augment: bool = False,
+            hyper_parameters_dict: Any = None,
+            single_classes: bool = False,
+            gray: bool = False,
+            shifts: bool = True,
+            frame_step: int = 1,
+            frame_cache_size: int = 32,
+    ) -> None:
+        """Crop ROI samples from KITTI frames on the fly.
+
+        Objects are selected like ``KITTI.FilterOut``: known class, not truncated, not occluded and inside the location
+        range. Like the Go ``crop`` subcommand every object yields one centered ROI and, with shifts, 4 ROIs shifted
+        up, down, left and right by a random 0.4~0.9 of the margin, drawn again on every access. Samples are prepared
+        like non-rectangular, non-mosaic `LoadImagesAndLabels` samples.
+
+        Args:
+            path (str): The KITTI root with images/ and labels/ folders.
+            classes (str or List[str]): The selected KITTI class names, or the path of a file with one name per line.
+            image_size (int, optional): The size of the ROI images. Defaults: 128.
+            augment (bool, optional): Whether to augment the images. Defaults: ``False``.
+            hyper_parameters_dict (Any, optional): The hyper-parameters. Defaults: None.
+            single_classes (bool, optional): Whether to use single class. Defaults: ``False``.
+            gray (bool, optional): Whether to use grayscale. Defaults: ``False``.
+            shifts (bool, optional): Whether to add the 4 shifted ROIs of every object. Defaults: ``True``.
+            frame_step (int, optional): Use every n-th frame, same as the ``freq`` flag of the Go tool. Defaults: 1.
+            frame_cache_size (int, optional): Number of decoded frames kept per worker. Defaults: 32.
+
+        """
+        classes = load_classes(classes) if isinstance(classes, str) else list(classes)
+        image_files = sorted(x for x in glob.glob(os.path.join(path, "images", "*.*"))
+                             if os.path.splitext(x)[-1].lower() in support_image_formats)[::frame_step]
+        assert len(image_files) > 0, f"No images found in {os.path.join(path, 'images')}"
+
+        frames, class_ids, rects, locations, object_ids = [], [], [], [], []
+        for i, image_file in enumerate(image_files):
+            stem = os.path.splitext(os.path.basename(image_file))[0]
+            try:
+                with open(os.path.join(path, "labels", stem + ".txt"), "r") as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                continue
+            for j, line in enumerate(lines):
+                info = line.split(" ")
+                name, truncated, occluded = info[0], float(info[1]), int(info[2])
+                x, y = float(info[11]), float(info[13])
+                if name not in classes or truncated != 0 or occluded != 0 or abs(x) > XRANGE or y < 0 or y > YRANGE:
+                    continue
+                frames.append(i)
+                class_ids.append(classes.index(name))
+                rects.append([int(float(v)) for v in info[4:8]])
+                locations.append([x, y])
+                object_ids.append(j)
+
+        self.image_files = image_files
+        self.frames = np.asarray(frames, dtype=np.int64)
+        self.class_ids = np.zeros(len(frames), dtype=np.int64) if single_classes else \
+            np.asarray(class_ids, dtype=np.int64)
+        self.rects = np.asarray(rects, dtype=np.int64).reshape(-1, 4)
+        self.locations = np.asarray(locations, dtype=np.float64).reshape(-1, 2)
+        self.object_ids = np.asarray(object_ids, dtype=np.int64)
+        self.num_shifts = 1 + len(roi_shift_steps) if shifts else 1
+        print(f"Found {len(frames)} objects in {len(image_files)} frames of {path}")
+
+        # Only the class column is indexed, enough for the class weights
+        self.labels = np.repeat(self.class_ids, self.num_shifts)[:, None].astype(np.float32)
+        self.image_size = image_size
+        self.augment = augment
+        self.hyper_parameters_dict = hyper_parameters_dict
+        self.gray = gray
+        self.frame_cache_size = frame_cache_size
+        self.frame_cache = OrderedDict()
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["frame_cache"] = OrderedDict()  # every worker caches its own frames
+
+        return state
+
+    def __len__(self) -> int:
+        """Number of ROI samples."""
+        return len(self.frames) * self.num_shifts
+
+    def load_frame(self, frame: int) -> ndarray:
+        """Returns the decoded BGR frame, from the LRU cache if possible."""
+        image = self.frame_cache.get(frame)
+        if image is not None:
+            self.frame_cache.move_to_end(frame)
+            return image
+
+        image = cv2.imread(self.image_files[frame])  # BGR
+        assert image is not None, "Image Not Found " + self.image_files[frame]
+        self.frame_cache[frame] = image
+        if len(self.frame_cache) > self.frame_cache_size:
+            self.frame_cache.popitem(last=False)
+
+        return image
+
+    def __getitem__(self, index: int):
+        """Returns the ROI image and label at the specified index."""
+        obj, shift = divmod(index, self.num_shifts)
+        frame = self.load_frame(int(self.frames[obj]))
+        image_wh = frame.shape[1], frame.shape[0]
+        rect = self.rects[obj].tolist()
+
+        roi_rect, roi_xywh, box_xywh, offset = make_roi(image_wh, rect)
+        if shift > 0:
+            rd = (400 + random.randrange(500)) / 1000  # random number in 0.4~0.9
+            translation = roi_shift_steps[shift - 1] * np.array(offset * 2, dtype=np.float64) * rd
+            roi_rect, roi_xywh, box_xywh, _ = make_roi(image_wh, rect, translation)
+
+        # Same pixels as the Go image.Rect crop, which excludes the bottom-right edge
+        image = frame[roi_rect[1]:roi_rect[3], roi_rect[0]:roi_rect[2]]
+        x = roi_label(int(self.class_ids[obj]), box_xywh, tuple(self.locations[obj]), roi_xywh)
+
+        image, hw0, _ = resize_image(image, self.image_size, self.augment)
+        image, labels, shapes, roi = letterbox_sample(image, x, hw0, self.image_size, self.augment)
+        image, labels_out = finish_sample(image, labels, self.augment, True, self.hyper_parameters_dict, self.gray)
+
+        stem, suffix = os.path.splitext(self.image_files[self.frames[obj]])
+        path = f"{stem}_{self.object_ids[obj]}" + (f"_{shift - 1}" if shift > 0 else "") + suffix
+
+        return image, labels_out, path, shapes, roi
+
+    collate_fn = staticmethod(LoadImagesAndLabels.collate_fn)
+
+
+class FrameGroupedSampler(Sampler):
+    def __init__(
+            self,
+            dataset: KittiROIDataset,
+            shuffle: bool = True,
+            seed: int = 0,
+            rank: int = None,
+            world_size: int = None,
+    ) -> None:
+        """Sample the ROIs of one frame consecutively, so that they share one decode in the frame cache.
+
+        The order of the frames and of the ROIs within a frame is shuffled with ``seed + epoch``. With several ranks
+        every rank takes one contiguous and equally long slice of that order, the tail that does not divide is dropped.
+
+        Args:
+            dataset (KittiROIDataset): The dataset.
+            shuffle (bool, optional): Whether to shuffle. Defaults: ``True``.
+            seed (int, optional): The shuffle seed, shared by all ranks. Defaults: 0.
+            rank (int, optional): The rank of this process, from torch.distributed if ``None``. Defaults: ``None``.
+            world_size (int, optional): The number of ranks, from torch.distributed if ``None``. Defaults: ``None``.
+
+        """
+        super(FrameGroupedSampler, self).__init__()
+        self.frames = np.repeat(dataset.frames, dataset.num_shifts)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        distributed_ready = distributed.is_available() and distributed.is_initialized()
+        self.rank = rank if rank is not None else (distributed.get_rank() if distributed_ready else 0)
+        self.world_size = world_size if world_size is not None else \
+            (distributed.get_world_size() if distributed_ready else 1)
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch of the shuffling, call it before every epoch."""
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        return len(self.frames) // self.world_size
+
+    def __iter__(self) -> Iterator[int]:
+        if not self.shuffle:
+            index = np.argsort(self.frames, kind="stable")
+        else:
+            rng = np.random.default_rng(self.seed + self.epoch)
+            frame_order = rng.permutation(self.frames.max() + 1 if len(self.frames) else 0)
+            # Sort by the shuffled rank of the frame, ties broken by a random key
+            index = np.lexsort((rng.random(len(self.frames)), frame_order[self.frames]))
+
+        # Contiguous slices keep the ROIs of a frame on one rank, except at the slice borders
+        num_samples = len(self)
+        return iter(index[self.rank * num_samples:(self.rank + 1) * num_samples].tolist())
@@ -11,9 +11,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import hashlib
 import math
 import os
-from typing import Any, List, Dict
+from collections import OrderedDict
+from typing import Any, List, Dict, Tuple
 
 import numpy as np
 import torch
@@ -21,10 +23,12 @@ from torch import nn, Tensor
 from torch.nn import functional as F_torch
 from torchvision.ops.misc import SqueezeExcitation
 
-from utils import save_darknet_state_dict, load_pretrained_darknet_state_dict, make_divisible
+from utils import save_darknet_state_dict, load_pretrained_darknet_state_dict, load_pretrained_torch_state_dict, \
+    make_divisible
 
 __all__ = [
-    "Darknet",
+    "Darknet", "DarknetInference", "roi_to_tensor", "load_fused_darknet", "supported_image_sizes", "ROIDepthLoss",
+    "compute_loss",
     "yolov3_tiny_prn_voc", "yolov3_tiny_prn_coco",
     "yolov3_tiny_voc", "yolov3_tiny_coco",
     "mobilenetv1_voc", "mobilenetv1_coco",
@@ -55,15 +59,18 @@ class Darknet(nn.Module):
         self.module_define = _parse_model_config(model_config)
         self.module_list, self.routs = _create_modules(self.module_define, image_size, model_config, gray, onnx_export)
         self.yolo_layers = _get_yolo_layers(self)
+        self._plan = None  # execution plan, built on the first forward and after fuse
+        self._target_constants = {}  # (grid sizes, device) -> (gains, anchors) of _build_targets
         self.version = np.array([0, 2, 5], dtype=np.int32)  # (int32) version info: major, minor, revision
         self.seen = np.array([0], dtype=np.int64)  # (int64) number of images seen during training
         self.onnx_export = onnx_export
 
     def forward(
             self, x: Tensor,
-            roi_info: list = None, # ADAPTATION
+            roi_info: Tensor or list = None, # ADAPTATION
             augment: bool = False
     ) -> list[Any] | tuple[Tensor, Tensor] | tuple[Tensor, Any] | tuple[Tensor, None]:
+        roi_info = roi_to_tensor(roi_info, x.device)
         if not augment:
             # return self.forward_once(x)
             return self.forward_once(x, roi_info) # ADAPTATION
@@ -85,7 +92,7 @@ class Darknet(nn.Module):
     def forward_once(
             self,
             x: Tensor,
-            roi_info: list, # ADAPTATION
+            roi_info: Tensor, # ADAPTATION
             augment: bool = False) -> list[Any] | tuple[Tensor, Tensor] | tuple[Tensor, Any]:
         image_size = x.shape[-2:]  # height, width
         yolo_out, out = [], []
@@ -98,22 +105,28 @@ class Darknet(nn.Module):
         if augment:
             x = torch.cat((x, _scale_image(x.flip(3), scale_factor[0]), _scale_image(x, scale_factor[1])), 0)
 
-        for i, module in enumerate(self.module_list):
-            name = module.__class__.__name__
-            if name == "_WeightedFeatureFusion":
+        if self._plan is None:
+            self._plan = self._build_plan()
+
+        roi_depth_logits = None
+        for module, (kind, keep, free) in zip(self.module_list, self._plan):
+            if kind == _LAYER_FUSION:
                 x = module(x, out)
-            elif name == "_FeatureConcat":
+            elif kind == _LAYER_CONCAT:
                 x = module(out)
-            elif name == "_YOLOLayer":
+            elif kind == _LAYER_YOLO:
                 yolo_out.append(module(x))
-            elif name == '_FilterAppend': # ADAPTATION
+            elif kind == _LAYER_FILTER_APPEND: # ADAPTATION
                 x = module(x, roi_info)
-            elif name == '_ROIDepth': # ADAPTATION
+            elif kind == _LAYER_ROI_DEPTH: # ADAPTATION
                 roi_depth_logits = module(x)
             else:
                 x = module(x)
 
-            out.append(x if self.routs[i] else [])
+            # Outputs are kept only until their last route/shortcut consumer
+            out.append(x if keep else None)
+            for j in free:
+                out[j] = None
 
         if self.training:  # train
             # return yolo_out
@@ -133,21 +146,283 @@ class Darknet(nn.Module):
             # return x, p
             return x, p, roi_depth_logits # ADAPTATION
 
-    def fuse(self):
-        # Fuse Conv2d + BatchNorm2d layers throughout model
-        print("Fusing layers...")
-        fused_list = nn.ModuleList()
-        for a in list(self.children())[0]:
-            if isinstance(a, nn.Sequential):
-                for i, b in enumerate(a):
-                    if isinstance(b, nn.modules.batchnorm.BatchNorm2d):
-                        # fuse this bn layer with the previous conv2d layer
-                        conv = a[i - 1]
-                        fused = _fuse_conv_and_bn(conv, b)
-                        a = nn.Sequential(fused, *list(a.children())[i + 1:])
-                        break
-            fused_list.append(a)
-        self.module_list = fused_list
+    def _build_plan(self) -> List[tuple]:
+        """Resolves the kind of every layer once and computes when routed outputs can be released.
+
+        Returns:
+            plan (List[tuple]): (kind, keep output, indices of outputs to release after the layer) per layer.
+
+        """
+        kinds = [_layer_kinds.get(module.__class__.__name__, _LAYER_PLAIN) for module in self.module_list]
+
+        # Last consumer of every routed output
+        last_use = {}
+        for i, (module, kind) in enumerate(zip(self.module_list, kinds)):
+            if kind in (_LAYER_FUSION, _LAYER_CONCAT):
+                for layer in module.layers:
+                    last_use[i + layer if layer < 0 else layer] = i
+
+        free = [[] for _ in kinds]
+        for j, i in last_use.items():
+            free[i].append(j)
+
+        return [(kind, i in last_use, free[i]) for i, kind in enumerate(kinds)]
+
+    def fuse(self, fold: bool = True) -> None:
+        """Folds every BatchNorm into the preceding convolution or linear layer, in place.
+
+        Layers are replaced inside their containers and module_list keeps its length, so routs and the route and
+        shortcut layer indices stay valid. Call it on an eval model only, the fused model cannot be trained.
+
+        Args:
+            fold (bool, optional): Whether to fold the BatchNorm values into the weights, ``False`` only builds the
+                fused layers to load a fused state_dict into. Default: ``True``.
+
+        """
+        print("Fusing layers..." if fold else "Building fused layers...")
+        for module in self.module_list:
+            _fuse_module(module, fold)
+        self._plan = None
+
+# Grids kept per YOLO layer, enough for multi-scale training and mixed stream shapes
+grid_cache_size = 16
+
+# Layer kinds of the Darknet execution plan
+_LAYER_PLAIN, _LAYER_FUSION, _LAYER_CONCAT, _LAYER_YOLO, _LAYER_FILTER_APPEND, _LAYER_ROI_DEPTH = range(6)
+_layer_kinds = {
+    "_WeightedFeatureFusion": _LAYER_FUSION,
+    "_FeatureConcat": _LAYER_CONCAT,
+    "_YOLOLayer": _LAYER_YOLO,
+    "_FilterAppend": _LAYER_FILTER_APPEND,
+    "_ROIDepth": _LAYER_ROI_DEPTH,
+}
+
+
+class DarknetInference(nn.Module):
+    def __init__(self, model: Darknet, image_size: tuple = (416, 416)) -> None:
+        """Inference-only view of a Darknet with a fixed ``(images, roi) -> (detections, depth)`` signature.
+
+        Every layer is wrapped in an adapter with the same forward signature, the YOLO grids and anchors are computed
+        once for image_size and nothing is mutated in forward, so the wrapper can be compiled with `torch.jit.script`
+        and `torch.compile`. The wrapper shares its parameters with the model, fuse the model before wrapping it.
+
+        Args:
+            model (Darknet): The model.
+            image_size (tuple, optional): Input height and width, only used to size the YOLO grids. Default: (416, 416).
+
+        """
+        super(DarknetInference, self).__init__()
+        model.eval()
+        was_exporting, model.onnx_export = model.onnx_export, False
+        # One dry run sizes the grids of every YOLO layer and records the channels of every shortcut input
+        fusion_channels = {}
+
+        def record_channels(module: nn.Module, inputs: tuple) -> None:
+            x, outputs = inputs
+            fusion_channels[module] = [x.shape[1]] + [outputs[j].shape[1] for j in module.layers]
+
+        hooks = [module.register_forward_pre_hook(record_channels) for module in model.module_list
+                 if _layer_kinds.get(module.__class__.__name__) == _LAYER_FUSION]
+        with torch.no_grad():
+            parameter = next(model.parameters())
+            channels = model.module_list[0][0].in_channels if isinstance(model.module_list[0], nn.Sequential) else 3
+            model(torch.zeros(1, channels, *image_size, device=parameter.device),
+                  torch.zeros(1, 4, device=parameter.device))
+        for hook in hooks:
+            hook.remove()
+        model.onnx_export = was_exporting
+
+        plan = model._build_plan()
+        layers = []
+        for i, (module, (kind, keep, free)) in enumerate(zip(model.module_list, plan)):
+            if kind == _LAYER_FUSION:
+                layer = _FusionLayer(module, [i + j if j < 0 else j for j in module.layers], fusion_channels[module])
+            elif kind == _LAYER_CONCAT:
+                layer = _ConcatLayer([i + j if j < 0 else j for j in module.layers])
+            elif kind == _LAYER_YOLO:
+                layer = _YOLODecodeLayer(module)
+            elif kind == _LAYER_FILTER_APPEND:
+                layer = _ROIAppendLayer()
+            elif kind == _LAYER_ROI_DEPTH:
+                layer = _DepthLayer(module)
+            else:
+                layer = _PlainLayer(module)
+            layer.keep = keep
+            layer.free = free
+            layers.append(layer)
+        self.layers = nn.ModuleList(layers)
+
+    def forward(self, images: Tensor, roi: Tensor) -> Tuple[Tensor, Tensor]:
+        """
+        Args:
+            images (Tensor): Normalized images with shape (B, C, H, W).
+            roi (Tensor): ROI info with shape (B, 4).
+
+        Returns:
+            detections (Tensor): Decoded predictions with shape (B, N, 5 + classes), xywh in pixels.
+            depth (Tensor): Depth predictions with shape (B, 1), zeros if the model has no roidepth layer.
+
+        """
+        out: List[Tensor] = []
+        detections: List[Tensor] = []
+        depths: List[Tensor] = []
+        released = images.new_empty(0)
+        x = images
+        for layer in self.layers:
+            x = layer(x, out, roi, detections, depths)
+            # Outputs are kept only until their last route/shortcut consumer
+            out.append(x if layer.keep else released)
+            for j in layer.free:
+                out[j] = released
+
+        depth = depths[0] if len(depths) > 0 else images.new_zeros(images.shape[0], 1)
+        return torch.cat(detections, 1), depth
+
+
+class _InferenceLayer(nn.Module):
+    """Base of the DarknetInference layer adapters, which share one forward signature."""
+    keep: bool
+    free: List[int]
+
+    def __init__(self) -> None:
+        super(_InferenceLayer, self).__init__()
+        self.keep = False
+        self.free = []
+
+
+class _PlainLayer(_InferenceLayer):
+    def __init__(self, module: nn.Module) -> None:
+        super(_PlainLayer, self).__init__()
+        self.module = module
+
+    def forward(
+            self,
+            x: Tensor,
+            out: List[Tensor],
+            roi: Tensor,
+            detections: List[Tensor],
+            depths: List[Tensor],
+    ) -> Tensor:
+        return self.module(x)
+
+
+class _ConcatLayer(_InferenceLayer):
+    layers: List[int]
+
+    def __init__(self, layers: List[int]) -> None:
+        super(_ConcatLayer, self).__init__()
+        self.layers = layers
+
+    def forward(
+            self,
+            x: Tensor,
+            out: List[Tensor],
+            roi: Tensor,
+            detections: List[Tensor],
+            depths: List[Tensor],
+    ) -> Tensor:
+        if len(self.layers) == 1:
+            return out[self.layers[0]]
+        return torch.cat([out[i] for i in self.layers], 1)
+
+
+class _FusionLayer(_InferenceLayer):
+    __constants__ = ["weight"]
+    layers: List[int]
+    channels: List[int]
+
+    def __init__(self, module: nn.Module, layers: List[int], channels: List[int]) -> None:
+        super(_FusionLayer, self).__init__()
+        self.layers = layers
+        self.channels = channels  # input channels, then the channels of every routed output
+        self.weight = module.weight
+        self.n = module.n
+        self.w = module.w if module.weight else None
+
+    def forward(
+            self,
+            x: Tensor,
+            out: List[Tensor],
+            roi: Tensor,
+            detections: List[Tensor],
+            depths: List[Tensor],
+    ) -> Tensor:
+        # Same as _WeightedFeatureFusion.forward, the channels are resolved once so the graph can be traced
+        w = x.new_ones(self.n)
+        if self.weight:
+            w = torch.sigmoid(self.w) * (2 / self.n)  # sigmoid weights (0-1)
+            x = x * w[0]
+
+        nx = self.channels[0]  # input channels
+        for i in range(self.n - 1):
+            a = out[self.layers[i]] * w[i + 1] if self.weight else out[self.layers[i]]  # feature to add
+            na = self.channels[i + 1]  # feature channels
+            if nx == na:  # same shape
+                x = x + a
+            elif nx > na:  # slice input
+                x[:, :na] = x[:, :na] + a
+            else:  # slice feature
+                x = x + a[:, :nx]
+
+        return x
+
+
+class _YOLODecodeLayer(_InferenceLayer):
+    def __init__(self, module: nn.Module) -> None:
+        super(_YOLODecodeLayer, self).__init__()
+        self.na, self.nx, self.ny = module.na, module.nx, module.ny
+        self.num_classes_output = module.num_classes_output
+        self.stride = float(module.stride)
+        self.register_buffer("grid", module.grid.clone(), persistent=False)
+        self.register_buffer("anchor_wh", module.anchor_wh.clone(), persistent=False)
+
+    def forward(
+            self,
+            x: Tensor,
+            out: List[Tensor],
+            roi: Tensor,
+            detections: List[Tensor],
+            depths: List[Tensor],
+    ) -> Tensor:
+        # Same decoding as _YOLOLayer in inference mode, without in-place updates
+        p = x.view(x.shape[0], self.na, self.num_classes_output, self.ny, self.nx).permute(0, 1, 3, 4, 2)
+        xy = (torch.sigmoid(p[..., :2]) + self.grid) * self.stride
+        wh = torch.exp(p[..., 2:4]) * self.anchor_wh * self.stride
+        detections.append(torch.cat([xy, wh, torch.sigmoid(p[..., 4:])], -1).view(x.shape[0], -1,
+                                                                                 self.num_classes_output))
+        return x
+
+
+class _ROIAppendLayer(_InferenceLayer):
+    def forward(
+            self,
+            x: Tensor,
+            out: List[Tensor],
+            roi: Tensor,
+            detections: List[Tensor],
+            depths: List[Tensor],
+    ) -> Tensor:
+        # Same as _FilterAppend.forward
+        planes = roi.to(x.dtype)[:, :, None, None].expand(-1, -1, x.shape[-2], x.shape[-1])
+        return torch.cat([x, planes], 1)
+
+
+class _DepthLayer(_InferenceLayer):
+    def __init__(self, module: nn.Module) -> None:
+        super(_DepthLayer, self).__init__()
+        self.module = module
+
+    def forward(
+            self,
+            x: Tensor,
+            out: List[Tensor],
+            roi: Tensor,
+            detections: List[Tensor],
+            depths: List[Tensor],
+    ) -> Tensor:
+        depths.append(self.module(x))
+        return x
+
 
 class _YOLOLayer(nn.Module):
     def __init__(
@@ -182,37 +457,59 @@ class _YOLOLayer(nn.Module):
         self.num_classes = num_classes  # number of classes (80)
         self.num_classes_output = num_classes + 5  # number of outputs (85)
         self.nx, self.ny, self.ng = 0, 0, 0  # initialize number of x, y grid points
-        self.anchor_vec = self.anchors / self.stride
-        self.anchor_wh = self.anchor_vec.view(1, self.na, 1, 1, 2)
+        # Buffers follow the model across devices, they are derived from the cfg and not saved
+        self.register_buffer("anchor_vec", self.anchors / self.stride, persistent=False)
+        self.register_buffer("anchor_wh", self.anchor_vec.clone().view(1, self.na, 1, 1, 2), persistent=False)
         self.onnx_export = onnx_export
-        self.grid = None
+        self.grid = None  # grid of the last inference size
+        self._grids = OrderedDict()  # (nx, ny, device, dtype) -> (grid, anchor_wh), least recently used first
 
         if onnx_export:
             self.training = False
             self.create_grids((image_size[1] // stride, image_size[0] // stride))  # number x, y grid points
 
-    def create_grids(self, ng=(13, 13), device="cpu"):
+    def _cached_grid(self, nx: int, ny: int, device: torch.device, dtype: torch.dtype) -> Tuple[Tensor, Tensor]:
+        """Returns the xy offsets (1, 1, ny, nx, 2) and anchor sizes (1, na, 1, 1, 2) of a grid size from an LRU cache.
+
+        Args:
+            nx (int): Number of x grid points.
+            ny (int): Number of y grid points.
+            device (torch.device): The device of the predictions.
+            dtype (torch.dtype): The dtype of the predictions.
+
+        Returns:
+            grid (Tensor): The xy offsets.
+            anchor_wh (Tensor): The anchor sizes in grid units.
+
+        """
+        key = (nx, ny, device, dtype)
+        entry = self._grids.get(key)
+        if entry is not None:
+            self._grids.move_to_end(key)
+            return entry
+
+        yv, xv = torch.meshgrid([torch.arange(ny, device=device), torch.arange(nx, device=device)], indexing="ij")
+        entry = torch.stack((xv, yv), 2).view((1, 1, ny, nx, 2)).to(dtype), self.anchor_wh.to(device, dtype)
+        self._grids[key] = entry
+        if len(self._grids) > grid_cache_size:
+            self._grids.popitem(last=False)
+
+        return entry
+
+    def create_grids(self, ng=(13, 13), device="cpu", dtype=torch.float32):
         self.nx, self.ny = ng  # x and y grid size
         self.ng = torch.tensor(ng, dtype=torch.float)
 
         # build xy offsets
         if not self.training:
-            yv, xv = torch.meshgrid([torch.arange(self.ny, device=device),
-                                     torch.arange(self.nx, device=device)],
-                                    indexing="ij")
-            self.grid = torch.stack((xv, yv), 2).view((1, 1, self.ny, self.nx, 2)).float()
-
-        if self.anchor_vec.device != device:
-            self.anchor_vec = self.anchor_vec.to(device)
-            self.anchor_wh = self.anchor_wh.to(device)
+            self.grid, _ = self._cached_grid(self.nx, self.ny, torch.device(device), dtype)
 
     def forward(self, p):
         if self.onnx_export:
             bs = 1  # batch size
         else:
             bs, _, ny, nx = p.shape  # bs, 255, 13, 13
-            if (self.nx, self.ny) != (nx, ny):
-                self.create_grids((nx, ny), p.device)
+            self.nx, self.ny = nx, ny
 
         # p.view(bs, 255, 13, 13) -- > (bs, 3, 13, 13, 85)  # (bs, anchors, grid, grid, classes + xywh)
         p = p.view(bs, self.na, self.num_classes_output, self.ny, self.nx)
@@ -236,13 +533,21 @@ class _YOLOLayer(nn.Module):
             return p_cls, xy * ng, wh
 
         else:  # inference
-            if self.grid==None: # ADAPTATION, for validation.
-                self.create_grids((nx, ny), p.device) # ADAPTATION, for validation.
-            io = p.clone()  # inference output
-            io[..., :2] = torch.sigmoid(io[..., :2]) + self.grid  # xy
-            io[..., 2:4] = torch.exp(io[..., 2:4]) * self.anchor_wh  # wh yolo method
-            io[..., :4] *= self.stride
-            torch.sigmoid_(io[..., 4:])
+            grid, anchor_wh = self._cached_grid(nx, ny, p.device, p.dtype)
+            self.grid = grid
+            if torch.is_grad_enabled() and p.requires_grad:  # out= writes are not differentiable
+                io = torch.cat((
+                    (torch.sigmoid(p[..., :2]) + grid) * self.stride,  # xy
+                    torch.exp(p[..., 2:4]) * anchor_wh * self.stride,  # wh yolo method
+                    torch.sigmoid(p[..., 4:]),
+                ), -1)
+                return io.view(bs, -1, self.num_classes_output), p
+            # Decode into an uninitialized output instead of a copy of p
+            io = torch.empty_like(p)  # inference output
+            xy, wh = io[..., :2], io[..., 2:4]
+            torch.sigmoid(p[..., :2], out=xy).add_(grid).mul_(self.stride)  # xy
+            torch.exp(p[..., 2:4], out=wh).mul_(anchor_wh).mul_(self.stride)  # wh yolo method
+            torch.sigmoid(p[..., 4:], out=io[..., 4:])
             return io.view(bs, -1, self.num_classes_output), p  # view [1, 3, 13, 13, 85] as [1, 507, 85]
 
 
@@ -263,26 +568,58 @@ class _FeatureConcat(nn.Module):
 
         return x
 
+def roi_to_tensor(roi_info: Tensor or list or None, device: torch.device) -> Tensor or None:
+    """Converts the ROI info of a batch to one (B, 4) tensor on the device.
+
+    Args:
+        roi_info (Tensor or list or None): A (B, 4) tensor, or per-sample lists of the 4 ROI label columns as returned by
+            `LoadImagesAndLabels.collate_fn`, of which the first label is used (zeros if a sample has no label).
+        device (torch.device): The device of the model input.
+
+    Returns:
+        roi (Tensor or None): The ROI info with shape (B, 4), ``None`` if roi_info is ``None``.
+
+    """
+    if roi_info is None or isinstance(roi_info, Tensor):
+        return roi_info if roi_info is None or roi_info.device == device else roi_info.to(device, non_blocking=True)
+
+    # Gather on the host, then copy once
+    roi = np.zeros((len(roi_info), len(roi_info[0]) if len(roi_info) else 0), dtype=np.float32)
+    for i, sample in enumerate(roi_info):
+        for j, column in enumerate(sample):
+            column = np.asarray(column).reshape(-1)
+            roi[i, j] = column[0] if column.size else 0
+
+    return torch.from_numpy(roi).to(device, non_blocking=True)
+
+
 class _FilterAppend(nn.Module): # ADAPTATION
     def __init__(self, catends: int):
         super(_FilterAppend, self).__init__()
         self.cantends = catends
 
-    def forward(self, x:Tensor, y:list=None):
-        y = [[0]*self.cantends]*x.shape[0] if not y else y
-        y_tensor = torch.ones(x.shape[0], len(y[0]), x.shape[-2], x.shape[-1], device=x.device)
-        for i in range(len(y)):
-            for j in range(len(y[i])):
-                # y_tensor[i,j,:,:] = y_tensor[i,j,:,:]*torch.Tensor([y[i][j]]).to(x.device)
-                y_tensor[i,j,:,:] = y_tensor[i,j,:,:]*torch.Tensor(np.array([y[i][j]])).to(x.device) # ADAPTATION
-        return torch.cat([x, y_tensor], 1)
+    def forward(self, x: Tensor, y: Tensor = None) -> Tensor:
+        """Appends the ROI info of every sample as constant feature planes.
+
+        Args:
+            x (Tensor): Features with shape (B, C, H, W).
+            y (Tensor, optional): ROI info with shape (B, catends), zeros if ``None``. Defaults: ``None``.
+
+        Returns:
+            Tensor: Features with shape (B, C + catends, H, W).
+
+        """
+        if y is None:
+            y = x.new_zeros(x.shape[0], self.cantends)
+        y = y.to(x.dtype)[:, :, None, None].expand(-1, -1, x.shape[-2], x.shape[-1])
+        return torch.cat([x, y], 1)
 
 class _Flatten(nn.Module): # ADAPTATION
     def __init__(self):
         super(_Flatten, self).__init__()
 
     def forward(self, x):
-        return x.view(x.size(0), -1)
+        return torch.flatten(x, 1)  # also works on the channels-last outputs of quantized convolutions
 
 class _FullyConnect(nn.Module): # ADAPTATION
     def __init__(self, n_input, n_output):
@@ -371,13 +708,13 @@ class _MixConv2d(nn.Module):
         mix_conv2d = []
         for g in range(groups):
             mix_conv2d.append(nn.Conv2d(in_channels=in_channels,
-                                        out_channels=ch[g],
+                                        out_channels=int(ch[g]),
                                         kernel_size=kernel_size_tuple[g],
                                         stride=stride,
                                         padding=kernel_size_tuple[g] // 2,
                                         dilation=dilation,
                                         bias=bias))
-        self.mix_conv2d = nn.ModuleList(*mix_conv2d)
+        self.mix_conv2d = nn.ModuleList(mix_conv2d)
 
     def forward(self, x: Tensor) -> Tensor:
         x = torch.cat([m(x) for m in self.mix_conv2d], dim=1)
@@ -480,76 +817,113 @@ def compute_MSELoss(x, y): # ADAPTTION
     mse_loss = loss_func(x, y)
     return 200*mse_loss
 
+class ROIDepthLoss(nn.Module):
+    def __init__(self, hyper_parameters_dict: dict, depth_gain: float = 200.0) -> None:
+        """YOLOv3 GIoU, objectness and class losses plus the ROI depth MSE loss, built once for the whole training.
+
+        The BCE criteria, their pos_weight and the zero accumulator are module state, move the criterion to the
+        device of the model once.
+
+        Args:
+            hyper_parameters_dict (dict): The hyper-parameters, giou, obj, cls, cls_pw, obj_pw and fl_gamma are used.
+            depth_gain (float, optional): The gain of the depth MSE loss. Default: 200.0.
+
+        """
+        super(ROIDepthLoss, self).__init__()
+        self.giou_gain = hyper_parameters_dict["giou"]
+        self.obj_gain = hyper_parameters_dict["obj"]
+        self.cls_gain = hyper_parameters_dict["cls"]
+        self.depth_gain = depth_gain
+
+        # Define criteria
+        self.bce_cls = nn.BCEWithLogitsLoss(pos_weight=torch.FloatTensor([hyper_parameters_dict["cls_pw"]]))
+        self.bce_obj = nn.BCEWithLogitsLoss(pos_weight=torch.FloatTensor([hyper_parameters_dict["obj_pw"]]))
+
+        # class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
+        self.cp, self.cn = _smooth_bce(eps=0.0)
+
+        # focal loss
+        g = hyper_parameters_dict["fl_gamma"]  # focal loss gamma
+        if g > 0:
+            self.bce_cls, self.bce_obj = _FocalLoss(self.bce_cls, g), _FocalLoss(self.bce_obj, g)
+
+        self.register_buffer("zero", torch.zeros(1), persistent=False)
+
+    def forward(
+            self,
+            p: List[Tensor],
+            p_roidepth: Tensor,
+            targets: Tensor,
+            model: nn.Module,
+    ) -> Tuple[Tensor, Tensor]:
+        """
+        Args:
+            p (List[Tensor]): YOLO layer predictions in training mode.
+            p_roidepth (Tensor): Depth predictions with shape (B, 1).
+            targets (Tensor): Targets (image, class, xywh, depth, ...).
+            model (nn.Module): The model, for the targets, num_classes and the giou ratio gr.
+
+        Returns:
+            loss (Tensor): The total loss.
+            loss_items (Tensor): Detached (GIoU, obj, cls, depth, total) losses.
+
+        """
+        tcls, tbox, tdep, indices, anchors = _build_targets(p, targets, model)  # targets
+        lbox = lobj = lcls = self.zero
+
+        # per output
+        for i, pi in enumerate(p):  # layer index, layer predictions
+            b, a, gj, gi = indices[i]  # image, anchor, gridy, gridx
+            tobj = torch.zeros_like(pi[..., 0])  # target obj
+
+            nb = b.shape[0]  # number of targets
+            if nb:
+                ps = pi[b, a, gj, gi]  # prediction subset corresponding to targets
+
+                # GIoU
+                pxy = ps[:, :2].sigmoid()
+                pwh = ps[:, 2:4].exp().clamp(max=1E3) * anchors[i]
+                pbox = torch.cat((pxy, pwh), 1)  # predicted box
+                giou = _bbox_iou(pbox.t(), tbox[i], x1y1x2y2=False, g_iou=True)  # giou(prediction, target)
+                lbox = lbox + (1.0 - giou).mean()  # giou loss
+
+                # Obj
+                tobj[b, a, gj, gi] = (1.0 - model.gr) + model.gr * giou.detach().clamp(0).type(tobj.dtype)
+
+                # Class
+                if model.num_classes > 1:  # cls loss (only if multiple classes)
+                    t = torch.full_like(ps[:, 5:], self.cn)  # targets
+                    t[torch.arange(nb, device=t.device), tcls[i]] = self.cp
+                    lcls = lcls + self.bce_cls(ps[:, 5:], t)  # BCE
+
+            lobj = lobj + self.bce_obj(pi[..., 4], tobj)  # obj loss
+
+        lbox = lbox * self.giou_gain
+        lobj = lobj * self.obj_gain
+        lcls = lcls * self.cls_gain
+        ldep = F_torch.mse_loss(p_roidepth, tdep.unsqueeze(1)) * self.depth_gain  # ADAPTATION
+        loss = lbox + lobj + lcls + ldep
+
+        return loss, torch.cat((lbox, lobj, lcls, ldep.unsqueeze(0), loss)).detach()
+
+
 def compute_loss(p: Tensor, p_roidepth: Tensor, targets: Tensor, model: nn.Module):  # predictions, targets, model
-    """Computes loss for YOLOv3.
+    """Computes loss for YOLOv3, build a `ROIDepthLoss` once instead when called every step.
 
     Args:
         p (Tensor): predictions
+        p_roidepth (Tensor): depth predictions
         targets (Tensor): targets
         model (nn.Module): model
 
     Returns:
         loss (Tensor): loss
+        loss_items (Tensor): detached (GIoU, obj, cls, depth, total) losses
 
     """
-    lcls = torch.FloatTensor([0]).to(device=targets.device)
-    lbox = torch.FloatTensor([0]).to(device=targets.device)
-    lobj = torch.FloatTensor([0]).to(device=targets.device)
-    tcls, tbox, tdep, indices, anchors = _build_targets(p, targets, model)  # targets
-    hyper_parameters_dict = model.hyper_parameters_dict  # hyperparameters
-
-    # Define criteria
-    BCEcls = nn.BCEWithLogitsLoss(
-        pos_weight=torch.FloatTensor([hyper_parameters_dict["cls_pw"]]).to(targets.device))
-    BCEobj = nn.BCEWithLogitsLoss(
-        pos_weight=torch.FloatTensor([hyper_parameters_dict["obj_pw"]]).to(targets.device))
-
-    # class label smoothing https://arxiv.org/pdf/1902.04103.pdf eqn 3
-    cp, cn = _smooth_bce(eps=0.0)
-
-    # focal loss
-    g = hyper_parameters_dict["fl_gamma"]  # focal loss gamma
-    if g > 0:
-        BCEcls, BCEobj = _FocalLoss(BCEcls, g), _FocalLoss(BCEobj, g)
-
-    # per output
-    nt = 0  # targets
-    for i, pi in enumerate(p):  # layer index, layer predictions
-        b, a, gj, gi = indices[i]  # image, anchor, gridy, gridx
-        tobj = torch.zeros_like(pi[..., 0])  # target obj
-
-        nb = b.shape[0]  # number of targets
-        if nb:
-            nt += nb  # cumulative targets
-            ps = pi[b, a, gj, gi]  # prediction subset corresponding to targets
-
-            # GIoU
-            pxy = ps[:, :2].sigmoid()
-            pwh = ps[:, 2:4].exp().clamp(max=1E3) * anchors[i]
-            pbox = torch.cat((pxy, pwh), 1)  # predicted box
-            giou = _bbox_iou(pbox.t(), tbox[i], x1y1x2y2=False, g_iou=True)  # giou(prediction, target)
-            lbox += (1.0 - giou).mean()  # giou loss
-
-            # Obj
-            tobj[b, a, gj, gi] = (1.0 - model.gr) + model.gr * giou.detach().clamp(0).type(tobj.dtype)  # giou ratio
-
-            # Class
-            if model.num_classes > 1:  # cls loss (only if multiple classes)
-                t = torch.full_like(ps[:, 5:], cn)  # targets
-                t[range(nb), tcls[i]] = cp
-                lcls += BCEcls(ps[:, 5:], t)  # BCE
-
-        lobj += BCEobj(pi[..., 4], tobj)  # obj loss
-
-    lbox *= hyper_parameters_dict["giou"]
-    lobj *= hyper_parameters_dict["obj"]
-    lcls *= hyper_parameters_dict["cls"]
-
-    # loss = lbox + lobj + lcls
-    ldep = compute_MSELoss(p_roidepth, tdep.unsqueeze(1)) # ADAPTATION 
-    loss = lbox + lobj + lcls + ldep # ADAPTATION
-    # return loss, torch.cat((lbox, lobj, lcls, loss)).detach()
-    return loss, torch.cat((lbox, lobj, lcls, ldep.unsqueeze(0), loss)).detach() # ADAPTATION
+    criterion = ROIDepthLoss(model.hyper_parameters_dict).to(targets.device)
+
+    return criterion(p, p_roidepth, targets, model)
 
 
 def convert_model_state_dict(
@@ -595,6 +969,105 @@ def convert_model_state_dict(
         print("Error: extension not supported.")
 
 
+fused_cache_version = 3
+
+
+def load_fused_darknet(
+        model_config_path: str,
+        model_weights_path: str,
+        image_size: tuple or int = (416, 416),
+        gray: bool = False,
+        cache: bool = True,
+) -> Darknet:
+    """Returns a fused eval Darknet with the weights loaded, cached on disk next to the weights.
+
+    The cache ``<weights>.fused`` holds the fused state_dict and a key of the config and model.py contents, the
+    weights file size and modification time, image_size and gray. On a hit the fused layers are built from the config
+    without folding any weights and the cached state is loaded into them, the cache is rewritten whenever the key
+    changes.
+
+    Args:
+        model_config_path (str): Model configuration file path.
+        model_weights_path (str): Darknet (*.weights) or PyTorch weights file path.
+        image_size (tuple or int, optional): Image size. Default: (416, 416).
+        gray (bool, optional): Whether to use grayscale images. Default: ``False``.
+        cache (bool, optional): Whether to read and write the cache. Default: ``True``.
+
+    Returns:
+        model (Darknet): The fused model on the CPU.
+
+    """
+    key = hashlib.md5()
+    for path in (model_config_path, __file__):
+        with open(path, "rb") as f:
+            key.update(f.read())
+    stat = os.stat(model_weights_path)
+    key.update(f"{fused_cache_version}:{stat.st_size}:{stat.st_mtime_ns}:{image_size}:{gray}".encode("utf-8"))
+    key = key.hexdigest()
+    cache_path = model_weights_path + ".fused"
+
+    model = Darknet(model_config_path, image_size, gray)
+    if cache and os.path.isfile(cache_path):
+        try:
+            checkpoint = torch.load(cache_path, map_location="cpu")
+            if checkpoint["key"] == key:
+                model.eval()
+                model.fuse(fold=False)
+                model.load_state_dict(checkpoint["state_dict"])
+                print(f"Loaded fused model from {cache_path}")
+                return model
+        except Exception as e:
+            print(f"WARNING: Ignoring fused model cache {cache_path}: {e}")
+            model = Darknet(model_config_path, image_size, gray)
+
+    if model_weights_path.endswith(".weights"):
+        load_pretrained_darknet_state_dict(model, model_weights_path)
+    else:
+        model = load_pretrained_torch_state_dict(model, model_weights_path)
+    model.eval()
+    model.fuse()
+
+    if cache:
+        try:
+            torch.save({"key": key, "state_dict": model.state_dict()}, cache_path + ".tmp")
+            os.replace(cache_path + ".tmp", cache_path)
+        except OSError as e:
+            print(f"WARNING: Cache directory {os.path.dirname(cache_path)} is not writeable: {e}")
+
+    return model
+
+
+def supported_image_sizes(model: Darknet, image_sizes: List[int]) -> List[int]:
+    """Returns the square input sizes the model runs at, layers like `_FullyConnect` fix the size of their input.
+
+    Every size is tried with one forward of a blank image in eval mode, the model and its mode are left unchanged.
+
+    Args:
+        model (Darknet): The model.
+        image_sizes (List[int]): The candidate sizes.
+
+    Returns:
+        image_sizes (List[int]): The candidate sizes that run.
+
+    """
+    training = model.training
+    model.eval()
+    parameter = next(model.parameters())
+    channels = model.module_list[0][0].in_channels if isinstance(model.module_list[0], nn.Sequential) else 3
+    sizes = []
+    with torch.no_grad():
+        for size in image_sizes:
+            try:
+                model(torch.zeros(1, channels, size, size, device=parameter.device),
+                      torch.zeros(1, 4, device=parameter.device))
+            except RuntimeError:
+                continue
+            sizes.append(size)
+    model.train(training)
+
+    return sizes
+
+
 def _bbox_iou(box1, box2, x1y1x2y2=True, g_iou=False, d_iou=False, c_iou=False):
     # Returns the IoU of box1 to box2. box1 is 4, box2 is nx4
     box2 = box2.t()
@@ -658,44 +1131,73 @@ def _build_targets(
     """
     # Build targets for compute_loss(), input targets(image,class,x,y,w,h)
     nt = targets.shape[0]
-    tcls, tbox, indices, anch = [], [], [], []
-    # gain = torch.ones(6, device=targets.device)  # normalized to gridspace gain
-    gain = torch.ones(12, device=targets.device)  # ADAPTATION
-
-    for i, j in enumerate(model.yolo_layers):
-        anchors = model.module_list[j].anchor_vec
-        # gain[2:] = torch.tensor(p[i].shape)[[3, 2, 3, 2]].to(targets.device)  # xyxy gain
-        gain[2:6] = torch.tensor(p[i].shape)[[3, 2, 3, 2]].to(targets.device)  # ADAPTATION
-        na = anchors.shape[0]  # number of anchors
-        # anchor tensor, same as .repeat_interleave(nt)
-        at = torch.arange(na).view(na, 1).repeat(1, nt).to(targets.device)
-
-        # Match targets to anchors
-        a, t, offsets = [], targets * gain, 0
-        if nt:
-            j = _wh_iou(anchors, t[:, 4:6]) > model.hyper_parameters_dict[
-                "iou_t"]  # iou(3,n) = wh_iou(anchors(3,2), gwh(n,2))
-            a, t = at[j], t.repeat(na, 1, 1)[j]  # filter
-
-        # Define
-        b, c = t[:, :2].long().T  # image, class
-        gxy = t[:, 2:4]  # grid xy
-        gwh = t[:, 4:6]  # grid wh
-        gij = (gxy - offsets).long()
-        gi, gj = gij.T  # grid xy indices
-
-        # Append# image, anchor, grid indices
-        indices.append((b, a, gj.clamp_(0, gain[3].long() - 1), gi.clamp_(0, gain[2].long() - 1)))
-        tbox.append(torch.cat((gxy - gij, gwh), 1))  # box
-        anch.append(anchors[a])  # anchors
-        tcls.append(c)  # class
-        if c.shape[0]:  # if any targets
-            assert c.max() < model.num_classes, f"Model accepts {model.num_classes} classes labeled from 0-{model.num_classes - 1}, however you labelled a class {c.max()}. "
+    gain, grid_max, anchors = _build_target_constants(model, tuple(tuple(x.shape[2:4]) for x in p), targets.device)
+    num_layers = gain.shape[0]
+
+    # Match targets to the anchors of all layers at once, iou(layers, na, nt) = wh_iou(anchors(layers, na, 2),
+    # gwh(layers, nt, 2)). Matches are ordered by layer, then anchor, then target, like the former per-layer loop
+    if nt:
+        t = targets[None] * gain[:, None]  # targets in the grid units of every layer
+        j = _wh_iou(anchors, t[..., 4:6]) > model.hyper_parameters_dict["iou_t"]
+        layer, a, target = j.nonzero(as_tuple=True)
+        counts = torch.bincount(layer, minlength=num_layers).tolist()
+        t = t[layer, target]
+    else:
+        layer = a = torch.zeros(0, dtype=torch.long, device=targets.device)
+        counts = [0] * num_layers
+        t = targets.new_zeros(0, targets.shape[1])
+
+    # Define
+    b, c = t[:, :2].long().T  # image, class
+    gxy = t[:, 2:4]  # grid xy
+    gwh = t[:, 4:6]  # grid wh
+    gij = torch.minimum(gxy.long().clamp_(min=0), grid_max[layer])  # grid xy indices, inside the grid
+    gi, gj = gij.T
+    if c.shape[0]:  # if any targets
+        assert c.max() < model.num_classes, f"Model accepts {model.num_classes} classes labeled from 0-{model.num_classes - 1}, however you labelled a class {c.max()}. "
+
+    # Split per layer, image, anchor, grid indices
+    indices = list(zip(b.split(counts), a.split(counts), gj.split(counts), gi.split(counts)))
+    tbox = list(torch.cat((gxy - gij, gwh), 1).split(counts))  # box
+    anch = list(anchors[layer, a].split(counts))  # anchors
+    tcls = list(c.split(counts))  # class
     tdep = torch.autograd.Variable(targets[:,6]) # ADAPTATION
     # return tcls, tbox, indices, anch
     return tcls, tbox, tdep, indices, anch # ADAPTATION
 
 
+def _build_target_constants(model: nn.Module, shapes: tuple, device: torch.device) -> Tuple[Tensor, Tensor, Tensor]:
+    """Returns the target gains, grid limits and anchors of all YOLO layers, cached per grid sizes and device.
+
+    Args:
+        model (nn.Module): model
+        shapes (tuple): (ny, nx) of every YOLO layer
+        device (torch.device): device of the targets
+
+    Returns:
+        gain (Tensor): gains with shape (layers, 12), the grid size in the xywh columns and ones elsewhere
+        grid_max (Tensor): largest grid x and y index with shape (layers, 2)
+        anchors (Tensor): anchors in grid units with shape (layers, na, 2), zero padded if na differs
+
+    """
+    key = (shapes, device)
+    constants = model._target_constants.get(key)
+    if constants is None:
+        gain = torch.ones(len(shapes), 12)  # ADAPTATION, image, class, xywh, 6 label columns
+        gain[:, 2:6] = torch.tensor([[nx, ny, nx, ny] for ny, nx in shapes])  # xyxy gain
+        anchor_vecs = [model.module_list[j].anchor_vec for j in model.yolo_layers]
+        anchors = torch.zeros(len(anchor_vecs), max(x.shape[0] for x in anchor_vecs), 2)
+        for i, anchor_vec in enumerate(anchor_vecs):
+            anchors[i, :anchor_vec.shape[0]] = anchor_vec.cpu()
+        grid_max = torch.tensor([[nx - 1, ny - 1] for ny, nx in shapes])
+        constants = gain.to(device), grid_max.to(device), anchors.to(device)
+        if len(model._target_constants) >= grid_cache_size:
+            model._target_constants.clear()
+        model._target_constants[key] = constants
+
+    return constants
+
+
 def _create_modules(
         module_define: list,
         image_size: int or tuple,
@@ -905,40 +1407,108 @@ def _create_modules(
     return module_list, routs_binary
 
 
-def _fuse_conv_and_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Module:
+def _batch_norm_affine(bn: nn.Module) -> Tuple[Tensor, Tensor]:
+    """Returns the per-channel scale and shift that a BatchNorm applies in eval mode."""
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+
+    return scale, bn.bias - bn.running_mean * scale
+
+
+def _fuse_conv_and_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d, channels: slice = slice(None)) -> nn.Conv2d:
     """Fuse convolution and batchnorm layers.
 
     Args:
         conv (nn.Conv2d): convolution layer
         bn (nn.BatchNorm2d): batchnorm layer
+        channels (slice, optional): the batchnorm channels produced by conv. Default: all channels.
 
     Returns:
-        fused_conv_bn (nn.Module): fused convolution layer
+        fused_conv_bn (nn.Conv2d): fused convolution layer
 
     """
     with torch.no_grad():
-        # init
+        scale, shift = _batch_norm_affine(bn)
+        scale, shift = scale[channels], shift[channels]
         fused_conv_bn = nn.Conv2d(conv.in_channels,
                                   conv.out_channels,
                                   kernel_size=conv.kernel_size,
                                   stride=conv.stride,
                                   padding=conv.padding,
-                                  bias=True)
+                                  dilation=conv.dilation,
+                                  groups=conv.groups,
+                                  bias=True,
+                                  padding_mode=conv.padding_mode).to(conv.weight.device)
+        fused_conv_bn.weight.copy_(conv.weight * scale.view(-1, 1, 1, 1))
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(shift)
+        fused_conv_bn.bias.copy_(bias * scale + shift)
 
-        # prepare filters
-        w_conv = conv.weight.clone().view(conv.out_channels, -1)
-        w_bn = torch.diag(bn.weight.div(torch.sqrt(bn.eps + bn.running_var)))
-        fused_conv_bn.weight.copy_(torch.mm(w_bn, w_conv).view(fused_conv_bn.weight.size()))
+    return fused_conv_bn
 
-        # prepare spatial bias
-        if conv.bias is not None:
-            b_conv = conv.bias
-        else:
-            b_conv = torch.zeros(conv.weight.size(0))
-        b_bn = bn.bias - bn.weight.mul(bn.running_mean).div(torch.sqrt(bn.running_var + bn.eps))
-        fused_conv_bn.bias.copy_(torch.mm(w_bn, b_conv.reshape(-1, 1)).reshape(-1) + b_bn)
 
-        return fused_conv_bn
+def _fuse_linear_and_bn(linear: nn.Linear, bn: nn.Module) -> nn.Linear:
+    """Fuse linear and batchnorm layers.
+
+    Args:
+        linear (nn.Linear): linear layer
+        bn (nn.Module): batchnorm layer over the linear outputs
+
+    Returns:
+        fused_linear_bn (nn.Linear): fused linear layer
+
+    """
+    with torch.no_grad():
+        scale, shift = _batch_norm_affine(bn)
+        fused_linear_bn = nn.Linear(linear.in_features, linear.out_features, bias=True).to(linear.weight.device)
+        fused_linear_bn.weight.copy_(linear.weight * scale.view(-1, 1))
+        bias = linear.bias if linear.bias is not None else torch.zeros_like(shift)
+        fused_linear_bn.bias.copy_(bias * scale + shift)
+
+    return fused_linear_bn
+
+
+def _add_bias(layer: nn.Module) -> nn.Module:
+    """Gives a Conv2d or Linear layer without bias an uninitialized one, the layout of a fused layer."""
+    if layer.bias is None:
+        layer.bias = nn.Parameter(layer.weight.new_empty(layer.weight.shape[0]))
+
+    return layer
+
+
+def _fuse_module(module: nn.Module, fold: bool = True) -> None:
+    """Folds every BatchNorm that directly follows a Conv2d, _MixConv2d or Linear in a Sequential, recursively.
+
+    Args:
+        module (nn.Module): The module, modified in place.
+        fold (bool, optional): Whether to fold the BatchNorm values into the weights, ``False`` only removes the
+            BatchNorm layers and adds the biases. Default: ``True``.
+
+    """
+    for child in module.children():
+        _fuse_module(child, fold)
+    if not isinstance(module, nn.Sequential):
+        return
+
+    previous_name, previous = None, None
+    for name, child in list(module.named_children()):
+        if isinstance(child, (nn.BatchNorm1d, nn.BatchNorm2d)) and previous is not None:
+            if isinstance(previous, nn.Conv2d):
+                setattr(module, previous_name, _fuse_conv_and_bn(previous, child) if fold else _add_bias(previous))
+            elif isinstance(previous, _MixConv2d):
+                # The kernel groups produce consecutive slices of the batchnorm channels
+                start = 0
+                for i, conv in enumerate(previous.mix_conv2d):
+                    previous.mix_conv2d[i] = _fuse_conv_and_bn(conv, child, slice(start, start + conv.out_channels)) \
+                        if fold else _add_bias(conv)
+                    start += conv.out_channels
+            elif isinstance(previous, nn.Linear):
+                setattr(module, previous_name, _fuse_linear_and_bn(previous, child) if fold else _add_bias(previous))
+            else:
+                previous_name, previous = name, child
+                continue
+            delattr(module, name)
+            previous_name, previous = None, None
+            continue
+        previous_name, previous = name, child
 
 
 def _get_yolo_layers(model):
@@ -1048,11 +1618,11 @@ def _wh_iou(wh1, wh2):
     Returns:
 
     """
-    # Returns the nxm IoU matrix. wh1 is nx2, wh2 is mx2
-    wh1 = wh1[:, None]  # [N,1,2]
-    wh2 = wh2[None]  # [1,M,2]
-    inter = torch.min(wh1, wh2).prod(2)  # [N,M]
-    return inter / (wh1.prod(2) + wh2.prod(2) - inter)  # iou = inter / (area1 + area2 - inter)
+    # Returns the nxm IoU matrix. wh1 is nx2, wh2 is mx2, leading batch dimensions are broadcast
+    wh1 = wh1[..., :, None, :]  # [...,N,1,2]
+    wh2 = wh2[..., None, :, :]  # [...,1,M,2]
+    inter = torch.min(wh1, wh2).prod(-1)  # [...,N,M]
+    return inter / (wh1.prod(-1) + wh2.prod(-1) - inter)  # iou = inter / (area1 + area2 - inter)
 
 
 def yolov3_tiny_prn_voc(**kwargs) -> Darknet:
@@ -304,13 +304,12 @@ class _Concat(nn.Module): # TODO: can _Concat be relapced by _FeatureConcat?
         super(_Concat, self).__init__()
         self.cantends = catends
 
-    def forward(self, x:Tensor, y:list=None):
-        y = [[0]*self.cantends]*x.shape[0] if not y else y
-        y_tensor = torch.ones(x.shape[0], len(y[0]), x.shape[-2], x.shape[-1], device=x.device)
-        for i in range(len(y)):
-            for j in range(len(y[i])):
-                y_tensor[i,j,:,:] = y_tensor[i,j,:,:]*torch.Tensor([y[i][j]]).to(x.device)
-        return torch.cat([x, y_tensor], 1)
+    def forward(self, x:Tensor, y:Tensor=None):
+        # y: (B, catends) ROI info, broadcast to constant (B, catends, H, W) planes
+        if y is None:
+            y = x.new_zeros(x.shape[0], self.cantends)
+        y = y.to(device=x.device, dtype=x.dtype)[:, :, None, None].expand(-1, -1, x.shape[-2], x.shape[-1])
+        return torch.cat([x, y], 1)
 
 class _Flatten(nn.Module):
     def __init__(self):
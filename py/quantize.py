@@ -0,0 +1,192 @@
+# Copyright 2022 Lorna Authors. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Post-training static INT8 quantization of Darknet for CPU inference.
+
+The model is fused, wrapped in `DarknetInference` and quantized in FX graph mode: the convolutions, LeakyReLUs,
+shortcuts, routes, ROI planes and the `_FullyConnect`/`_ROIDepth` linears run in INT8, the YOLO decoding and the
+outputs stay in float32. Activation ranges are calibrated on batches of a `LoadImagesAndLabels` data list.
+
+Usage:
+    python quantize.py --cfg ../cfg/roidepth_0_0_2.cfg --weights ../weights/best.pt --data ../cfg/roidepth-kitti.data
+
+"""
+import argparse
+import copy
+import io
+from typing import Tuple
+
+import torch
+from torch import Tensor, nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from benchmark import measure_latency
+from dataset import parse_dataset_config, LoadImagesAndLabels
+from model import Darknet, DarknetInference
+from task_factory import Tester
+from utils import load_pretrained_torch_state_dict, load_pretrained_darknet_state_dict, load_classes
+
+__all__ = [
+    "quantize_model", "model_size"
+]
+
+
+class _TesterModel(nn.Module):
+    def __init__(self, inference: nn.Module, num_classes: int) -> None:
+        """Gives an inference module the ``(images, roi) -> (detections, None, depth)`` signature of `Tester.test`.
+
+        Args:
+            inference (nn.Module): A `DarknetInference` or its quantized graph.
+            num_classes (int): Number of classes.
+
+        """
+        super(_TesterModel, self).__init__()
+        self.inference = inference
+        self.num_classes = num_classes
+
+    def forward(self, images: Tensor, roi: Tensor) -> Tuple[Tensor, None, Tensor]:
+        detections, depth = self.inference(images, roi)
+        return detections, None, depth
+
+
+def quantize_model(
+        model: Darknet,
+        dataloader: DataLoader,
+        image_size: tuple = (416, 416),
+        num_batches: int = 32,
+        backend: str = "x86",
+) -> nn.Module:
+    """Statically quantizes a copy of the model to INT8, calibrated on the first batches of a dataloader.
+
+    Args:
+        model (Darknet): The float model, not modified.
+        dataloader (DataLoader): Calibration batches as returned by `LoadImagesAndLabels.collate_fn`.
+        image_size (tuple, optional): Input height and width. Default: (416, 416).
+        num_batches (int, optional): Number of calibration batches. Default: 32.
+        backend (str, optional): The quantized engine, ``x86``, ``fbgemm`` or ``qnnpack`` (ARM). Default: ``x86``.
+
+    Returns:
+        quantized_model (nn.Module): The quantized ``(images, roi) -> (detections, depth)`` graph module on the CPU.
+
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    model.fuse()
+    for module in model.modules():
+        if isinstance(module, nn.LeakyReLU):
+            module.inplace = False  # quantized::leaky_relu has no in-place variant
+    inference = DarknetInference(model, image_size).eval()
+
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    # Boxes in pixels and scores would share one INT8 scale, the decoding and its output stay in float32
+    for name, layer in inference.layers.named_children():
+        if layer.__class__.__name__ == "_YOLODecodeLayer":
+            qconfig_mapping.set_module_name(f"layers.{name}", None)
+    qconfig_mapping.set_module_name_object_type_order("", torch.cat, 0, None)
+
+    channels = model.module_list[0][0].in_channels
+    example_inputs = (torch.zeros(1, channels, *image_size), torch.zeros(1, 4))
+    prepared = prepare_fx(inference, qconfig_mapping, example_inputs)
+
+    num_batches = min(num_batches, len(dataloader))
+    with torch.no_grad():
+        for i, (imgs, _, _, _, roi) in enumerate(tqdm(dataloader, total=num_batches, desc="Calibrating")):
+            if i == num_batches:
+                break
+            prepared(imgs.float() / 255.0, roi)
+
+    return convert_fx(prepared)
+
+
+def model_size(model: nn.Module) -> int:
+    """Returns the size of the serialized state dict of a model in bytes."""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+
+    return buffer.getbuffer().nbytes
+
+
+def main(args: argparse.Namespace) -> None:
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    image_size = (args.img_size, args.img_size)
+    dataset_dict = parse_dataset_config(args.data)
+    names = load_classes(dataset_dict["names"])
+    num_classes = 1 if args.single_cls else int(dataset_dict["classes"])
+
+    model = Darknet(args.cfg, image_size=image_size, gray=args.gray)
+    model.num_classes = num_classes
+    if args.weights.endswith(".weights"):
+        load_pretrained_darknet_state_dict(model, args.weights)
+    elif args.weights:
+        model = load_pretrained_torch_state_dict(model, args.weights)
+    model.eval()
+
+    def build_dataloader(path: str, shuffle: bool) -> DataLoader:
+        dataset = LoadImagesAndLabels(path, args.img_size, args.batch_size, augment=False, rect_label=False,
+                                      single_classes=args.single_cls, pad=0.5, gray=args.gray)
+        return DataLoader(dataset, batch_size=args.batch_size, shuffle=shuffle, num_workers=args.workers,
+                          collate_fn=dataset.collate_fn)
+
+    calibration_dataloader = build_dataloader(dataset_dict["train"], True)
+    test_dataloader = build_dataloader(dataset_dict["valid"], False)
+    quantized_model = quantize_model(model, calibration_dataloader, image_size, args.calib_batches, args.backend)
+
+    fused_model = copy.deepcopy(model)
+    fused_model.fuse()
+    float_model = DarknetInference(fused_model, image_size).eval()
+
+    # Same settings as the test section of config.yaml
+    iouv = torch.linspace(0.5, 0.95, 10)
+    results = {}
+    for name, inference in (("float32", float_model), ("int8", quantized_model)):
+        print(f"Testing {name} model")
+        _, _, map50, _, _, depth_accuracy, _ = Tester.test(_TesterModel(inference, num_classes), test_dataloader, names,
+                                                        args.conf_threshold, args.iou_threshold, iouv[0].view(1),
+                                                        iouv.numel())
+        images = torch.rand(1, 1 if args.gray else 3, *image_size)
+        roi = torch.rand(1, 4)
+        latency = measure_latency(torch.jit.freeze(torch.jit.script(inference)), images, roi, args.iters)
+        results[name] = (map50, depth_accuracy, latency, model_size(inference) / 1e6)
+
+    print(("%10s" * 5) % ("Model", "mAP@0.5", "Acc@dep", "ms", "MB"))
+    for name, result in results.items():
+        print(("%10s" + "%10.4g" * 4) % (name, *result))
+    print(("%10s" + "%+10.4g" * 4) % ("delta", *[b - a for a, b in zip(results["float32"], results["int8"])]))
+
+    if args.output:
+        torch.jit.save(torch.jit.script(quantized_model), args.output)
+        print(f"Saved the quantized TorchScript model to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="quantize.py", description="Post-training INT8 quantization of Darknet.")
+    parser.add_argument("--cfg", type=str, default="../cfg/roidepth_0_0_2.cfg", help="model config")
+    parser.add_argument("--weights", type=str, default="", help="weights, random initialization if empty")
+    parser.add_argument("--data", type=str, default="../cfg/roidepth-kitti.data", help="dataset config")
+    parser.add_argument("--img-size", type=int, default=128, help="input size")
+    parser.add_argument("--batch-size", type=int, default=16, help="calibration and test batch size")
+    parser.add_argument("--calib-batches", type=int, default=32, help="number of calibration batches")
+    parser.add_argument("--backend", type=str, default="x86", help="quantized engine: x86, fbgemm or qnnpack")
+    parser.add_argument("--gray", action="store_true", help="grayscale input")
+    parser.add_argument("--single-cls", action="store_true", help="single-class dataset")
+    parser.add_argument("--conf-threshold", type=float, default=0.001, help="test confidence threshold")
+    parser.add_argument("--iou-threshold", type=float, default=0.6, help="test NMS IoU threshold")
+    parser.add_argument("--workers", type=int, default=4, help="number of DataLoader workers")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, torch default if 0")
+    parser.add_argument("--iters", type=int, default=100, help="latency iterations")
+    parser.add_argument("--output", type=str, default="", help="TorchScript file of the quantized model, if set")
+    main(parser.parse_args())
@@ -0,0 +1,219 @@
+# Copyright 2022 Lorna Authors. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Pre-letterboxed shard format for fixed-size, non-augmented training.
+
+`pack` runs the non-augmented `LoadImagesAndLabels` pipeline once and writes the letterboxed uint8 CHW images into large
+sequential shard files, plus one index with the labels, ROI fields and letterbox shapes. `ShardDataset` memory-maps the
+shards, so loading a sample is a slice instead of a JPEG decode, resize and letterbox.
+
+Usage:
+    python shards.py --data-list dataset/train/paths.txt --img-size 128
+
+"""
+import argparse
+import os
+from typing import List
+
+import numpy as np
+import torch
+from numpy import ndarray
+from torch.utils.data import DataLoader, Dataset
+from torchvision.transforms import functional as F_vision
+from tqdm import tqdm
+
+from dataset import LoadImagesAndLabels, num_label_columns, label_roi
+from utils import make_directory
+
+__all__ = [
+    "shard_directory", "pack", "ShardDataset"
+]
+
+shards_version = 1
+
+
+def shard_directory(path: str, image_size: int) -> str:
+    """Returns the default shard directory of a data list, ``<list>_<image_size>.shards`` next to it.
+
+    Args:
+        path (str): The data list (*.txt).
+        image_size (int): The letterboxed image size.
+
+    Returns:
+        directory (str): The shard directory.
+
+    """
+    return f"{os.path.splitext(path)[0]}_{image_size}.shards"
+
+
+def pack(
+        path: str,
+        image_size: int = 128,
+        output: str = None,
+        shard_size: int = 4096,
+        num_workers: int = 8,
+) -> str:
+    """Packs a data list into letterboxed uint8 shards.
+
+    Samples are produced by the non-augmented, non-rectangular `LoadImagesAndLabels` pipeline, so a `ShardDataset`
+    returns exactly the same tensors.
+
+    Args:
+        path (str): The data list (*.txt).
+        image_size (int, optional): The letterboxed image size. Defaults: 128.
+        output (str, optional): The shard directory, `shard_directory(path, image_size)` if ``None``. Defaults: ``None``.
+        shard_size (int, optional): Number of samples per shard file. Defaults: 4096.
+        num_workers (int, optional): Number of DataLoader workers producing samples. Defaults: 8.
+
+    Returns:
+        directory (str): The shard directory.
+
+    """
+    output = output or shard_directory(path, image_size)
+    make_directory(output)
+
+    dataset = LoadImagesAndLabels(path, image_size, augment=False, rect_label=False, num_io_workers=num_workers)
+    num_images = len(dataset)
+    dataloader = DataLoader(dataset, batch_size=None, shuffle=False, num_workers=num_workers)
+
+    shapes = np.zeros((num_images, 6), dtype=np.float64)  # h0, w0, h / h0, w / w0, pad w, pad h
+    labels, label_counts, shard_sizes = [], np.zeros(num_images, dtype=np.int64), []
+    shard, shard_file = None, None
+    for i, (image, labels_out, _, (hw0, (ratio, pad)), _) in enumerate(tqdm(dataloader, desc="Packing shards")):
+        if i % shard_size == 0:
+            if shard is not None:
+                shard.close()
+                os.replace(shard_file + ".tmp", shard_file)
+            shard_file = os.path.join(output, f"shard_{len(shard_sizes):05d}.bin")
+            shard = open(shard_file + ".tmp", "wb")
+            shard_sizes.append(0)
+
+        shard.write(image.numpy().tobytes())
+        shard_sizes[-1] += 1
+        shapes[i] = list(hw0) + list(ratio) + list(pad)
+        labels.append(labels_out[:, 1:].numpy())
+        label_counts[i] = labels_out.shape[0]
+
+    if shard is not None:
+        shard.close()
+        os.replace(shard_file + ".tmp", shard_file)
+
+    label_offsets = np.zeros(num_images + 1, dtype=np.int64)
+    label_offsets[1:] = np.cumsum(label_counts)
+
+    # The index is written last, it marks the shards as complete
+    with open(os.path.join(output, "index.npz.tmp"), "wb") as f:
+        np.savez(f,
+                 version=np.array(shards_version),
+                 image_size=np.array(image_size),
+                 image_files=np.array(dataset.image_files),
+                 shard_sizes=np.asarray(shard_sizes, dtype=np.int64),
+                 shapes=shapes,
+                 labels=np.concatenate(labels, 0) if labels else np.zeros((0, num_label_columns), dtype=np.float32),
+                 label_offsets=label_offsets)
+    os.replace(os.path.join(output, "index.npz.tmp"), os.path.join(output, "index.npz"))
+    print(f"Packed {num_images} images into {len(shard_sizes)} shards in {output}")
+
+    return output
+
+
+class ShardDataset(Dataset):
+    def __init__(
+            self,
+            path: str,
+            single_classes: bool = False,
+            gray: bool = False,
+    ) -> None:
+        """Load letterboxed images and labels from the shards written by `pack`.
+
+        The shards are memory-mapped copy-on-write, an image is a slice of its shard and no decoding happens in the
+        workers. Samples have the same format as `LoadImagesAndLabels` without augmentation.
+
+        Args:
+            path (str): The shard directory.
+            single_classes (bool, optional): Whether to use single class. Defaults: ``False``.
+            gray (bool, optional): Whether to use grayscale. Defaults: ``False``.
+
+        """
+        with np.load(os.path.join(path, "index.npz"), allow_pickle=False) as f:
+            assert int(f["version"]) == shards_version, f"Shards in {path} are outdated, pack them again"
+            self.image_size = int(f["image_size"])
+            self.image_files = f["image_files"].tolist()
+            self.shard_sizes = f["shard_sizes"]
+            self.shapes = f["shapes"]
+            self.labels = f["labels"]
+            self.label_offsets = f["label_offsets"]
+
+        if single_classes:
+            self.labels = self.labels.copy()
+            self.labels[:, 0] = 0
+
+        self.path = path
+        self.gray = gray
+        self.shard_offsets = np.zeros(len(self.shard_sizes) + 1, dtype=np.int64)
+        self.shard_offsets[1:] = np.cumsum(self.shard_sizes)
+        self.shards = None  # memory maps are opened lazily in every worker
+
+    def _open_shards(self) -> List[ndarray]:
+        size = self.image_size
+        return [np.memmap(os.path.join(self.path, f"shard_{i:05d}.bin"), dtype=np.uint8, mode="c",
+                          shape=(int(n), 3, size, size)) for i, n in enumerate(self.shard_sizes)]
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state["shards"] = None  # reopen in the worker instead of pickling the mapped content
+
+        return state
+
+    def __len__(self) -> int:
+        """Number of images."""
+        return len(self.image_files)
+
+    def image_labels(self, index: int) -> ndarray:
+        """Returns a view on the labels of the image at the specified index, shape (n, 11)."""
+        return self.labels[self.label_offsets[index]:self.label_offsets[index + 1]]
+
+    def __getitem__(self, index: int):
+        """Returns the image and label at the specified index."""
+        if self.shards is None:
+            self.shards = self._open_shards()
+
+        shard = int(np.searchsorted(self.shard_offsets, index, side="right")) - 1
+        image = torch.from_numpy(self.shards[shard][index - self.shard_offsets[shard]])
+
+        if self.gray:
+            # RGB tensor convert GRAY tensor
+            image = F_vision.rgb_to_grayscale(image)
+
+        x = self.image_labels(index)
+        labels_out = torch.zeros((x.shape[0], num_label_columns + 1))
+        labels_out[:, 1:] = torch.from_numpy(x)
+        roi = label_roi(x)
+        h0, w0, rh, rw, pw, ph = self.shapes[index].tolist()
+        shapes = (int(h0), int(w0)), ((rh, rw), (pw, ph))
+
+        return image, labels_out, self.image_files[index], shapes, roi
+
+    collate_fn = staticmethod(LoadImagesAndLabels.collate_fn)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="shards.py", description="Pack a data list into letterboxed shards.")
+    parser.add_argument("--data-list", type=str, required=True, help="data list (*.txt) to pack")
+    parser.add_argument("--img-size", type=int, default=128, help="letterboxed image size")
+    parser.add_argument("--output", type=str, default=None, help="shard directory, <list>_<img-size>.shards if empty")
+    parser.add_argument("--shard-size", type=int, default=4096, help="samples per shard file")
+    parser.add_argument("--workers", type=int, default=8, help="number of packing workers")
+    args = parser.parse_args()
+
+    pack(args.data_list, args.img_size, args.output, args.shard_size, args.workers)
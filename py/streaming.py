@@ -0,0 +1,274 @@
+# Copyright 2022 Lorna Authors. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Streaming tar shards for datasets too large for local RAM or disk.
+
+`pack_tars` groups the image and label files of a data list into sequential tar shards, one record per image with the
+members ``<key>.path`` (original image path), ``<key><image suffix>`` (the unchanged encoded image) and ``<key>.txt``
+(the label file, absent if missing). `TarShardDataset` streams the shards and yields the same
+``(image, labels_out, path, shapes, roi)`` tuples as `LoadImagesAndLabels`.
+
+Usage:
+    python streaming.py --data-list dataset/train/paths.txt --shard-size 10000
+
+"""
+import argparse
+import io
+import os
+import random
+import tarfile
+from typing import Any, Iterator, List, Tuple
+
+import cv2
+import numpy as np
+from torch import distributed
+from torch.utils.data import IterableDataset, get_worker_info
+from tqdm import tqdm
+
+from dataset import LoadImagesAndLabels, num_label_columns, parse_labels, resize_image, letterbox_sample, \
+    finish_sample
+from utils import make_directory
+
+__all__ = [
+    "tar_directory", "pack_tars", "TarShardDataset"
+]
+
+tars_version = 1
+
+
+def tar_directory(path: str) -> str:
+    """Returns the default tar shard directory of a data list, ``<list>.tars`` next to it.
+
+    Args:
+        path (str): The data list (*.txt).
+
+    Returns:
+        directory (str): The tar shard directory.
+
+    """
+    return f"{os.path.splitext(path)[0]}.tars"
+
+
+def _add_member(tar: tarfile.TarFile, name: str, data: bytes) -> None:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def pack_tars(
+        path: str,
+        output: str = None,
+        shard_size: int = 10000,
+) -> str:
+    """Packs the images and label files of a data list into sequential tar shards.
+
+    Args:
+        path (str): The data list (*.txt).
+        output (str, optional): The shard directory, `tar_directory(path)` if ``None``. Defaults: ``None``.
+        shard_size (int, optional): Number of records per shard. Defaults: 10000.
+
+    Returns:
+        directory (str): The shard directory.
+
+    """
+    output = output or tar_directory(path)
+    make_directory(output)
+
+    # Checks the labels and caches them, the records are the raw files
+    dataset = LoadImagesAndLabels(path, augment=False, rect_label=False)
+    names, counts = [], []
+    tar, tar_file = None, None
+    for i, (image_file, label_file) in enumerate(tqdm(zip(dataset.image_files, dataset.label_files),
+                                                      total=len(dataset), desc="Packing tar shards")):
+        if i % shard_size == 0:
+            if tar is not None:
+                tar.close()
+                os.replace(tar_file + ".tmp", tar_file)
+            names.append(f"shard_{len(names):05d}.tar")
+            counts.append(0)
+            tar_file = os.path.join(output, names[-1])
+            tar = tarfile.open(tar_file + ".tmp", "w")
+
+        key = f"{i:09d}"
+        _add_member(tar, key + ".path", image_file.encode("utf-8"))
+        with open(image_file, "rb") as f:
+            _add_member(tar, key + os.path.splitext(image_file)[-1].lower(), f.read())
+        if os.path.isfile(label_file):
+            with open(label_file, "rb") as f:
+                _add_member(tar, key + ".txt", f.read())
+        counts[-1] += 1
+
+    if tar is not None:
+        tar.close()
+        os.replace(tar_file + ".tmp", tar_file)
+
+    # The index is written last, it marks the shards as complete
+    with open(os.path.join(output, "index.npz.tmp"), "wb") as f:
+        np.savez(f,
+                 version=np.array(tars_version),
+                 names=np.array(names),
+                 counts=np.asarray(counts, dtype=np.int64),
+                 classes=dataset.labels[:, 0].astype(np.int16))
+    os.replace(os.path.join(output, "index.npz.tmp"), os.path.join(output, "index.npz"))
+    print(f"Packed {len(dataset)} images into {len(names)} tar shards in {output}")
+
+    return output
+
+
+def _read_records(path: str) -> Iterator[dict]:
+    """Streams the records of one tar shard, a record maps member suffixes to their bytes."""
+    record, record_key = {}, None
+    with open(path, "rb") as f, tarfile.open(fileobj=f, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            key, suffix = os.path.splitext(member.name)
+            if key != record_key and record:
+                yield record
+                record = {}
+            record_key = key
+            record[suffix] = tar.extractfile(member).read()
+    if record:
+        yield record
+
+
+class TarShardDataset(IterableDataset):
+    def __init__(
+            self,
+            path: str,
+            image_size: int = 416,
+            augment: bool = False,
+            hyper_parameters_dict: Any = None,
+            single_classes: bool = False,
+            gray: bool = False,
+            shuffle: bool = False,
+            buffer_size: int = 1000,
+            seed: int = 0,
+            rank: int = None,
+            world_size: int = None,
+    ) -> None:
+        """Stream images and labels from the tar shards written by `pack_tars`.
+
+        Every epoch the shard order is shuffled with ``seed + epoch``, the shards are split deterministically across
+        ranks and then across the DataLoader workers of a rank, and samples pass through a shuffle buffer. Samples are
+        prepared like non-rectangular `LoadImagesAndLabels` samples; mosaics need random access and are not built, with
+        augment the affine, colorspace and flip augmentations are applied to every image.
+
+        Args:
+            path (str): The tar shard directory.
+            image_size (int, optional): The size of the images. Defaults: 416.
+            augment (bool, optional): Whether to augment the images. Defaults: ``False``.
+            hyper_parameters_dict (Any, optional): The hyper-parameters. Defaults: None.
+            single_classes (bool, optional): Whether to use single class. Defaults: ``False``.
+            gray (bool, optional): Whether to use grayscale. Defaults: ``False``.
+            shuffle (bool, optional): Whether to shuffle shards and samples. Defaults: ``False``.
+            buffer_size (int, optional): The number of samples in the shuffle buffer. Defaults: 1000.
+            seed (int, optional): The shuffle seed, shared by all ranks. Defaults: 0.
+            rank (int, optional): The rank of this process, from torch.distributed if ``None``. Defaults: ``None``.
+            world_size (int, optional): The number of ranks, from torch.distributed if ``None``. Defaults: ``None``.
+
+        """
+        with np.load(os.path.join(path, "index.npz"), allow_pickle=False) as f:
+            assert int(f["version"]) == tars_version, f"Tar shards in {path} are outdated, pack them again"
+            self.shard_files = [os.path.join(path, x) for x in f["names"].tolist()]
+            self.shard_counts = f["counts"]
+            classes = f["classes"]
+
+        distributed_ready = distributed.is_available() and distributed.is_initialized()
+        self.rank = rank if rank is not None else (distributed.get_rank() if distributed_ready else 0)
+        self.world_size = world_size if world_size is not None else \
+            (distributed.get_world_size() if distributed_ready else 1)
+
+        # Only the class column is indexed, enough for the class weights
+        self.labels = np.zeros((len(classes), 1), dtype=np.float32) if single_classes else \
+            classes[:, None].astype(np.float32)
+        self.image_size = image_size
+        self.augment = augment
+        self.hyper_parameters_dict = hyper_parameters_dict
+        self.single_classes = single_classes
+        self.gray = gray
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        """Sets the epoch of the shard and sample shuffling, call it before every epoch."""
+        self.epoch = epoch
+
+    def __len__(self) -> int:
+        """Approximate number of images per rank."""
+        return int(self.shard_counts.sum()) // self.world_size
+
+    def _worker_shards(self) -> Tuple[List[str], int]:
+        """Returns the shards of this rank and DataLoader worker, and the global worker index."""
+        worker_info = get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        order = np.arange(len(self.shard_files))
+        if self.shuffle:
+            order = np.random.default_rng(self.seed + self.epoch).permutation(order)
+        order = order[self.rank::self.world_size][worker_id::num_workers]
+
+        return [self.shard_files[i] for i in order], self.rank * num_workers + worker_id
+
+    def _load_sample(self, record: dict) -> tuple:
+        path = record[".path"].decode("utf-8")
+        data = next(v for k, v in record.items() if k not in (".path", ".txt"))
+        image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)  # BGR
+        assert image is not None, "Image Not Found " + path
+
+        x = parse_labels(record[".txt"].decode("utf-8"), path) if ".txt" in record else \
+            np.zeros((0, num_label_columns), dtype=np.float32)
+        if self.single_classes:
+            x[:, 0] = 0
+
+        image, hw0, _ = resize_image(image, self.image_size, self.augment)
+        image, labels, shapes, roi = letterbox_sample(image, x, hw0, self.image_size, self.augment)
+        image, labels_out = finish_sample(image, labels, self.augment, True, self.hyper_parameters_dict, self.gray)
+
+        return image, labels_out, path, shapes, roi
+
+    def __iter__(self) -> Iterator[tuple]:
+        shard_files, worker = self._worker_shards()
+        rng = random.Random((self.seed + self.epoch) * 100003 + worker)
+        records = (record for file in shard_files for record in _read_records(file))
+        if not self.shuffle:
+            for record in records:
+                yield self._load_sample(record)
+            return
+
+        # Records are decoded only when they leave the buffer, it holds encoded bytes
+        buffer = []
+        for record in records:
+            if len(buffer) < self.buffer_size:
+                buffer.append(record)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], record = record, buffer[i]
+            yield self._load_sample(record)
+        rng.shuffle(buffer)
+        for record in buffer:
+            yield self._load_sample(record)
+
+    collate_fn = staticmethod(LoadImagesAndLabels.collate_fn)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="streaming.py", description="Pack a data list into tar shards.")
+    parser.add_argument("--data-list", type=str, required=True, help="data list (*.txt) to pack")
+    parser.add_argument("--output", type=str, default=None, help="shard directory, <list>.tars if empty")
+    parser.add_argument("--shard-size", type=int, default=10000, help="records per shard")
+    args = parser.parse_args()
+
+    pack_tars(args.data_list, args.output, args.shard_size)
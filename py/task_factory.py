@@ -1,22 +1,28 @@
 import cv2, math, os, random, time, yaml
+from contextlib import nullcontext
 from tqdm import tqdm
 from pathlib import Path
 import numpy as np
 import torch
-from torch import nn, optim, cuda
+from torch import nn, optim, cuda, distributed
+from torch import multiprocessing as mp
 from torch.backends import cudnn
+from torch.nn import functional as F_torch
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import lr_scheduler
 from torch.optim.swa_utils import AveragedModel
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, DistributedSampler
 from torch.utils.tensorboard import SummaryWriter
-from torchvision.ops import boxes
 from dataset import parse_dataset_config, labels_to_class_weights, LoadImagesAndLabels, LoadImages
+from shards import shard_directory, ShardDataset
+from streaming import tar_directory, TarShardDataset
+from kitti import KittiROIDataset, FrameGroupedSampler, YRANGE
 from utils import load_pretrained_torch_state_dict, load_pretrained_darknet_state_dict, \
-    save_torch_state_dict, AverageMeter, ProgressMeter, plot_images, non_max_suppression, \
-    clip_coords, xywh2xyxy, xyxy2xywh, ap_per_class, load_classes, scale_coords, plot_one_box
-from model import Darknet, compute_loss
+    CheckpointWriter, AverageMeter, MetricAccumulator, ProgressMeter, plot_images, non_max_suppression, \
+    clip_coords, xywh2xyxy, xyxy2xywh, match_predictions, load_classes, scale_coords, plot_one_box
+from model import Darknet, ROIDepthLoss, load_fused_darknet, supported_image_sizes
 from wrapper import timer
-from indicators import collect_depth, cal_depth_indicators
+from indicators import DEPTH_RANGE_BINS, collect_depth, cal_depth_indicators, depth_range_metrics
 from abc import ABC, abstractmethod
 from typing import Dict, Any, Callable
 import absl.logging as log
@@ -43,6 +49,53 @@ def get(task:str='train') -> Callable:
     assert task in pool.keys(), "task {} does not exist !".format(task)
     return pool[task]
 
+def _train_worker(local_rank: int, options: dict) -> None:
+    """Trains as one DistributedDataParallel rank, spawned by `launch_training` or started by torchrun.
+
+    Args:
+        local_rank (int): The rank of this process on its node.
+        options (dict): The train section of the config.
+
+    """
+    nprocs = int(os.environ.get('LOCAL_WORLD_SIZE', options.get('nprocs', 1)))
+    if torch.device(options['device']).type == 'cuda':
+        torch.cuda.set_device(local_rank)
+    else:
+        # Split the cores of the node between its ranks
+        torch.set_num_threads(max(os.cpu_count() // nprocs, 1))
+    if 'WORLD_SIZE' in os.environ:
+        distributed.init_process_group(backend=options.get('dist_backend', 'nccl'), init_method='env://')
+    else:
+        distributed.init_process_group(
+            backend=options.get('dist_backend', 'nccl'),
+            init_method=options.get('dist_url', 'tcp://127.0.0.1:29500'),
+            rank=options.get('node_rank', 0) * nprocs + local_rank,
+            world_size=options.get('nnodes', 1) * nprocs
+        )
+    try:
+        Trainer(local_rank).go()
+    finally:
+        distributed.destroy_process_group()
+
+def launch_training(path: str = 'config.yaml') -> None:
+    """Trains in this process, or in nprocs DistributedDataParallel processes on each of the nnodes nodes.
+
+    A process started by torchrun, which sets WORLD_SIZE, joins the process group of its environment instead.
+
+    Args:
+        path (str, optional): The config. Defaults: ``config.yaml``.
+
+    """
+    with open(path, 'r') as f:
+        options = yaml.load(f, Loader=yaml.CLoader).get('train')
+    if 'WORLD_SIZE' in os.environ:
+        _train_worker(int(os.environ.get('LOCAL_RANK', 0)), options)
+    elif options.get('nprocs', 1) * options.get('nnodes', 1) > 1:
+        mp.spawn(_train_worker, args=(options,), nprocs=options.get('nprocs', 1))
+    else:
+        Trainer().go()
+    return
+
 class BaseTask(ABC):
     """
     pass
@@ -61,7 +114,10 @@ class BaseTask(ABC):
         ds(int)               pixel grid size
         multi_scale (bool):   adjust (67%% - 150%%) imsz every 10 batches
         rect (bool):          rectangular training
-        cache_imgs (bool):    cache images for faster training
+        cache_imgs (bool|str): cache images for faster training, false/ram/disk
+        cache_dir (str):      directory of disk image caches
+        io_workers (int):     workers reading shapes, labels and cached images
+        io_processes (bool):  use processes instead of threads for io_workers
         weights (str):        initial weights path
         name (str):           renames results.txt to results_name.txt if supplied
         adam (bool):          use adam optimizer
@@ -139,11 +195,11 @@ class Trainer(BaseTask):
 
     """
 
-    def __init__(self):
-        """pass
+    def __init__(self, local_rank: int = 0):
+        """Builds the training of one process, of one rank if the default process group is initialized.
 
         Args:
-            pass
+            local_rank (int, optional): The rank of this process on its node, selects the GPU. Defaults: 0.
 
         Raises:
             pass
@@ -152,14 +208,24 @@ class Trainer(BaseTask):
             pass
         """
 
+        distributed_ready = distributed.is_available() and distributed.is_initialized()
+        self.rank = distributed.get_rank() if distributed_ready else 0
+        self.world_size = distributed.get_world_size() if distributed_ready else 1
+        if self.rank != 0:
+            log.set_verbosity(log.WARNING)
         self._load_options('config.yaml')
+        assert OPT['batch_size'] % self.world_size == 0, \
+            "batch_size {} is not a multiple of the {} ranks".format(OPT['batch_size'], self.world_size)
         OPT['device'] = torch.device(OPT['device'])
-        random.seed(OPT['seed'])
-        np.random.seed(OPT['seed'])
-        torch.manual_seed(OPT['seed'])
-        torch.cuda.manual_seed_all(OPT['seed'])
+        if OPT['device'].type == 'cuda' and self.world_size > 1:
+            OPT['device'] = torch.device('cuda', local_rank)
+        # Ranks augment differently, DistributedDataParallel broadcasts the weights of rank 0
+        random.seed(OPT['seed'] + self.rank)
+        np.random.seed(OPT['seed'] + self.rank)
+        torch.manual_seed(OPT['seed'] + self.rank)
+        torch.cuda.manual_seed_all(OPT['seed'] + self.rank)
         cudnn.benchmark = True
-        self.scaler = cuda.amp.GradScaler()
+        self.scaler = cuda.amp.GradScaler(enabled=OPT['device'].type == 'cuda')
         self.start_epoch = 0
         self.train_dataset, self.train_dataloader, self.val_dataloader, self.names, self.n_classes = \
             self._build_dataset()
@@ -174,14 +240,22 @@ class Trainer(BaseTask):
             log.info("Loaded `{}` pretrained model weights successfully.".format(OPT['pretrained']))
         else:
             print("Pretrained model weights not found.")
+        # self.model stays the bare Darknet for the loss, EMA, validation and checkpoints, only the forward is wrapped
+        self.train_model = self.model
+        if self.world_size > 1:
+            self.train_model = DistributedDataParallel(
+                self.model,
+                device_ids=[OPT['device']] if OPT['device'].type == 'cuda' else None
+            )
         self.scaheduler = self.define_scheduler(self.optimizer, self.start_epoch, OPT['epochs'])
+        # Only rank 0 logs and checkpoints
         self.tbw = SummaryWriter(
             os.path.join(
                 "logs", 
                 os.path.basename(OPT['net_cfg']).split('.')[0],
                 time.strftime("%Y%m%d%H%M%S", time.localtime())
             )
-        )
+        ) if self.rank == 0 else None
         log.info('Start Tensorboard with "tensorboard --logdir=logs", view at http://localhost:6006/')
         iouv = torch.linspace(0.5, 0.95, 10).to(OPT['device'])  # iou vector for mAP@0.5:0.95
         self.iouv = iouv[0].view(1)  # comment for mAP@0.5:0.95
@@ -208,42 +282,138 @@ class Trainer(BaseTask):
         log.info(OPT)
         return
 
-    def _build_dataset(self) -> tuple[Dataset, DataLoader, DataLoader, list, int]:
-        # Load dataset
-        dataset_dict = parse_dataset_config(OPT['data_cfg'])
-        n_classes = 1 if OPT['single_cls'] else int(dataset_dict["classes"])
-        names = dataset_dict["names"]
-        HYP["cls"] *= n_classes / 80
+    def _build_datasets(self, dataset_dict: dict) -> tuple[Dataset, Dataset]:
+        """pass
+
+        Args:
+            pass
+
+        Raises:
+            pass
+
+        Returns:
+            pass
+        """
+
+        if OPT.get('dataset_format', 'images') == 'shards':
+            assert not OPT['augment'] and not OPT['rect_label'], \
+                "Shards are pre-letterboxed, set augment and rect_label to false"
+            train_dataset = ShardDataset(
+                shard_directory(dataset_dict["train"], OPT['img_size_max']),
+                single_classes=OPT['single_cls'],
+                gray=OPT['gray']
+            )
+            val_dataset = ShardDataset(
+                shard_directory(dataset_dict["valid"], OPT['val_img_size']),
+                single_classes=OPT['single_cls'],
+                gray=OPT['gray']
+            )
+            return train_dataset, val_dataset
+
+        if OPT.get('dataset_format', 'images') == 'kitti':
+            assert not OPT['rect_label'], "KITTI ROIs are cropped on the fly, set rect_label to false"
+            # train and valid of the data config are KITTI roots, validation uses the unshifted ROIs only
+            classes = OPT.get('kitti_classes') or dataset_dict["names"]
+            train_dataset = KittiROIDataset(
+                dataset_dict["train"],
+                classes,
+                image_size=OPT['img_size_max'],
+                augment=OPT['augment'],
+                hyper_parameters_dict=HYP,
+                single_classes=OPT['single_cls'],
+                gray=OPT['gray']
+            )
+            val_dataset = KittiROIDataset(
+                dataset_dict["valid"],
+                classes,
+                image_size=OPT['val_img_size'],
+                single_classes=OPT['single_cls'],
+                gray=OPT['gray'],
+                shifts=False
+            )
+            return train_dataset, val_dataset
+
+        if OPT.get('dataset_format', 'images') == 'tars':
+            assert not OPT['rect_label'], "Tar shards are streamed, set rect_label to false"
+            train_dataset = TarShardDataset(
+                tar_directory(dataset_dict["train"]),
+                image_size=OPT['img_size_max'],
+                augment=OPT['augment'],
+                hyper_parameters_dict=HYP,
+                single_classes=OPT['single_cls'],
+                gray=OPT['gray'],
+                shuffle=True,
+                buffer_size=OPT.get('shuffle_buffer', 1000),
+                seed=OPT['seed']
+            )
+            # Only rank 0 validates, so it streams all validation shards instead of its share
+            val_dataset = TarShardDataset(
+                tar_directory(dataset_dict["valid"]),
+                image_size=OPT['val_img_size'],
+                single_classes=OPT['single_cls'],
+                gray=OPT['gray'],
+                rank=0,
+                world_size=1
+            )
+            return train_dataset, val_dataset
+
         train_dataset = LoadImagesAndLabels(
             path=dataset_dict["train"],
-            image_size=OPT['img_size'],
+            image_size=OPT['img_size_max'],
             batch_size=OPT['batch_size'],
             augment=OPT['augment'],
             hyper_parameters_dict=HYP,
             rect_label=OPT['rect_label'],
             cache_images=OPT['cache_imgs'],
             single_classes=OPT['single_cls'],
-            gray=OPT['gray']
+            gray=OPT['gray'],
+            cache_dir=OPT.get('cache_dir'),
+            num_io_workers=OPT.get('io_workers', 8),
+            io_processes=OPT.get('io_processes', False)
         )
         val_dataset = LoadImagesAndLabels(
             path=dataset_dict["valid"],
-            image_size=OPT['img_size'],
+            image_size=OPT['val_img_size'],
             batch_size=OPT['batch_size'],
             augment=OPT['augment'],
             hyper_parameters_dict=HYP,
             rect_label=OPT['rect_label'],
             cache_images=OPT['cache_imgs'],
             single_classes=OPT['single_cls'],
-            gray=OPT['gray']
+            gray=OPT['gray'],
+            cache_dir=OPT.get('cache_dir'),
+            num_io_workers=OPT.get('io_workers', 8),
+            io_processes=OPT.get('io_processes', False)
         )
+        return train_dataset, val_dataset
+
+    def _build_dataset(self) -> tuple[Dataset, DataLoader, DataLoader, list, int]:
+        # Load dataset
+        dataset_dict = parse_dataset_config(OPT['data_cfg'])
+        n_classes = 1 if OPT['single_cls'] else int(dataset_dict["classes"])
+        names = dataset_dict["names"]
+        HYP["cls"] *= n_classes / 80
+        train_dataset, val_dataset = self._build_datasets(dataset_dict)
+        # Streamed datasets shuffle themselves, and need fresh workers to see set_epoch
+        streamed = isinstance(train_dataset, TarShardDataset)
+        # KITTI ROIs of one frame are sampled together to share the decoded frame
+        if isinstance(train_dataset, KittiROIDataset):
+            sampler = FrameGroupedSampler(train_dataset, seed=OPT['seed'])
+        elif self.world_size > 1 and not streamed:
+            # Every rank reads batch_size / world_size images of each rectangular batch of the dataset
+            sampler = DistributedSampler(train_dataset, shuffle=not OPT['rect_label'], seed=OPT['seed'], drop_last=True)
+        else:
+            sampler = None
+        pin_memory = OPT['device'].type == 'cuda'
         train_dataloader = DataLoader(
             train_dataset,
-            batch_size=OPT['batch_size'],
-            shuffle=not OPT['rect_label'],
+            batch_size=OPT['batch_size'] // self.world_size,
+            shuffle=not OPT['rect_label'] and not streamed and sampler is None,
+            sampler=sampler,
             num_workers=OPT['n_workers'],
-            pin_memory=True,
+            pin_memory=pin_memory,
             drop_last=True,
-            persistent_workers=True,
+            persistent_workers=not streamed,
             collate_fn=train_dataset.collate_fn
         )
         val_dataloader = DataLoader(
@@ -251,7 +421,7 @@ class Trainer(BaseTask):
             batch_size=OPT['batch_size'],
             shuffle=False,
             num_workers=OPT['n_workers'],
-            pin_memory=True,
+            pin_memory=pin_memory,
             drop_last=False,
             persistent_workers=True,
             collate_fn=train_dataset.collate_fn
@@ -273,13 +443,23 @@ class Trainer(BaseTask):
 
         model = Darknet(
             OPT['net_cfg'], 
-            image_size=(OPT['img_size'], OPT['img_size']),
+            image_size=(OPT['val_img_size'], OPT['val_img_size']),
             gray=OPT['gray']
         )
         model = model.to(OPT['device'])
         model.num_classes = self.n_classes
         model.hyper_parameters_dict = HYP
         model.gr = 1.0
+        # Multi-scale training picks one multiple of 32 in [img_size_min, img_size_max] per batch
+        candidates = list(range(math.ceil(OPT['img_size_min'] / 32) * 32, OPT['img_size_max'] + 1, 32)) \
+            or [OPT['img_size_max']]
+        self.image_sizes = supported_image_sizes(model, candidates)
+        assert self.image_sizes, "{} supports none of the image sizes {}".format(OPT['net_cfg'], candidates)
+        if len(self.image_sizes) < len(candidates):
+            log.warning("Skipping the image sizes {} that {} does not support".format(
+                sorted(set(candidates) - set(self.image_sizes)), OPT['net_cfg']))
+        # Loss criteria and their constants live on the device for the whole training
+        self.criterion = ROIDepthLoss(HYP).to(OPT['device'])
         model.class_weights = labels_to_class_weights(
             self.train_dataset.labels,
             1 if OPT['single_cls'] else self.n_classes
@@ -330,7 +510,9 @@ class Trainer(BaseTask):
             iouv=self.iouv,
             niou=self.niou,
             verbose=OPT['verbose'],
-            device=OPT['device']
+            device=OPT['device'],
+            depth_bins=OPT.get('depth_range_bins', DEPTH_RANGE_BINS),
+            depth_scale=OPT.get('depth_scale', YRANGE)
         )
 
     def train(
@@ -366,62 +548,87 @@ class Trainer(BaseTask):
             [batch_time, data_time, giou_losses, obj_losses, cls_losses, dep_losses, losses],
             prefix=f"Epoch: [{epoch + 1}]"
         )
-        self.model.train()
+        self.train_model.train()
+        # Every rank draws the same sizes, images per second and number of images of every size
+        size_rng = np.random.default_rng([OPT['seed'], epoch])
+        throughput = {}
         end = time.time()
         accumulate = max(round(OPT['accumulate_batch_size'] / OPT['batch_size']), 1)
-        for batch_i, (imgs, targets, paths, _, roi) in enumerate(self.train_dataloader):
-            total_batch_i = batch_i + (batches * epoch) 
-            imgs = imgs.to(OPT['device']).float() / 255.0  
-            targets = targets.to(OPT['device'])
-            data_time.update(time.time() - end)
-            self.add_batch_sample_to_tb(imgs, targets, paths, 0) if total_batch_i==0 else None
-            if total_batch_i <= n_burn:
-                xi = [0, n_burn]
-                self.model.gr = np.interp(total_batch_i, xi, [0.0, 1.0])
-                for j, x in enumerate(self.optimizer.param_groups):
-                    # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
-                    lr_decay = \
-                        lambda lr: (((1 + math.cos(lr * math.pi / OPT['epochs'])) / 2) ** 1.0) * 0.95 + 0.05
-                    x['lr'] = np.interp(
-                        total_batch_i, xi, 
-                        [0.1 if j == 2 else 0.0, x.get('initial_lr') * lr_decay(epoch)]
-                    )
-                    x['weight_decay'] = np.interp(
-                        total_batch_i, xi, [0.0, OPT['optim_weight_decay'] if j == 1 else 0.0]
-                    )
-                    if 'momentum' in x:
-                        x['momentum'] = np.interp(total_batch_i, xi, [0.9, OPT['optim_momentum']])
-            self.model.zero_grad(set_to_none=True)
-            # Mixed precision training
-            with cuda.amp.autocast():
-                p, p_roidepth = self.model(imgs, roi)
-                loss, loss_item = compute_loss(p, p_roidepth, targets, self.model)
-                loss *= OPT['batch_size'] / OPT['accumulate_batch_size']
-            # Backpropagation
-            self.scaler.scale(loss).backward()
-            # update generator weights
-            if total_batch_i % accumulate == 0:
-                self.scaler.step(self.optimizer)
-                self.scaler.update()
-            self.ema_model.update_parameters(self.model)
-            # update looger
-            giou_losses.update(loss_item[0], imgs.size(0))
-            obj_losses.update(loss_item[1], imgs.size(0))
-            cls_losses.update(loss_item[2], imgs.size(0))
-            dep_losses.update(loss_item[3], imgs.size(0))
-            losses.update(loss_item[4], imgs.size(0))
-
-            batch_time.update(time.time() - end)
-            end = time.time()
-            # Record training log information
-            if batch_i % print_freq == 0:
-                # Writer Loss to file
-                self.tbw.add_scalar("Train/GIoULoss", loss_item[0], total_batch_i)
-                self.tbw.add_scalar("Train/ObjLoss", loss_item[1], total_batch_i)
-                self.tbw.add_scalar("Train/ClsLoss", loss_item[2], total_batch_i)
-                self.tbw.add_scalar("Train/DepLoss", loss_item[3], total_batch_i)
-                self.tbw.add_scalar("Train/Loss", loss_item[4], total_batch_i)
-                progress.display(batch_i)
+        # Streamed shards give the ranks uneven numbers of batches, ranks that run out shadow the gradient all-reduce
+        streamed = isinstance(self.train_dataset, TarShardDataset)
+        with self.train_model.join() if self.world_size > 1 and streamed else nullcontext():
+            for batch_i, (imgs, targets, paths, _, roi) in enumerate(self.train_dataloader):
+                total_batch_i = batch_i + (batches * epoch) 
+                imgs = imgs.to(OPT['device'], non_blocking=True).float() / 255.0
+                targets = targets.to(OPT['device'], non_blocking=True)
+                roi = roi.to(OPT['device'], non_blocking=True)
+                data_time.update(time.time() - end)
+                # Images are loaded at img_size_max and scaled down on the device, the labels are normalized
+                size = self.image_sizes[size_rng.integers(len(self.image_sizes))]
+                if size != OPT['img_size_max']:
+                    shape = [math.ceil(x * size / OPT['img_size_max'] / 32) * 32 for x in imgs.shape[2:]]
+                    imgs = F_torch.interpolate(imgs, size=shape, mode='bilinear', align_corners=False)
+                self.add_batch_sample_to_tb(imgs, targets, paths, 0) if total_batch_i==0 and self.tbw else None
+                if total_batch_i <= n_burn:
+                    xi = [0, n_burn]
+                    self.model.gr = np.interp(total_batch_i, xi, [0.0, 1.0])
+                    for j, x in enumerate(self.optimizer.param_groups):
+                        # bias lr falls from 0.1 to lr0, all other lrs rise from 0.0 to lr0
+                        lr_decay = \
+                            lambda lr: (((1 + math.cos(lr * math.pi / OPT['epochs'])) / 2) ** 1.0) * 0.95 + 0.05
+                        x['lr'] = np.interp(
+                            total_batch_i, xi, 
+                            [0.1 if j == 2 else 0.0, x.get('initial_lr') * lr_decay(epoch)]
+                        )
+                        x['weight_decay'] = np.interp(
+                            total_batch_i, xi, [0.0, OPT['optim_weight_decay'] if j == 1 else 0.0]
+                        )
+                        if 'momentum' in x:
+                            x['momentum'] = np.interp(total_batch_i, xi, [0.9, OPT['optim_momentum']])
+                self.model.zero_grad(set_to_none=True)
+                # Mixed precision training
+                with cuda.amp.autocast(enabled=OPT['device'].type == 'cuda'):
+                    p, p_roidepth = self.train_model(imgs, roi)
+                    loss, loss_item = self.criterion(p, p_roidepth, targets, self.model)
+                    loss *= OPT['batch_size'] / OPT['accumulate_batch_size']
+                # Backpropagation
+                self.scaler.scale(loss).backward()
+                # update generator weights
+                if total_batch_i % accumulate == 0:
+                    self.scaler.step(self.optimizer)
+                    self.scaler.update()
+                if self.rank == 0:
+                    self.ema_model.update_parameters(self.model)
+                # update looger
+                giou_losses.update(loss_item[0], imgs.size(0))
+                obj_losses.update(loss_item[1], imgs.size(0))
+                cls_losses.update(loss_item[2], imgs.size(0))
+                dep_losses.update(loss_item[3], imgs.size(0))
+                losses.update(loss_item[4], imgs.size(0))
+
+                batch_time.update(time.time() - end)
+                images, seconds = throughput.get(size, (0, 0.0))
+                throughput[size] = images + imgs.size(0), seconds + batch_time.val - data_time.val
+                end = time.time()
+                # Record training log information
+                if batch_i % print_freq == 0 and self.rank == 0:
+                    # Writer Loss to file
+                    self.tbw.add_scalar("Train/GIoULoss", loss_item[0], total_batch_i)
+                    self.tbw.add_scalar("Train/ObjLoss", loss_item[1], total_batch_i)
+                    self.tbw.add_scalar("Train/ClsLoss", loss_item[2], total_batch_i)
+                    self.tbw.add_scalar("Train/DepLoss", loss_item[3], total_batch_i)
+                    self.tbw.add_scalar("Train/Loss", loss_item[4], total_batch_i)
+                    progress.display(batch_i)
+        if self.world_size > 1:
+            for meter in [giou_losses, obj_losses, cls_losses, dep_losses, losses]:
+                meter.all_reduce(OPT['device'])
+        if self.rank == 0:
+            progress.display_summary()
+            for meter in [giou_losses, obj_losses, cls_losses, dep_losses, losses]:
+                self.tbw.add_scalar(f"Train/Epoch{meter.name}", meter.avg, epoch + 1)
+            for size, (images, seconds) in sorted(throughput.items()):
+                log.info("{0}x{0}: {1:.1f} images/s per rank over {2} images".format(size, images / seconds, images))
+                self.tbw.add_scalar(f"Train/ImagesPerSecond{size}", images / seconds, epoch + 1)
         return
 
     @timer("training")
@@ -441,26 +648,44 @@ class Trainer(BaseTask):
         best_map50 = 0.0
         n_batch = len(self.train_dataloader)
         log.info('Starting training for {} epochs...'.format(OPT['epochs']))
+        # Checkpoints are written in the background while the next epoch trains
+        checkpoint_writer = CheckpointWriter(self.tbw.get_logdir(), keep=OPT.get('keep_checkpoints', 5)) \
+            if self.rank == 0 else None
 
         for epoch in range(self.start_epoch, OPT['epochs']):
+            if isinstance(self.train_dataset, TarShardDataset):
+                self.train_dataset.set_epoch(epoch)
+            if isinstance(self.train_dataloader.sampler, (FrameGroupedSampler, DistributedSampler)):
+                self.train_dataloader.sampler.set_epoch(epoch)
             self.train(
                 epoch=epoch, 
                 batches=n_batch,
                 n_burn=max(3*n_batch, 500),
                 print_freq=305
             )
-            p, r, map50, f1, maps, dep_acc = self.validate()
+            self.scaheduler.step()
+            if self.rank != 0:
+                # Rank 0 validates and checkpoints while the other ranks wait
+                distributed.barrier()
+                continue
+            p, r, map50, f1, maps, dep_acc, depth_metrics = self.validate()
             self.tbw.add_scalar("Val/Precision", p, epoch + 1)
             self.tbw.add_scalar("Val/Recall", r, epoch + 1)
             self.tbw.add_scalar("Val/mAP0.5", map50, epoch + 1)
             self.tbw.add_scalar("Val/F1", f1, epoch + 1)
             self.tbw.add_scalar("Val/Acc@dep", dep_acc, epoch + 1)
-            self.scaheduler.step()
+            bins = depth_metrics["bins"]
+            for i in np.flatnonzero(depth_metrics["count"]):
+                depth_range = f"{bins[i]:g}-{bins[i + 1]:g}"
+                self.tbw.add_scalar(f"Val/DepthMAE/{depth_range}", depth_metrics["mae"][i], epoch + 1)
+                self.tbw.add_scalar(f"Val/DepthAccuracy/{depth_range}", depth_metrics["accuracy"][i], epoch + 1)
+                self.tbw.add_scalar(f"Val/DepthOneSigma/{depth_range}", depth_metrics["one_sigma"][i], epoch + 1)
+                self.tbw.add_scalar(f"Val/DepthTwoSigma/{depth_range}", depth_metrics["two_sigma"][i], epoch + 1)
             # Automatically save model weights
             is_best = map50 > best_map50
             is_last = (epoch + 1) == OPT['epochs']
             best_map50 = max(map50, best_map50)
-            save_torch_state_dict(
+            checkpoint_writer.save(
                 {
                     "epoch": epoch + 1,
                     "best_map50": best_map50,
@@ -469,13 +694,13 @@ class Trainer(BaseTask):
                     "optimizer": self.optimizer.state_dict()
                 },
                 f"epoch_{epoch + 1}.pth.tar",
-                self.tbw.get_logdir(),
-                self.tbw.get_logdir(),
-                "best.pth.tar",
-                "last.pth.tar",
                 is_best,
                 is_last
             )
+            if self.world_size > 1:
+                distributed.barrier()
+        if checkpoint_writer is not None:
+            checkpoint_writer.close()
         return
 
     def define_optimizer(self, model: nn.Module) -> optim.SGD:
@@ -601,6 +826,12 @@ class Tester(BaseTask):
 
     def _build_model(self) -> nn.Module:
         n_classes = 1 if OPT['single_cls'] else int(parse_dataset_config(OPT['data_cfg'])["classes"])
+        if OPT.get('fuse', True):
+            # The fused model is cached next to the weights
+            model = load_fused_darknet(OPT['net_cfg'], OPT['weights'], OPT['img_size'], OPT['gray']).to(OPT['device'])
+            model.num_classes = n_classes
+            log.info(f"Loaded `{OPT['weights']}` fused model successfully.")
+            return model
         model = Darknet(OPT['net_cfg'], image_size=OPT['img_size']).to(OPT['device'])
         model.num_classes = n_classes
         if OPT['weights'].endswith(".pth.tar"):
@@ -623,93 +854,73 @@ class Tester(BaseTask):
         iouv: torch.Tensor,
         niou: int,
         verbose: bool = False,
-        device: torch.device = torch.device("cpu")
+        device: torch.device = torch.device("cpu"),
+        depth_bins: tuple = DEPTH_RANGE_BINS,
+        depth_scale: float = YRANGE
     ):
         seen = 0
         model.eval()
         # Format print information
         s = ("%20s" + "%10s" * 7) % ("Class", "Images", "Targets", "P", "R", "mAP@0.5", "F1", "Acc@dep")
         p, r, f1, mp, mr, map50, mf1 = 0., 0., 0., 0., 0., 0., 0.
-        jdict, stats, ap, ap_class, dep_errs = [], [], [], [],[]
+        ap, ap_class = [], []
+        metrics = MetricAccumulator(niou, device)
         for _, (imgs, targets, _, _, roi) in enumerate(tqdm(test_dataloader, desc=s)):
-            imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
-            targets = targets.to(device)
+            imgs = imgs.to(device, non_blocking=True).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
+            targets = targets.to(device, non_blocking=True)
+            roi = roi.to(device, non_blocking=True)
             _, _, height, width = imgs.shape  # batch size, channels, height, width
             whwh = torch.Tensor([width, height, width, height]).to(device)
             with torch.no_grad():
                 output, _, depth_output = model(imgs, roi)  # inference and training outputs
                 output = non_max_suppression(output, conf_threshold, iou_threshold)
-            # Statistics per image
-            for si, pred in enumerate(zip(output, depth_output)):
-                pred_obj, pred_dep = pred
-                labels = targets[targets[:, 0] == si, 1:]
-                n_labels = len(labels)
-                target_classes = labels[:, 0].tolist() if n_labels else []  # target class
-                seen += 1
-                if pred_obj is None:
-                    if n_labels:
-                        stats.append(
-                            (
-                                torch.zeros(0, niou, dtype=torch.bool),
-                                torch.Tensor(),
-                                torch.Tensor(),
-                                target_classes
-                            )
-                        )
-                    continue
-                # Clip boxes to image bounds
-                clip_coords(pred_obj, (height, width))
-                # Assign all predictions as incorrect
-                correct = torch.zeros(pred_obj.shape[0], niou, dtype=torch.bool, device=device)
-                if n_labels:
-                    detected = []  # target indices
-                    target_classes_tensor = labels[:, 0]
-                    # target boxes
-                    tbox = xywh2xyxy(labels[:, 1:5]) * whwh
-                    # Per target class
-                    for cls in torch.unique(target_classes_tensor):
-                        ti = (cls == target_classes_tensor).nonzero().view(-1)  # target indices
-                        pi = (cls == pred_obj[:, 5]).nonzero().view(-1)  # prediction indices
-                        # Search for detections
-                        if pi.shape[0]:
-                            # Prediction to target ious
-                            ious, i = boxes.box_iou(pred_obj[pi, :4], tbox[ti]).max(1)  # best ious, indices
-                            # Append detections
-                            for j in (ious > iouv[0]).nonzero():
-                                d = ti[i[j]]  # detected target
-                                if d not in detected:
-                                    detected.append(d)
-                                    correct[pi[j]] = ious[j] > iouv
-                                    if len(detected) == n_labels:  # all targets already located in image
-                                        break
-                dep_err = abs(labels[:, 5] - pred_dep).cpu()
-                dep_errs.append(dep_err)
-                # Append statistics (correct, conf, pcls, target_classes)
-                stats.append((correct.cpu(), pred_obj[:, 4].cpu(), pred_obj[:, 5].cpu(), target_classes))
+            seen += len(output)
+            # Match the detections of the whole batch to its targets at once
+            detections = [pred_obj for pred_obj in output if pred_obj is not None]
+            detections = torch.cat(detections) if detections else torch.zeros(0, 6, device=device)
+            counts = torch.tensor([0 if pred_obj is None else pred_obj.shape[0] for pred_obj in output], device=device)
+            detection_images = torch.arange(len(output), device=device).repeat_interleave(counts)
+            # Clip boxes to image bounds
+            clip_coords(detections, (height, width))
+            correct = match_predictions(detections, detection_images, xywh2xyxy(targets[:, 2:6]) * whwh,
+                                        targets[:, 1], targets[:, 0], iouv)
+            # Depth of the first target of every image with targets and detections
+            first_targets = torch.full_like(counts, targets.shape[0]).scatter_reduce_(
+                0, targets[:, 0].long(), torch.arange(targets.shape[0], device=device), "amin")
+            has_depth = (first_targets < targets.shape[0]) & (counts > 0)
+            metrics.update(correct, detections[:, 4], detections[:, 5], targets[:, 1],
+                           targets[first_targets[has_depth], 6], depth_output.view(len(output), -1)[has_depth, 0])
         # Compute statistics
-        stats = [np.concatenate(x, 0) for x in zip(*stats)]  # to numpy
-        if len(stats):
-            p, r, ap, f1, ap_class = ap_per_class(*stats)
+        if metrics.num_detections or metrics.num_targets:
+            p, r, ap, f1, ap_class = metrics.ap_per_class()
             if niou > 1:
                 p, r, ap, f1 = p[:, 0], r[:, 0], ap.mean(1), ap[:, 0]  # [P, R, AP@0.5:0.95, AP@0.5]
             mp, mr, map50, mf1 = p.mean(), r.mean(), ap.mean(), f1.mean()
-            nt = np.bincount(stats[3].astype(np.int64), minlength=model.num_classes)  # number of targets per class
+            nt = metrics.targets_per_class(model.num_classes)  # number of targets per class
         else:
             nt = torch.zeros(1)
-        # dep_acc = np.mean([e[0] for e in dep_errs]) if len(dep_errs)!=0 else 0
-        dep_acc = np.mean([e[0] for e in dep_errs])
+        dep_acc = metrics.depth_accuracy()
+        target_depths, pred_depths = metrics.depths()
+        depth_metrics = depth_range_metrics(target_depths * depth_scale, pred_depths * depth_scale, depth_bins)
         # Print results
         pf = "%20s" + "%10.3g" * 7  # print format
         print(pf % ("all", seen, nt.sum(), mp, mr, map50, mf1, dep_acc))
+        # Print depth results per range
+        print(("%20s" + "%10s" * 5) % ("Depth range", "Targets", "MAE", "Acc@dep", "1 sigma", "2 sigma"))
+        for i, count in enumerate(depth_metrics["count"]):
+            if count:
+                print(("%20s" + "%10d" + "%10.3g" * 4) % (
+                    f"{depth_metrics['bins'][i]:g}-{depth_metrics['bins'][i + 1]:g}", count, depth_metrics["mae"][i],
+                    depth_metrics["accuracy"][i], depth_metrics["one_sigma"][i], depth_metrics["two_sigma"][i]))
         # Print results per class
-        if verbose and model.num_classes > 1 and len(stats):
+        if verbose and model.num_classes > 1 and len(ap_class):
             for i, c in enumerate(ap_class):
                 print(pf % (names[c], seen, nt[c], p[i], r[i], ap[i], f1[i]))
         # Return results
         maps = np.zeros(model.num_classes) + map50
         for ap_index, c in enumerate(ap_class):
             maps[c] = ap[ap_index]
-        return mp, mr, map50, mf1, maps, dep_acc
+        return mp, mr, map50, mf1, maps, dep_acc, depth_metrics
 
     def go(self):
         """pass
@@ -782,6 +993,7 @@ class Detector(BaseTask):
             iou_threshold=OPT['iou_threshold'],
             filter_classes=OPT['filter_classes'],
             agnostic_nms=OPT['agnostic_nms'],
+            roi=OPT.get('roi'),
             device=OPT['device']
         )
         return
@@ -833,6 +1045,16 @@ class Detector(BaseTask):
             model (nn.Module): YOLO model
 
         """
+        if OPT['fuse']:
+            # The fused model is cached next to the weights
+            model = load_fused_darknet(
+                OPT['net_cfg'],
+                OPT['weights'],
+                image_size=(OPT['img_size'], OPT['img_size']),
+                gray=OPT['gray']
+            )
+            log.info(f"Loaded `{OPT['weights']}` fused model successfully.")
+            return model.to(device=OPT['device'])
         model = Darknet(
             OPT['net_cfg'], 
             image_size=(OPT['img_size'], OPT['img_size']),
@@ -847,7 +1069,6 @@ class Detector(BaseTask):
             raise "The model weights path is not correct."
         log.info(f"Loaded `{OPT['weights']}` pretrained model weights successfully.")
         model = model.to(device=OPT['device'])
-        model.fuse() if OPT['fuse'] else None 
         return model
 
 
@@ -867,6 +1088,7 @@ class Detector(BaseTask):
         augment: bool = False,
         filter_classes: list[int] = None,
         agnostic_nms: bool = False,
+        roi: list[float] = None,
         device: torch.device = torch.device("cpu"),
     ) -> None:
         """Detect
@@ -886,6 +1108,8 @@ class Detector(BaseTask):
             augment (bool, optional): Whether to use data augmentation. Default: ``False``.
             filter_classes (list[int], optional): Filter classes. Default: ``None``.
             agnostic_nms (bool, optional): Whether to use agnostic nms. Default: ``False``.
+            roi (list[float], optional): ROI info (x, y, w, h) fed to the model for every frame, e.g.
+                ``[0.5, 0.5, 1, 1]`` for the full frame. Default: ``None``, the model gets no ROI.
             device (torch.device, optional): Model processing equipment. Default: ``torch.device("cpu")``.
 
         Returns:
@@ -893,14 +1117,16 @@ class Detector(BaseTask):
 
         """
         model.eval()
+        if roi is not None:
+            roi = torch.tensor([roi], dtype=torch.float32, device=device)
         for input_path, image, raw_image, video_capture in dataset:
-            image = image.to(device).float()
+            image = image.to(device, non_blocking=True).float()
             # image = image.float()
             image /= 255.0
             if image.ndimension() == 3:
                 image = image.unsqueeze(0)
             with torch.no_grad():
-                output = model(image)[0]
+                output = model(image, None if roi is None else roi.expand(image.shape[0], 4))[0]
             output = non_max_suppression(
                 output, conf_threshold, iou_threshold,
                 False, filter_classes, agnostic_nms
@@ -950,7 +1176,8 @@ class Detector(BaseTask):
         return
 
 if __name__=="__main__":
-    # task = Trainer()
+    # launch_training()
+    # exit(0)
     task = Detector()
     task.go()
     exit(0)
\ No newline at end of file
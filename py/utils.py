@@ -15,10 +15,11 @@ import math
 import os
 import random
 import shutil
-import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import Enum
 from pathlib import Path
-from typing import Optional
+from typing import Any, Optional, Tuple
 
 import cv2
 import matplotlib.pyplot as plt
@@ -26,15 +27,15 @@ import numpy as np
 import torch
 import torchvision.ops
 from numpy import ndarray
-from torch import nn, optim, Tensor
+from torch import distributed, nn, optim, Tensor
 
 __all__ = [
     "load_classes",
     "load_torch_state_dict", "load_pretrained_torch_state_dict", "load_resume_torch_state_dict",
-    "load_pretrained_darknet_state_dict", "save_torch_state_dict", "save_darknet_state_dict",
+    "load_pretrained_darknet_state_dict", "save_torch_state_dict", "CheckpointWriter", "save_darknet_state_dict",
     "ap_per_class", "clip_coords", "coco80_to_coco91_class", "compute_ap", "make_directory", "make_divisible",
-    "non_max_suppression", "plot_one_box", "plot_images", "scale_coords", "xywh2xyxy", "xyxy2xywh",
-    "Summary", "AverageMeter", "ProgressMeter",
+    "match_predictions", "non_max_suppression", "plot_one_box", "plot_images", "scale_coords", "xywh2xyxy", "xyxy2xywh",
+    "Summary", "AverageMeter", "MetricAccumulator", "ProgressMeter",
 ]
 
 
@@ -162,6 +163,108 @@ def save_torch_state_dict(
         shutil.copyfile(checkpoint_path, os.path.join(results_dir, last_file_name))
 
 
+def _snapshot_to_cpu(state: Any) -> Any:
+    """Returns a copy of a (nested) state dict with every tensor copied to the CPU, safe from later in-place updates."""
+    if isinstance(state, Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return type(state)((k, _snapshot_to_cpu(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(_snapshot_to_cpu(v) for v in state)
+
+    return state
+
+
+def _replace_with_link(source: str, destination: str) -> None:
+    """Atomically points destination at the file source, with a hard link or a copy where links are unsupported."""
+    temporary_path = destination + ".tmp"
+    if os.path.lexists(temporary_path):
+        os.remove(temporary_path)
+    try:
+        os.link(source, temporary_path)
+    except OSError:
+        shutil.copyfile(source, temporary_path)
+    os.replace(temporary_path, destination)
+
+
+class CheckpointWriter(object):
+    def __init__(
+            self,
+            checkpoint_dir: str,
+            keep: int = 5,
+            best_file_name: str = "best.pth.tar",
+            last_file_name: str = "last.pth.tar",
+    ) -> None:
+        """Saves checkpoints on a background thread, so that training continues right after the state is copied.
+
+        Every checkpoint is written to a temporary file and renamed, so a crash never leaves a truncated file behind.
+        The best and last checkpoints are hard links to the epoch checkpoint, and only the newest keep epoch
+        checkpoints are kept. At most one checkpoint is written at a time, `save` waits for the previous one.
+
+        Args:
+            checkpoint_dir (str): The directory of the checkpoints.
+            keep (int, optional): Number of epoch checkpoints kept, all if 0. Best and last are always kept.
+                Defaults: 5.
+            best_file_name (str, optional): File name of the best checkpoint. Defaults: ``best.pth.tar``.
+            last_file_name (str, optional): File name of the last checkpoint. Defaults: ``last.pth.tar``.
+
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.best_file_name = best_file_name
+        self.last_file_name = last_file_name
+        self.saved_files = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self.pending = None
+
+    def save(self, state_dict: dict, file_name: str, is_best: bool = False, is_last: bool = False) -> Future:
+        """Copies the state to the CPU and writes it in the background.
+
+        Args:
+            state_dict (dict): The checkpoint, tensors may live on any device.
+            file_name (str): File name of the checkpoint in checkpoint_dir.
+            is_best (bool, optional): Whether to link it as the best checkpoint. Defaults: ``False``.
+            is_last (bool, optional): Whether to link it as the last checkpoint. Defaults: ``False``.
+
+        Returns:
+            future (Future): Done when the checkpoint is written, raises the error of the write if it failed.
+
+        """
+        snapshot = _snapshot_to_cpu(state_dict)
+        self.wait()
+        self.pending = self.executor.submit(self._write, snapshot, file_name, is_best, is_last)
+
+        return self.pending
+
+    def _write(self, state_dict: dict, file_name: str, is_best: bool, is_last: bool) -> None:
+        checkpoint_path = os.path.join(self.checkpoint_dir, file_name)
+        torch.save(state_dict, checkpoint_path + ".tmp")
+        os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+        if is_best:
+            _replace_with_link(checkpoint_path, os.path.join(self.checkpoint_dir, self.best_file_name))
+        if is_last:
+            _replace_with_link(checkpoint_path, os.path.join(self.checkpoint_dir, self.last_file_name))
+
+        if checkpoint_path not in self.saved_files:
+            self.saved_files.append(checkpoint_path)
+        while 0 < self.keep < len(self.saved_files):
+            os.remove(self.saved_files.popleft())  # best and last keep their own links
+
+    def wait(self) -> None:
+        """Blocks until the pending checkpoint is written, raises the error of the write if it failed."""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self) -> None:
+        """Waits for the pending checkpoint and stops the background thread."""
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+
+
 def save_darknet_state_dict(self, model_weights_path: str, cutoff=-1) -> None:
     """Saves model weights to a file.
 
@@ -193,9 +296,32 @@ def save_darknet_state_dict(self, model_weights_path: str, cutoff=-1) -> None:
                 conv_layer.weight.data.cpu().numpy().tofile(f)
 
 
+def _interp_inner(x, x0: ndarray, x1: ndarray, y0: ndarray, y1: ndarray) -> ndarray:
+    """`np.interp` of x between the points (x0, y0) and (x1, y1) with x0 <= x < x1, with the same arithmetic.
+
+    Args:
+        x: x-coordinates to evaluate.
+        x0 (ndarray): x-coordinates of the points left of x.
+        x1 (ndarray): x-coordinates of the points right of x.
+        y0 (ndarray): y-coordinates of the points left of x.
+        y1 (ndarray): y-coordinates of the points right of x.
+
+    Returns:
+        y (ndarray): The interpolated values.
+
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):  # x0 == x1 outside the points, replaced by the callers
+        slope = (y1 - y0) / (x1 - x0)
+    return np.where(x0 == x, y0, slope * (x - x0) + y0)
+
+
 def ap_per_class(tp, conf, pred_cls, target_cls):
     """
     Computes the average precision, given the recall and precision curves.
+
+    The curves of all classes and IoU thresholds are computed at once as segments of flat arrays, every value matches
+    the per-class `compute_ap` loop exactly.
+
     Args:
         tp:True positives (list).
         conf: Objectness value from 0-1 (list).
@@ -211,35 +337,74 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
     tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
 
     # Find unique classes
-    unique_classes = np.unique(target_cls)
+    unique_classes, n_gt = np.unique(target_cls, return_counts=True)  # number of ground truth objects
 
     # Create Precision-Recall curve and compute AP for each class
     pr_score = 0.1  # score to evaluate P and R https://github.com/ultralytics/yolov3/issues/898
     s = [unique_classes.shape[0], tp.shape[1]]  # number class, number iou thresholds (i.e. 10 for mAP0.5...0.95)
     ap, p, r = np.zeros(s), np.zeros(s), np.zeros(s)
-    for ci, c in enumerate(unique_classes):
-        i = pred_cls == c
-        n_gt = (target_cls == c).sum()  # Number of ground truth objects
-        n_p = i.sum()  # Number of predicted objects
-
-        if n_p == 0 or n_gt == 0:
-            continue
-        else:
-            # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum(0)
-            tpc = tp[i].cumsum(0)
 
-            # Recall
-            recall = tpc / (n_gt + 1e-16)  # recall curve
-            r[ci] = np.interp(-pr_score, -conf[i], recall[:, 0])  # r at pr_score, negative x, xp because xp decreases
-
-            # Precision
-            precision = tpc / (tpc + fpc)  # precision curve
-            p[ci] = np.interp(-pr_score, -conf[i], precision[:, 0])  # p at pr_score
-
-            # AP from recall-precision curve
-            for j in range(tp.shape[1]):
-                ap[ci, j] = compute_ap(recall[:, j], precision[:, j])
+    # Predictions of the target classes grouped by class, in the objectness order within every class
+    ci = np.searchsorted(unique_classes, pred_cls).clip(0, max(unique_classes.shape[0] - 1, 0))
+    i = np.flatnonzero(unique_classes[ci] == pred_cls) if unique_classes.shape[0] else np.zeros(0, dtype=np.int64)
+    i = i[np.argsort(ci[i], kind="stable")]
+    if i.shape[0] == 0:
+        return p, r, ap, 2 * p * r / (p + r + 1e-16), unique_classes.astype('int32')
+    tp, conf, ci = tp[i], conf[i], ci[i]
+    n_p = np.bincount(ci)  # number of predicted objects
+    classes = np.flatnonzero(n_p)
+    n_p = n_p[classes]
+    ends = n_p.cumsum() - 1
+    starts = ends - n_p + 1
+    segments = np.repeat(np.arange(classes.shape[0]), n_p)  # class segment of every prediction
+
+    # Accumulate TPs, one row per IoU threshold and restarting at every class, the FPs are the remaining predictions
+    tpc = np.ascontiguousarray(tp.T).cumsum(1)
+    tpc -= np.concatenate((np.zeros((tpc.shape[0], 1), dtype=tpc.dtype), tpc[:, starts[1:] - 1]), 1)[:, segments]
+    n_seen = np.arange(1, ci.shape[0] + 1) - starts[segments]  # tpc + fpc
+
+    # Recall
+    recall = tpc / (n_gt[ci] + 1e-16)  # recall curve
+
+    # Precision
+    precision = tpc / n_seen  # precision curve
+
+    # r and p at pr_score, negative x, xp because xp decreases, j is the last prediction with -conf <= -pr_score
+    xp = -conf.astype(np.float64)
+    j = starts + np.bincount(segments[xp <= -pr_score], minlength=classes.shape[0]) - 1
+    inner = (j >= starts) & (j < ends)
+    k0, k1 = np.where(inner, j, starts), np.where(inner, j + 1, starts)
+    for value, curve in ((r, recall[0]), (p, precision[0])):
+        value[classes] = np.where(inner, _interp_inner(-pr_score, xp[k0], xp[k1], curve[k0], curve[k1]),
+                                  np.where(j < starts, curve[starts], curve[ends]))[:, None]
+
+    # AP from recall-precision curves, one curve per IoU threshold and class laid out one after another, with the
+    # sentinel values of `compute_ap` at both ends, and one spare value for the last `np.maximum.reduceat` block
+    num_curves, stride = tp.shape[1] * classes.shape[0], ci.shape[0] + 2 * classes.shape[0]
+    heads = (stride * np.arange(tp.shape[1])[:, None] + starts + 2 * np.arange(classes.shape[0])).ravel()
+    tails = heads + np.tile(n_p + 1, tp.shape[1])
+    mrec, mpre = np.zeros(num_curves * 2 + tpc.size + 1), np.zeros(num_curves * 2 + tpc.size + 1)
+    points = np.arange(ci.shape[0]) + 2 * segments + 1
+    mrec[:-1].reshape(tp.shape[1], stride)[:, points] = recall
+    mpre[:-1].reshape(tp.shape[1], stride)[:, points] = precision
+    mrec[tails] = np.minimum(recall[:, ends].ravel() + 1E-3, 1.)
+
+    # 101-point interp (COCO), j is the last point of the curve with mrec <= x, found by bisection of all curves
+    x = np.linspace(0, 1, 101)
+    j, j1 = np.repeat(heads[:, None], x.shape[0], 1), np.repeat(tails[:, None] + 1, x.shape[0], 1)
+    for _ in range(int(n_p.max() + 2).bit_length()):
+        mid = (j + j1) // 2
+        right = mrec[mid] <= x
+        j, j1 = np.where(right, mid, j), np.where(right, j1, mid)
+    j1 = np.minimum(j + 1, tails[:, None])
+
+    # Precision envelope at j1, the maximum of every block between j1 values, then accumulated from the tail
+    blocks = np.concatenate((j1, tails[:, None] + 1), 1).ravel()
+    envelope = np.maximum.reduceat(mpre, blocks).reshape(num_curves, -1)[:, :-1]
+    envelope1 = np.maximum.accumulate(envelope[:, ::-1], 1)[:, ::-1]
+    envelope0 = np.maximum(mpre[j], envelope1)
+    y = np.where(j < tails[:, None], _interp_inner(x, mrec[j], mrec[j1], envelope0, envelope1), envelope0)
+    ap[classes] = np.trapz(y, x, axis=1).reshape(tp.shape[1], classes.shape[0]).T  # integrate
 
     # Compute F1 score (harmonic mean of precision and recall)
     f1 = 2 * p * r / (p + r + 1e-16)
@@ -247,6 +412,76 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
     return p, r, ap, f1, unique_classes.astype('int32')
 
 
+def match_predictions(
+        detections: Tensor,
+        detection_images: Tensor,
+        target_boxes: Tensor,
+        target_classes: Tensor,
+        target_images: Tensor,
+        iouv: Tensor,
+) -> Tensor:
+    """Greedily matches the detections of a whole batch to its targets with tensor operations.
+
+    Every detection is compared with the targets of its own image and class and keeps its best IoU target. Going down
+    in confidence, the first detection above ``iouv[0]`` takes that target, later detections of the same target are
+    false positives. This is the per image, per class and per detection loop of the former `Tester.test`, with the
+    same results, without a Python iteration or a device synchronization per detection.
+
+    Args:
+        detections (Tensor): xyxy, conf, cls detections with shape (n, 6), in descending confidence within every
+            image, the order of `non_max_suppression`.
+        detection_images (Tensor): Image index of every detection, shape (n,).
+        target_boxes (Tensor): xyxy target boxes in the coordinates of the detections, shape (m, 4).
+        target_classes (Tensor): Target classes, shape (m,).
+        target_images (Tensor): Image index of every target, shape (m,).
+        iouv (Tensor): Ascending IoU thresholds, shape (niou,).
+
+    Returns:
+        correct (Tensor): True positives at every IoU threshold, bool with shape (n, niou).
+
+    """
+    correct = torch.zeros(detections.shape[0], iouv.numel(), dtype=torch.bool, device=detections.device)
+    if not detections.shape[0] or not target_boxes.shape[0]:
+        return correct
+
+    # Only the (detection, target) pairs of the same image and class are compared, not a dense IoU matrix
+    images = torch.cat((detection_images, target_images)).long()
+    classes = torch.cat((detections[:, 5], target_classes)).long()
+    _, groups = torch.unique(images * (int(classes.max()) + 1) + classes, return_inverse=True)
+    detection_groups, target_groups = groups[:detections.shape[0]], groups[detections.shape[0]:]
+    members = torch.sort(target_groups, stable=True).indices  # targets of a group stay in their order
+    group_counts = torch.bincount(target_groups, minlength=int(groups.max()) + 1)
+    group_starts = group_counts.cumsum(0) - group_counts
+    pairs = group_counts[detection_groups]
+    pair_detection = torch.repeat_interleave(torch.arange(detections.shape[0], device=detections.device), pairs)
+    pair_offsets = torch.arange(pair_detection.shape[0], device=detections.device) - \
+        torch.repeat_interleave(pairs.cumsum(0) - pairs, pairs)
+    pair_target = members[group_starts[detection_groups][pair_detection] + pair_offsets]
+
+    # Element-wise IoU of the pairs, as `torchvision.ops.box_iou` computes it
+    box1, box2 = detections[pair_detection, :4], target_boxes[pair_target]
+    inter = (torch.min(box1[:, 2:], box2[:, 2:]) - torch.max(box1[:, :2], box2[:, :2])).clamp(0).prod(1)
+    area1 = (box1[:, 2] - box1[:, 0]) * (box1[:, 3] - box1[:, 1])
+    area2 = (box2[:, 2] - box2[:, 0]) * (box2[:, 3] - box2[:, 1])
+    pair_ious = inter / (area1 + area2 - inter)
+
+    # Best target of every detection, the first one on ties
+    ious = pair_ious.new_full((detections.shape[0],), -1.0).scatter_reduce_(0, pair_detection, pair_ious, "amax")
+    best = torch.full_like(detection_groups, target_boxes.shape[0])
+    is_best = pair_ious == ious[pair_detection]
+    best.scatter_reduce_(0, pair_detection[is_best], pair_target[is_best], "amin")
+
+    # Candidates are in confidence order within every image, the first candidate of every target takes it
+    candidates = (ious > iouv[0]).nonzero().view(-1)
+    hit, order = best[candidates].sort(stable=True)
+    first = torch.ones_like(hit, dtype=torch.bool)
+    first[1:] = hit[1:] != hit[:-1]
+    matched = candidates[order[first]]
+    correct[matched] = ious[matched, None] > iouv
+
+    return correct
+
+
 def clip_coords(boxes: Tensor, image_shape: tuple) -> Tensor:
     """Clip bounding xyxy bounding boxes to image shape (height, width)
 
@@ -326,79 +561,148 @@ def non_max_suppression(prediction: Tensor,
                         iou_threshold: float = 0.6,
                         multi_label: bool = True,
                         filter_classes: list = None,
-                        agnostic: bool = False):
+                        agnostic: bool = False,
+                        merge: bool = False,
+                        max_candidates: int = 30000):
     """
-    Performs Non-Maximum Suppression (NMS) on inference results
+    Performs Non-Maximum Suppression (NMS) on inference results of a whole batch at once
+
+    The boxes of all images are filtered together and the most confident max_candidates boxes of every image are kept.
+    Boxes are suppressed within every (image, class) group by one `batched_nms` call on GPUs and by one `nms` call
+    per image on the CPU, whose kernel compares all boxes of a call with each other.
+
     Args:
-        prediction (Tensor): model output
+        prediction (Tensor): model output with shape (B, N, 5 + classes), xywh, objectness and class probabilities
         conf_threshold (float): confidence threshold
         iou_threshold (float): IoU threshold for NMS
         multi_label (bool): allow multiple labels per box
         filter_classes (list): filter by class: --class 0, or --class 0 2 3
         agnostic (bool): class-agnostic NMS
+        merge (bool): replace every kept box by the confidence-weighted mean of the boxes it overlaps, changes the
+            boxes and so the mAP compared with plain NMS
+        max_candidates (int): most confident boxes of every image passed to NMS, all if 0
 
     Returns:
-        list: Returns detections with shape:
+        list: Detections (n, 6) of every image, xyxy, confidence and class, ``None`` if an image has none
 
     """
     # Settings
-    merge = True  # merge for best mAP
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
-    time_limit = 10.0  # seconds to quit after
+    merge_max_candidates = 3000  # merge the boxes of images with fewer candidates only
 
-    t = time.time()
-    nc = prediction[0].shape[1] - 5  # number of classes
+    batch_size = prediction.shape[0]
+    nc = prediction.shape[2] - 5  # number of classes
     multi_label &= nc > 1  # multiple labels per box
-    output = [None] * prediction.shape[0]
-    for xi, x in enumerate(prediction):  # image index, image inference
-        # Apply constraints
-        x = x[x[:, 4] > conf_threshold]  # confidence
-        x = x[((x[:, 2:4] > min_wh) & (x[:, 2:4] < max_wh)).all(1)]  # width-height
-
-        # If none remain process next image
-        if not x.shape[0]:
-            continue
-
-        # Compute conf
-        x[..., 5:] *= x[..., 4:5]  # conf = obj_conf * cls_conf
-
-        # Box (center x, center y, width, height) to (x1, y1, x2, y2)
-        box = xywh2xyxy(x[:, :4])
-
-        # Detections matrix nx6 (xyxy, conf, cls)
-        if multi_label:
-            i, j = (x[:, 5:] > conf_threshold).nonzero().t()
-            x = torch.cat((box[i], x[i, j + 5].unsqueeze(1), j.float().unsqueeze(1)), 1)
-        else:  # best class only
-            conf, j = x[:, 5:].max(1)
-            x = torch.cat((box, conf.unsqueeze(1), j.float().unsqueeze(1)), 1)[conf > conf_threshold]
-
-        # Filter by class
-        if filter_classes:
-            x = x[(j.view(-1, 1) == torch.tensor(filter_classes, device=j.device)).any(1)]
-
-        # If none remain process next image
-        n = x.shape[0]  # number of boxes
-        if not n:
-            continue
-
-        # Batched NMS
-        c = x[:, 5] * 0 if agnostic else x[:, 5]  # classes
-        boxes, scores = x[:, :4].clone() + c.view(-1, 1) * max_wh, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.boxes.nms(boxes, scores, iou_threshold)
-        if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
-            try:  # update boxes as boxes(i,4) = weights(i,n) * boxes(n,4)
-                iou = boxes.box_iou(boxes[i], boxes) > iou_threshold  # iou matrix
-                weights = iou * scores[None]  # box weights
-                x[i, :4] = torch.mm(weights, x[:, :4]).float() / weights.sum(1, keepdim=True)  # merged boxes
-            except:
-                pass
-
-        output[xi] = x[i]
-        if (time.time() - t) > time_limit:
-            break  # time limit exceeded
-
-    return output
+
+    # Apply constraints, image is the image index of every remaining box
+    wh = prediction[..., 2:4]
+    keep = (prediction[..., 4] > conf_threshold) & ((wh > min_wh) & (wh < max_wh)).all(2)
+    image, index = keep.nonzero(as_tuple=True)
+    x = prediction[image, index]
+
+    # Compute conf = obj_conf * cls_conf
+    scores = x[:, 5:] * x[:, 4:5]
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Candidates (xyxy, conf, cls) of the whole batch
+    if multi_label:
+        i, j = (scores > conf_threshold).nonzero(as_tuple=True)
+        box, conf, image = box[i], scores[i, j], image[i]
+    else:  # best class only
+        conf, j = scores.max(1)
+        keep = conf > conf_threshold
+        box, conf, j, image = box[keep], conf[keep], j[keep], image[keep]
+
+    # Filter by class
+    if filter_classes:
+        keep = (j.view(-1, 1) == torch.tensor(filter_classes, device=j.device)).any(1)
+        box, conf, j, image = box[keep], conf[keep], j[keep], image[keep]
+
+    # Keep the most confident candidates of every image
+    counts = torch.bincount(image, minlength=batch_size)
+    if max_candidates and bool((counts > max_candidates).any()):
+        order = torch.sort(conf, descending=True, stable=True).indices
+        order = order[torch.sort(image[order], stable=True).indices]  # by image, then by confidence
+        starts = counts.cumsum(0) - counts
+        keep = order[torch.arange(order.shape[0], device=order.device) - starts[image[order]] < max_candidates]
+        keep = torch.sort(keep).values
+        box, conf, j, image = box[keep], conf[keep], j[keep], image[keep]
+        counts = torch.bincount(image, minlength=batch_size)
+
+    # If none remain return
+    if not box.shape[0]:
+        return [None] * batch_size
+
+    # Batched NMS over (image, class) groups
+    group = image if agnostic else image * nc + j
+    if box.device.type == "cpu":
+        # The candidates of every image are contiguous, the boxes of every class are offset to not overlap others
+        boxes = box if agnostic else box + j[:, None] * max_wh
+        i = torch.cat([x[torchvision.ops.nms(boxes[x], conf[x], iou_threshold)]
+                       for x in torch.arange(box.shape[0], device=box.device).split(counts.tolist()) if x.shape[0]])
+    else:
+        i = torchvision.ops.batched_nms(box, conf, group, iou_threshold)
+
+    # Merge NMS (boxes merged using weighted mean)
+    if merge:
+        merged = i[(counts[image[i]] > 1) & (counts[image[i]] < merge_max_candidates)]
+        if merged.shape[0]:
+            box[merged] = _merge_boxes(box, conf, group, merged, iou_threshold)
+
+    # Split the detections by image, in descending confidence within every image
+    i = i[torch.sort(image[i], stable=True).indices]
+    detections = torch.cat((box[i], conf[i, None], j[i, None].float()), 1)
+    detections = detections.split(torch.bincount(image[i], minlength=batch_size).tolist())
+
+    return [x if x.shape[0] else None for x in detections]
+
+
+def _merge_boxes(box: Tensor, conf: Tensor, group: Tensor, kept: Tensor, iou_threshold: float) -> Tensor:
+    """Returns the confidence-weighted mean of the boxes of its group that every kept box overlaps, itself included.
+
+    Only the (kept, member) pairs of the same group are compared, not a dense kept by candidates IoU matrix.
+
+    Args:
+        box (Tensor): candidate boxes with shape (n, 4), xyxy
+        conf (Tensor): candidate confidences with shape (n,)
+        group (Tensor): NMS group of every candidate with shape (n,)
+        kept (Tensor): indices of the boxes to merge with shape (k,)
+        iou_threshold (float): IoU threshold for NMS
+
+    Returns:
+        Tensor: merged boxes with shape (k, 4)
+
+    """
+    # Only the candidates of the groups of kept boxes take part, contiguous in the group order
+    num_groups = int(group.max()) + 1
+    merged_groups = torch.zeros(num_groups, dtype=torch.bool, device=group.device)
+    merged_groups[group[kept]] = True
+    members = merged_groups[group].nonzero().squeeze(1)
+    members = members[torch.sort(group[members], stable=True).indices]
+    group_counts = torch.bincount(group[members], minlength=num_groups)
+    group_starts = group_counts.cumsum(0) - group_counts
+
+    # One (kept, member) pair per member of the group of every kept box
+    kept_group = group[kept]
+    pairs = group_counts[kept_group]
+    pair_kept = torch.repeat_interleave(torch.arange(kept.shape[0], device=kept.device), pairs)
+    pair_offsets = torch.arange(pair_kept.shape[0], device=kept.device) - \
+        torch.repeat_interleave(pairs.cumsum(0) - pairs, pairs)
+    pair_member = members[group_starts[kept_group][pair_kept] + pair_offsets]
+
+    # Element-wise IoU of the pairs
+    box1, box2 = box[kept][pair_kept], box[pair_member]
+    inter = (torch.min(box1[:, 2:], box2[:, 2:]) - torch.max(box1[:, :2], box2[:, :2])).clamp(0).prod(1)
+    area1 = (box1[:, 2] - box1[:, 0]) * (box1[:, 3] - box1[:, 1])
+    area2 = (box2[:, 2] - box2[:, 0]) * (box2[:, 3] - box2[:, 1])
+    weights = (inter / (area1 + area2 - inter) > iou_threshold) * conf[pair_member]  # box weights
+
+    weighted_boxes = box.new_zeros(kept.shape[0], 4).index_add_(0, pair_kept, weights[:, None] * box2)
+    weights_sum = conf.new_zeros(kept.shape[0]).index_add_(0, pair_kept, weights)
+
+    return weighted_boxes / weights_sum[:, None]
 
 
 def plot_one_box(
@@ -623,6 +927,13 @@ class AverageMeter(object):
         self.count += n
         self.avg = self.sum / self.count
 
+    def all_reduce(self, device: torch.device = torch.device("cpu")) -> None:
+        """Sums the meter over all ranks of the default process group, the device must suit its backend."""
+        total = torch.tensor([float(self.sum), float(self.count)], dtype=torch.float64, device=device)
+        distributed.all_reduce(total, distributed.ReduceOp.SUM)
+        self.sum, self.count = total.tolist()
+        self.avg = self.sum / self.count if self.count else 0
+
     def __str__(self):
         fmtstr = "{name} {val" + self.fmt + "} ({avg" + self.fmt + "})"
         return fmtstr.format(**self.__dict__)
@@ -642,6 +953,134 @@ class AverageMeter(object):
         return fmtstr.format(**self.__dict__)
 
 
+class MetricAccumulator(object):
+    """Collects the detection and depth statistics of an evaluation in growable buffers on the evaluation device.
+
+    Every batch is appended as a whole, without copies to the host, and the buffers double in size when full. The
+    statistics reach the host once, when `ap_per_class`, `targets_per_class` or `depth_accuracy` is called.
+
+    Args:
+        niou (int): Number of IoU thresholds.
+        device (torch.device, optional): Device of the buffers. Default: ``torch.device("cpu")``.
+        capacity (int, optional): Initial number of rows of every buffer. Default: 1024.
+
+    """
+
+    def __init__(self, niou: int, device: torch.device = torch.device("cpu"), capacity: int = 1024) -> None:
+        self.niou = niou
+        self.device = device
+        self.capacity = capacity
+        self.reset()
+
+    def reset(self) -> None:
+        self._buffers = {
+            "correct": torch.empty(self.capacity, self.niou, dtype=torch.bool, device=self.device),
+            "conf": torch.empty(self.capacity, device=self.device),
+            "pred_classes": torch.empty(self.capacity, device=self.device),
+            "target_classes": torch.empty(self.capacity, device=self.device),
+            "target_depths": torch.empty(self.capacity, device=self.device),
+            "pred_depths": torch.empty(self.capacity, device=self.device),
+        }
+        self._sizes = dict.fromkeys(self._buffers, 0)
+
+    @property
+    def num_detections(self) -> int:
+        return self._sizes["conf"]
+
+    @property
+    def num_targets(self) -> int:
+        return self._sizes["target_classes"]
+
+    def _get(self, name: str) -> Tensor:
+        return self._buffers[name][:self._sizes[name]]
+
+    def _append(self, name: str, values: Tensor) -> None:
+        buffer, size = self._buffers[name], self._sizes[name]
+        if size + values.shape[0] > buffer.shape[0]:
+            grown = buffer.new_empty((max(2 * buffer.shape[0], size + values.shape[0]), *buffer.shape[1:]))
+            grown[:size] = buffer[:size]
+            self._buffers[name] = buffer = grown
+        buffer[size:size + values.shape[0]] = values
+        self._sizes[name] = size + values.shape[0]
+
+    def update(
+            self,
+            correct: Tensor,
+            conf: Tensor,
+            pred_classes: Tensor,
+            target_classes: Tensor,
+            target_depths: Tensor,
+            pred_depths: Tensor,
+    ) -> None:
+        """Appends the statistics of a batch.
+
+        Args:
+            correct (Tensor): True positives of the detections at every IoU threshold, shape (n, niou).
+            conf (Tensor): Confidence of the detections, shape (n,).
+            pred_classes (Tensor): Class of the detections, shape (n,).
+            target_classes (Tensor): Class of all targets, shape (m,).
+            target_depths (Tensor): Depth of the targets with a depth prediction, shape (k,).
+            pred_depths (Tensor): The predicted depths of these targets, shape (k,).
+
+        """
+        self._append("correct", correct)
+        self._append("conf", conf)
+        self._append("pred_classes", pred_classes)
+        self._append("target_classes", target_classes)
+        self._append("target_depths", target_depths)
+        self._append("pred_depths", pred_depths)
+
+    def merge(self, other: "MetricAccumulator") -> None:
+        """Appends the statistics of another accumulator."""
+        for name in self._buffers:
+            self._append(name, other._get(name).to(self.device))
+
+    def all_gather(self) -> None:
+        """Replaces the statistics with those of all ranks of the default process group, in rank order.
+
+        The device of the accumulator must suit the backend of the process group, the CPU for gloo and CUDA for nccl.
+        """
+        sizes = torch.tensor(list(self._sizes.values()), device=self.device)
+        all_sizes = [torch.empty_like(sizes) for _ in range(distributed.get_world_size())]
+        distributed.all_gather(all_sizes, sizes)
+        all_sizes = torch.stack(all_sizes).tolist()
+
+        gathered = {}
+        for index, name in enumerate(self._buffers):
+            max_size = max(rank_sizes[index] for rank_sizes in all_sizes)
+            values = self._get(name)
+            # Every rank sends the same shape, bool as uint8 for the backends without bool support
+            values = values.to(torch.uint8) if values.dtype == torch.bool else values
+            padded = values.new_zeros((max_size, *values.shape[1:]))
+            padded[:values.shape[0]] = values
+            chunks = [torch.empty_like(padded) for _ in all_sizes]
+            distributed.all_gather(chunks, padded)
+            gathered[name] = [chunk[:rank_sizes[index]].to(self._buffers[name].dtype)
+                              for chunk, rank_sizes in zip(chunks, all_sizes)]
+
+        self.reset()
+        for name, chunks in gathered.items():
+            for chunk in chunks:
+                self._append(name, chunk)
+
+    def ap_per_class(self) -> tuple:
+        """Returns the precision, recall, AP, F1 and classes of `ap_per_class` over the accumulated detections."""
+        return ap_per_class(*[self._get(name).cpu().numpy()
+                              for name in ("correct", "conf", "pred_classes", "target_classes")])
+
+    def targets_per_class(self, num_classes: int) -> ndarray:
+        """Returns the number of targets of every class."""
+        return np.bincount(self._get("target_classes").cpu().numpy().astype(np.int64), minlength=num_classes)
+
+    def depths(self) -> Tuple[ndarray, ndarray]:
+        """Returns the target depths and the predicted depths."""
+        return self._get("target_depths").cpu().numpy(), self._get("pred_depths").cpu().numpy()
+
+    def depth_accuracy(self) -> float:
+        """Returns the mean absolute depth error."""
+        return np.mean(abs(self._get("target_depths") - self._get("pred_depths")).cpu().numpy())
+
+
 class ProgressMeter(object):
     def __init__(self, num_batches, meters, prefix=""):
         self.batch_fmtstr = self._get_batch_fmtstr(num_batches)